@@ -10,52 +10,194 @@ load_dotenv()  # Load environment variables from .env file
 import os
 import json
 import re
+import math
+import time
+import itertools
+import sqlite3
 import requests
 import operator
-from typing import TypedDict, Annotated, List, Dict, Any
+import threading
+from collections import OrderedDict
+from typing import TypedDict, Annotated, List, Dict, Any, Literal
+
+from pydantic import BaseModel, Field, ValidationError
 
 # Import necessary LangChain components
 from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage, AnyMessage, AIMessage
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, END
+from langgraph.checkpoint.sqlite import SqliteSaver
 from langchain_core.tools import tool
+from langchain_core.exceptions import OutputParserException
+
+from singleflight import directions_flight, places_flight, search_flight
+from openai import APITimeoutError
+from hedging import directions_hedger, places_hedger, search_hedger
+from circuit_breaker import directions_breaker, places_breaker, search_breaker, chat_breaker, CircuitOpenError
+from scheduler import scheduler, scheduled_invoke, remaining_time, request_deadline, SchedulerTimeout
+from poi_index import poi_store
+from travel_matrix import travel_matrix, format_duration, format_distance
+from route_geometry import directions_paths, compact_directions
+from osm_router import osm_router
+from metrics import metrics
+from prefetch import PrefetchCache, predict_tool_calls
+from tool_memo import ToolMemo, is_error_result
+from answer_cache import AnswerCache
 
 # Load API keys from environment variables
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MAPS_API_KEY = os.getenv("MAPS_API_KEY")
 
-# Initialize the LLM with OpenAI
-llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=OPENAI_API_KEY, temperature=0.3)
-reasoning_llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=OPENAI_API_KEY, temperature=0.1)
+# Answer Nearby Searches from the local POI store when it knows enough places
+POI_LOCAL_TIER = os.getenv("POI_LOCAL_TIER", "1") != "0"
+# Places not seen for longer than this (seconds) are looked up in the Places API again
+POI_MAX_AGE = float(os.getenv("POI_MAX_AGE", str(7 * 24 * 3600)))
+
+# Walking and bicycling directions come from the local OSM router when its data is built
+LOCAL_ROUTER = os.getenv("LOCAL_ROUTER", "1") != "0"
+
+# Conversation checkpoints (shared by all UI sessions and service workers)
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", "checkpoints.db")
+
+# Graph topology of the agent: "reason_act" (separate reasoning call) or "plan_act"
+AGENT_TOPOLOGY = os.getenv("AGENT_TOPOLOGY", "reason_act")
+
+# Start likely tool calls while the model is still planning
+PREFETCH_TOOLS = os.getenv("PREFETCH_TOOLS", "1") != "0"
+
+# Reuse identical tool results within a conversation
+TOOL_MEMO = os.getenv("TOOL_MEMO", "1") != "0"
+
+# Answer repeated factual attraction questions from earlier answers
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") != "0"
+
+# Wall-clock budget of one agent turn and the part kept back for the final answer (seconds)
+TURN_BUDGET = float(os.getenv("AGENT_TURN_BUDGET", "60"))
+FINAL_ANSWER_RESERVE = float(os.getenv("AGENT_FINAL_ANSWER_RESERVE", "10"))
+
+# Initialize the LLM with OpenAI (scheduled_invoke retries, within the turn deadline)
+llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=OPENAI_API_KEY, temperature=0.3, max_retries=0)
+reasoning_llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=OPENAI_API_KEY, temperature=0.1, max_retries=0)
 
 # === Tool functions ===
 
+def maps_get(url: str, params: dict, retries: int = 2):
+    """GET a Google Maps endpoint within the shared Maps rate limit budget."""
+    for attempt in range(retries + 1):
+        scheduler.acquire("google_maps")
+        # Never a zero timeout (requests rejects it) when the deadline has just passed
+        response = requests.get(url, params=params, timeout=max(remaining_time(30), 1.0))
+        
+        over_limit = response.status_code == 429 or (
+            response.status_code == 200 and response.json().get("status") == "OVER_QUERY_LIMIT"
+        )
+        if not over_limit or attempt == retries:
+            return response
+        
+        # Back off for every caller, not just this one
+        scheduler.providers["google_maps"].pause(2 ** attempt)
+
+class TripDetails(BaseModel):
+    """Everything the tools need from one user message."""
+    origin: str = Field(default="", description="Starting location of a trip, empty if not mentioned")
+    destination: str = Field(default="", description="Destination of a trip, empty if not mentioned")
+    mode: Literal["", "transit", "walking", "bicycling", "driving"] = Field(
+        default="", description="Requested transport mode, empty if not mentioned")
+    attractions: List[str] = Field(
+        default_factory=list, description="Budapest attractions, landmarks or places mentioned or implied")
+    categories: List[Literal["attractions", "restaurants", "cafes", "museums", "parks", "shopping"]] = Field(
+        default_factory=list, description="Kinds of places the user is looking for")
+
+# One schema-constrained call answers both parse_input_tool and extract_attractions_tool
+extraction_llm = llm.with_structured_output(TripDetails)
+
+EXTRACTION_PROMPT = """
+You are a multilingual assistant for Budapest tourism and transport.
+Be flexible with Hungarian address formats and landmarks in Budapest.
+From the following text extract the trip origin and destination, the requested
+transport mode, every mentioned or implied Budapest attraction, landmark or place
+of interest (e.g. "Parliament Building", "Buda Castle") and the kinds of places
+the user is looking for. Leave a field empty when the text does not say it.
+
+Text: "{text}"
+"""
+
+# Extraction results per message (normalized text -> TripDetails dict)
+_extraction_memo = OrderedDict()
+_extraction_lock = threading.Lock()
+EXTRACTION_MEMO_SIZE = 256
+
+def _fallback_trip_details(text: str) -> dict:
+    """Regex based extraction, used when the structured output cannot be parsed."""
+    details = TripDetails().model_dump()
+    match = re.search(r'from\s+(.*?)\s+to\s+(.*)', text, re.IGNORECASE)
+    if not match:
+        # Try Hungarian patterns
+        match = re.search(r'(.*?)-(?:ról|ről|ból|ből|tól|től)\s+(?:a |az )?(.*?)(?:-ra|-re|-ba|-be|-hoz|-hez|-höz)?', text, re.IGNORECASE)
+    if match:
+        details["origin"], details["destination"] = match.group(1), match.group(2)
+    # Potential proper nouns (capitalized words), limited to avoid false positives
+    details["attractions"] = re.findall(r'([A-Z][a-zA-Záéíóöőúüű]+(?:\s+[A-Z][a-zA-Záéíóöőúüű]+)*)', text)[:3]
+    return details
+
+def extract_trip_details(text: str) -> dict:
+    """Origin, destination, mode, attractions and categories of a message in one LLM call.
+    
+    Results are memoized per message, so the tools reading the same message
+    share one call. Regex fallbacks are not memoized: the next call asks the
+    model again.
+    """
+    key = " ".join(text.split()).casefold()
+    with _extraction_lock:
+        if key in _extraction_memo:
+            _extraction_memo.move_to_end(key)
+            metrics.inc("extraction.memo_hits")
+            return dict(_extraction_memo[key])
+    
+    metrics.inc("extraction.calls")
+    messages = [HumanMessage(content=EXTRACTION_PROMPT.format(text=text))]
+    try:
+        # None when the model refused or returned no structured output
+        result = chat_breaker.call(None, lambda: scheduled_invoke(extraction_llm, messages))
+    except (OutputParserException, ValidationError):
+        result = None
+    if result is None:
+        metrics.inc("extraction.fallbacks")
+        return _fallback_trip_details(text)
+    
+    details = result.model_dump()
+    with _extraction_lock:
+        _extraction_memo[key] = details
+        while len(_extraction_memo) > EXTRACTION_MEMO_SIZE:
+            _extraction_memo.popitem(last=False)
+    return dict(details)
+
 def parse_trip_input(user_input: str) -> dict:
     """Extract origin and destination from user text input."""
-    prompt = f"""
-    You are a multilingual assistant specializing in Hungarian location recognition.
-    Extract two locations from this sentence.
-    Be flexible with Hungarian address formats and landmarks in Budapest.
-    Respond ONLY with a JSON like:
-    {{"from": "X", "to": "Y"}}
-    Input: "{user_input}"
-    """
-    messages = [HumanMessage(content=prompt)]
-    response = llm.invoke(messages)
+    details = extract_trip_details(user_input)
+    trip = {"from": details["origin"], "to": details["destination"]}
+    if details["mode"]:
+        trip["mode"] = details["mode"]
+    return trip
 
-    try:
-        return json.loads(response.content)
-    except:
-        # Fallback parsing with simple regex
-        match = re.search(r'from\s+(.*?)\s+to\s+(.*)', user_input, re.IGNORECASE)
-        if match:
-            return {"from": match.group(1), "to": match.group(2)}
-        # Try Hungarian patterns
-        match = re.search(r'(.*?)-(?:ról|ről|ból|ből|tól|től)\s+(?:a |az )?(.*?)(?:-ra|-re|-ba|-be|-hoz|-hez|-höz)?', user_input, re.IGNORECASE)
-        return {"from": match.group(1), "to": match.group(2)} if match else {"from": "", "to": ""}
+# Maps API statuses that mean the service (not the query) failed
+MAPS_FAILURE_STATUSES = {"UNKNOWN_ERROR", "OVER_QUERY_LIMIT", "REQUEST_DENIED"}
+
+def is_maps_failure(data) -> bool:
+    """Whether a Maps API result counts as an upstream failure for the circuit breaker."""
+    return data is None or "error" in data or data.get("status") in MAPS_FAILURE_STATUSES
 
 def get_directions(from_place: str, to_place: str, mode: str = "transit") -> dict:
-    """Get route directions using Google Directions API."""
+    """Get route directions using Google Directions API.
+    
+    Walking and bicycling routes are answered by the local OSM router when
+    it knows both places; everything else goes to the API.
+    """
+    if LOCAL_ROUTER and mode in ("walking", "bicycling") and osm_router.available:
+        route = osm_router.directions(from_place, to_place, mode)
+        if route is not None:
+            return route
+    
     url = "https://maps.googleapis.com/maps/api/directions/json"
     
     # Add Budapest to location if not specified
@@ -76,25 +218,137 @@ def get_directions(from_place: str, to_place: str, mode: str = "transit") -> dic
     if mode == "transit":
         params["transit_mode"] = "bus|subway|train|tram"
     
-    response = requests.get(url, params=params)
-    return response.json() if response.status_code == 200 else {"error": "Directions API failed"}
+    def fetch():
+        response = maps_get(url, params)
+        return response.json() if response.status_code == 200 else {"error": "Directions API failed"}
+    
+    def guarded_fetch():
+        # While the API is down the last good route is served, or we fail fast
+        try:
+            return directions_breaker.call(key, lambda: directions_hedger.call(fetch), is_failure=is_maps_failure)
+        except CircuitOpenError:
+            return {"error": "Directions API temporarily unavailable"}
+    
+    # Identical concurrent requests share one upstream call
+    key = (from_place, to_place, mode)
+    return directions_flight.do(key, guarded_fetch)
 
-def get_local_attractions(lat: float, lng: float, category: str = "tourist_attraction", radius: int = 1000) -> dict:
-    """Find places near coordinates based on category using Google Places API."""
-    places_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+def route_summary(from_place: str, to_place: str, mode: str = "transit", with_path: bool = False) -> dict:
+    """Total duration and distance of a trip, without step-by-step directions.
+    
+    Landmark-to-landmark pairs are read from the precomputed travel matrix;
+    other pairs fall back to the Directions API. With with_path the
+    simplified route geometry is added as 'path' when the API was called.
+    """
+    summary = travel_matrix.lookup(from_place, to_place, mode)
+    if summary is not None:
+        return dict(summary, source="precomputed travel matrix")
     
-    # Map user-friendly categories to Google Places API types
-    category_map = {
-        "attractions": "tourist_attraction",
-        "restaurants": "restaurant",
-        "cafes": "cafe",
-        "museums": "museum",
-        "parks": "park",
-        "shopping": "shopping_mall",
+    route = get_directions(from_place, to_place, mode)
+    if not route.get("routes"):
+        return {"error": route.get("error") or route.get("status", "Route not found"),
+                "from": from_place, "to": to_place, "mode": mode}
+    leg = route["routes"][0]["legs"][0]
+    summary = {
+        "from": from_place,
+        "to": to_place,
+        "mode": mode,
+        "duration_s": leg["duration"]["value"],
+        "distance_m": leg["distance"]["value"],
+        "duration_text": format_duration(leg["duration"]["value"]),
+        "distance_text": format_distance(leg["distance"]["value"]),
+        "source": route.get("source", "directions api")
+    }
+    if with_path:
+        summary["path"] = directions_paths(route, mode)[0]["path"]
+    return summary
+
+PLACES_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+
+# Map user-friendly categories to Google Places API types
+PLACE_CATEGORY_MAP = {
+    "attractions": "tourist_attraction",
+    "restaurants": "restaurant",
+    "cafes": "cafe",
+    "museums": "museum",
+    "parks": "park",
+    "shopping": "shopping_mall",
+}
+
+# Default weights of the place ranking score (each feature is scaled to 0..1)
+PLACE_RANKING_WEIGHTS = {
+    "rating": 1.0,     # Google rating / 5
+    "reviews": 0.5,    # Review count on a log scale
+    "distance": 1.0,   # 1 at the search center, 0 at the search radius
+    "open_now": 0.5    # 1 if open, 0.5 if unknown, 0 if closed
+}
+
+class PlacesAPIError(RuntimeError):
+    """Raised when the first Places page cannot be fetched."""
+
+def distance_meters(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two coordinates in meters."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+def score_place(place: dict, radius: int, weights: dict = None) -> float:
+    """Ranking score of a normalized place (see PLACE_RANKING_WEIGHTS)."""
+    weights = weights or PLACE_RANKING_WEIGHTS
+    rating = place["rating"] if isinstance(place["rating"], (int, float)) else 0
+    open_now = {True: 1.0, False: 0.0}.get(place["open_now"], 0.5)
+    features = {
+        "rating": rating / 5,
+        "reviews": min(1.0, math.log1p(place["user_ratings_total"]) / math.log1p(10000)),
+        "distance": max(0.0, 1 - place["distance_m"] / radius) if radius else 0.0,
+        "open_now": open_now
     }
+    return sum(weights.get(name, 0) * value for name, value in features.items())
+
+def rank_places(places: list, radius: int, weights: dict = None) -> list:
+    """Sort normalized places by their ranking score, best first."""
+    for place in places:
+        place["score"] = score_place(place, radius, weights)
+    return sorted(places, key=lambda p: p["score"], reverse=True)
+
+def fetch_places_page(params: dict, retries: int = 3) -> dict:
+    """Fetch one Nearby Search page (the first one, or the one of params['pagetoken'])."""
+    def fetch():
+        for attempt in range(retries + 1):
+            res = maps_get(PLACES_URL, params)
+            if res.status_code != 200:
+                return None
+            data = res.json()
+            # A fresh next_page_token only becomes valid after a short delay
+            if "pagetoken" in params and data.get("status") == "INVALID_REQUEST" and attempt < retries:
+                time.sleep(1)
+                continue
+            return data
+        return None
     
-    place_type = category_map.get(category.lower(), category)
+    def guarded_fetch():
+        # Page tokens are single-use and rejected until they become valid, so
+        # next pages are neither hedged (a duplicate could race the token) nor served stale
+        paged = "pagetoken" in params
+        try:
+            return places_breaker.call(None if paged else key, fetch if paged else lambda: places_hedger.call(fetch),
+                                       is_failure=is_maps_failure)
+        except CircuitOpenError:
+            return None
+    
+    # Identical concurrent requests share one upstream call
+    key = tuple(sorted(params.items()))
+    return places_flight.do(key, guarded_fetch)
+
+def iter_local_attractions(lat: float, lng: float, category: str = "tourist_attraction", radius: int = 1000,
+                           max_pages: int = 3, weights: dict = None):
+    """Lazily yield places near coordinates, best ranked first within each page.
     
+    Further result pages are only requested when the consumer asks for more
+    places than the pages fetched so far. Places are deduplicated by place_id.
+    Raises PlacesAPIError if not even the first page could be fetched.
+    """
+    place_type = PLACE_CATEGORY_MAP.get(category.lower(), category)
     params = {
         "location": f"{lat},{lng}",
         "radius": radius,
@@ -103,66 +357,101 @@ def get_local_attractions(lat: float, lng: float, category: str = "tourist_attra
         "key": MAPS_API_KEY
     }
     
-    res = requests.get(places_url, params=params)
-    if res.status_code == 200:
-        data = res.json()
-        places = []
-        for place in data.get("results", [])[:5]:  # Limit to 5 results
-            places.append({
+    seen = set()
+    for page in range(max_pages):
+        data = fetch_places_page(params)
+        if data is None:
+            if page == 0:
+                raise PlacesAPIError("Places API failed")
+            return
+        
+        batch = []
+        for place in data.get("results", []):
+            place_id = place.get("place_id") or place.get("name")
+            if place_id in seen:
+                continue
+            seen.add(place_id)
+            location = place.get("geometry", {}).get("location", {})
+            batch.append({
+                "place_id": place_id,
                 "name": place.get("name"),
                 "rating": place.get("rating", "N/A"),
+                "user_ratings_total": place.get("user_ratings_total", 0),
                 "address": place.get("vicinity"),
-                "open_now": place.get("opening_hours", {}).get("open_now", "unknown")
+                "open_now": place.get("opening_hours", {}).get("open_now", "unknown"),
+                "location": location,
+                "types": place.get("types", []),
+                "distance_m": distance_meters(lat, lng, location["lat"], location["lng"]) if location else radius
             })
-        return {"places": places}
-    return {"error": "Places API failed", "places": []}
+        # Remember the places (with the searched type) for local nearby queries
+        poi_store.add_many(dict(place, category=place_type) for place in batch)
+        yield from rank_places(batch, radius, weights)
+        
+        next_page_token = data.get("next_page_token")
+        if not next_page_token:
+            return
+        params = {"pagetoken": next_page_token, "key": MAPS_API_KEY}
 
-def extract_attraction_names(text: str) -> list:
-    """Extract attraction names from user query text."""
-    prompt = f"""
-    You are a specialized assistant for Budapest tourism.
-    From the following text, extract any mentioned or implied Budapest attractions, landmarks, or places of interest.
-    Return ONLY a JSON array of attraction names, with no additional text.
-    
-    Example output: ["Parliament Building", "Buda Castle"]
-    
-    Text: "{text}"
-    """
-    messages = [HumanMessage(content=prompt)]
-    response = llm.invoke(messages)
+def get_local_attractions(lat: float, lng: float, category: str = "tourist_attraction", radius: int = 1000,
+                          include_location: bool = False) -> dict:
+    """Find places near coordinates based on category using Google Places API."""
+    # First tier: the local POI store, if it knows enough matching places
+    place_type = PLACE_CATEGORY_MAP.get(category.lower(), category)
+    local_places = poi_store.local_places(lat, lng, place_type, radius, minimum=5, max_age=POI_MAX_AGE) \
+        if POI_LOCAL_TIER else None
     
     try:
-        # Try to parse JSON array from response
-        attractions = json.loads(response.content)
-        if isinstance(attractions, list):
-            return attractions
-    except:
-        # Fallback: Find potential proper nouns (capitalized words)
-        potential_attractions = re.findall(r'([A-Z][a-zA-Záéíóöőúüű]+(?:\s+[A-Z][a-zA-Záéíóöőúüű]+)*)', text)
-        if potential_attractions:
-            return potential_attractions[:3]  # Limit to avoid excessive false positives
-    
-    return []
+        if local_places:
+            ranked = rank_places(local_places, radius)[:5]
+        else:
+            # Limit to 5 results - only the first page is fetched for that
+            ranked = itertools.islice(iter_local_attractions(lat, lng, category, radius), 5)
+        places = []
+        for place in ranked:
+            item = {
+                "name": place["name"],
+                "rating": place["rating"],
+                "address": place["address"],
+                "open_now": place["open_now"]
+            }
+            if include_location:
+                item["location"] = place.get("location")
+            places.append(item)
+    except PlacesAPIError:
+        return {"error": "Places API failed", "places": []}
+    return {"places": places}
+
+def extract_attraction_names(text: str) -> list:
+    """Extract attraction names from user query text."""
+    return list(extract_trip_details(text)["attractions"])
 
 # === Register tools with LangChain's @tool decorator ===
 
 @tool
 def parse_input_tool(text: str) -> dict:
-    """Parses user input and extracts 'from' and 'to' destinations."""
+    """Parses user input and extracts 'from' and 'to' destinations (and 'mode' if the user asked for one)."""
     return parse_trip_input(text)
 
-@tool
-def directions_tool(from_place: str, to_place: str, mode: str = "transit") -> dict:
+@tool(response_format="content_and_artifact")
+def directions_tool(from_place: str, to_place: str, mode: str = "transit", summary_only: bool = False) -> tuple:
     """Gets route using Google Directions API.
     Args:
         from_place: Starting location
         to_place: Destination location
         mode: Transportation mode (transit, walking, bicycling, driving)
+        summary_only: Set to true when only the travel time and distance are needed, not the steps
     """
-    return get_directions(from_place, to_place, mode)
+    # The route geometry goes to the map as the artifact, the model only gets the text
+    if summary_only:
+        summary = route_summary(from_place, to_place, mode, with_path=True)
+        path = summary.pop("path", None)
+        paths = [{"from": from_place, "to": to_place, "mode": mode, "path": path}] if path else []
+        return summary, {"paths": paths}
+    directions = get_directions(from_place, to_place, mode)
+    return compact_directions(directions), {"paths": directions_paths(directions, mode)}
 
-@tool
-def attractions_tool(lat: float, lng: float, category: str = "tourist_attraction", radius: int = 1000) -> dict:
+@tool(response_format="content_and_artifact")
+def attractions_tool(lat: float, lng: float, category: str = "tourist_attraction", radius: int = 1000) -> tuple:
     """Finds places near coordinates based on category.
     Args:
         lat: Latitude
@@ -170,7 +459,14 @@ def attractions_tool(lat: float, lng: float, category: str = "tourist_attraction
         category: Place category (attractions, restaurants, cafes, museums, parks, shopping)
         radius: Search radius in meters
     """
-    return get_local_attractions(lat, lng, category, radius)
+    result = get_local_attractions(lat, lng, category, radius, include_location=True)
+    points = [
+        {"name": place["name"], "lat": place["location"]["lat"], "lng": place["location"]["lng"]}
+        for place in result["places"] if place.get("location")
+    ]
+    for place in result["places"]:
+        place.pop("location", None)
+    return result, {"points": points}
 
 @tool
 def extract_attractions_tool(text: str) -> list:
@@ -198,9 +494,12 @@ Focus ONLY on Budapest context. No global or irrelevant content.
 Return a list where each name is followed by its description.
 """
     try:
-        # Use the search-capable model
-        gpt4_model = ChatOpenAI(model="gpt-4o-search-preview-2025-03-11", openai_api_key=OPENAI_API_KEY)
-        response = gpt4_model.invoke([HumanMessage(content=prompt)])
+        # Use the search-capable model; identical concurrent lookups share one call
+        gpt4_model = ChatOpenAI(model="gpt-4o-search-preview-2025-03-11", openai_api_key=OPENAI_API_KEY, max_retries=0)
+        key = ("attraction_info", json.dumps(attractions, ensure_ascii=False))
+        response = search_flight.do(key, lambda: search_breaker.call(key, lambda: search_hedger.call(
+            lambda: scheduled_invoke(gpt4_model, [HumanMessage(content=prompt)], expected_output_tokens=1000)
+        )))
         
         return {
             "info": response.content,
@@ -218,6 +517,9 @@ Return a list where each name is followed by its description.
 class AgentState(TypedDict):
     """Represents the state of the agent throughout the conversation."""
     messages: Annotated[list[AnyMessage], operator.add]  # The messages accumulate
+    deadline: float  # Wall-clock end of the current turn (time.time())
+    deadline_turn: int  # Position of the human message whose turn the deadline belongs to
+    plan: str  # Reasoning plan of the current turn (kept out of the message history)
 
 # === Reasoning prompt for the planning step ===
 REASONING_PROMPT = """
@@ -241,27 +543,84 @@ Format your response as a clear, step-by-step plan.
 DO NOT write any actual tool calls or code - just describe what you plan to do.
 """
 
+# === Planning instruction for the single-call (plan_act) topology ===
+PLAN_ACT_PROMPT = """
+Before acting on the user's new message, plan your approach:
+what the user is asking for, which information is needed, and which tools to use in what order.
+Write this plan at the very beginning of your reply between <plan> and </plan> tags,
+then in the same reply make the first tool calls of the plan (or answer directly if no tool is needed).
+The plan is hidden from the user.
+"""
+
+# === Instruction when the turn has to end without more tool calls ===
+FINAL_ANSWER_PROMPT = """
+There is no time left for more tool calls. Answer the user now, using only the
+information gathered so far. If something could not be looked up, say so briefly.
+"""
+
+# Answer when the turn budget ran out before the final answer could be written
+OUT_OF_TIME_ANSWER = ("Sajnos nem maradt idő a válasz befejezésére, kérlek próbáld újra. / "
+                      "Sorry, I ran out of time to finish this answer, please try again.")
+
+PLAN_PATTERN = re.compile(r"<plan>(.*?)</plan>\s*", re.DOTALL)
+
 # === Agent class to manage the conversation flow ===
 class Agent:
     """A LangGraph-based ReAct agent that adds reasoning before tool use."""
     
-    def __init__(self, model, tools, system=""):
-        """Initialize the agent with a language model, tools, and system prompt."""
+    def __init__(self, model, tools, system="", checkpointer=None, topology="reason_act", prefetch=PREFETCH_TOOLS,
+                 memo=TOOL_MEMO, turn_budget=TURN_BUDGET, answer_cache=ANSWER_CACHE):
+        """Initialize the agent with a language model, tools, and system prompt.
+
+        With a checkpointer the conversation state is stored per thread ID,
+        so each turn only needs to send the new human message.
+
+        topology selects the graph: "reason_act" runs a separate reasoning
+        call before the main model, "plan_act" lets the main model write its
+        plan and make the first tool calls in the same response.
+
+        With prefetch, tool calls guessed from the user message run while
+        the model is planning (see prefetch.py). With memo, repeated tool
+        calls of a conversation are answered from tool_memo.py. With
+        answer_cache, near-duplicates of earlier factual attraction questions
+        are answered without running the graph (see answer_cache.py).
+
+        Every turn gets turn_budget seconds of wall-clock time. Model and
+        tool calls only get the time that is left, and when it (or the
+        recursion limit) is nearly used up the model has to answer from
+        what it gathered so far instead of calling more tools.
+        """
+        if topology not in ("reason_act", "plan_act"):
+            raise ValueError(f"Unknown agent topology: {topology}")
         self.system = system
+        self.topology = topology
+        self.turn_budget = turn_budget
+        # The system prompt and the tool schemas form the same prefix in every call,
+        # so the provider's prompt cache can reuse it
+        self.system_message = SystemMessage(content=system) if system else None
         self.model = model.bind_tools(tools)
+        # Same tool schemas (same cached prefix), but no tool calls allowed - for forced final answers
+        self.answer_model = model.bind_tools(tools, tool_choice="none") if tools else model
         self.tools = {t.name: t for t in tools}
+        self.prefetch = PrefetchCache() if prefetch and tools else None
+        self.memo = ToolMemo() if memo and tools else None
+        self.answer_cache = AnswerCache() if answer_cache and tools else None
 
         # Create a graph with reasoning, llm and action nodes
         graph = StateGraph(AgentState)
         
         # Add nodes
-        graph.add_node("reason", self.add_reasoning)  # New reasoning node
-        graph.add_node("llm", self.call_openai)  # Node for generating responses or tool calls
+        if topology == "reason_act":
+            graph.add_node("reason", self.add_reasoning)  # New reasoning node
+            graph.add_node("llm", self.call_openai)  # Node for generating responses or tool calls
+        else:
+            graph.add_node("llm", self.plan_and_act)  # Plans and calls tools in one response
         graph.add_node("action", self.take_action)  # Node for executing tools
         
         # Add edges to define the flow:
         # Start with reasoning -> then LLM -> then possibly action -> back to LLM -> end
-        graph.add_edge("reason", "llm")
+        if topology == "reason_act":
+            graph.add_edge("reason", "llm")
         
         graph.add_conditional_edges(
             "llm",  # From the LLM node
@@ -271,17 +630,134 @@ class Agent:
         graph.add_edge("action", "llm")  # After action, go back to LLM
         
         # Set the entry point to reasoning (the new first step)
-        graph.set_entry_point("reason")
+        graph.set_entry_point("reason" if topology == "reason_act" else "llm")
         
         # Compile the graph
-        self.graph = graph.compile()
+        self.checkpointer = checkpointer
+        self.graph = graph.compile(checkpointer=checkpointer)
+
+    def thread_config(self, thread_id: str, recursion_limit: int = 10) -> dict:
+        """Graph config that resumes the conversation stored under thread_id."""
+        return {"configurable": {"thread_id": thread_id}, "recursion_limit": recursion_limit}
+
+    def run_turn(self, thread_id: str, message: HumanMessage, recursion_limit: int = 10,
+                 use_cache: bool = True) -> list:
+        """Run one conversation turn and return only the messages it produced.
+
+        The previous history is resumed from the checkpoint of the thread,
+        so only the new human message is sent into the graph. use_cache=False
+        bypasses the answer cache (the new answer still refreshes it).
+        """
+        cached = self.cached_turn(thread_id, message, bypass=not use_cache)
+        if cached is not None:
+            return cached
+
+        config = self.thread_config(thread_id, recursion_limit)
+        previous_count = 0
+        if self.checkpointer is not None:
+            previous_count = len(self.graph.get_state(config).values.get("messages", []))
+
+        result = self.graph.invoke({"messages": [message]}, config)
+        turn_messages = result["messages"][previous_count:]
+        self.remember_turn(message, turn_messages)
+        return turn_messages
+
+    def cached_turn(self, thread_id: str, message: HumanMessage, bypass: bool = False):
+        """The turn answered from the answer cache, or None if the graph has to run.
+
+        A hit is still recorded in the thread (as if the llm node had
+        answered), so follow-up questions see it in the history.
+        """
+        if self.answer_cache is None:
+            return None
+        if bypass:
+            metrics.inc("answer_cache.bypassed")
+            return None
+        hit = self.answer_cache.lookup(message.content)
+        if hit is None:
+            return None
+        answer = AIMessage(content=hit["answer"], response_metadata={
+            "source": "answer_cache", "cached_query": hit["query"], "similarity": hit["similarity"]
+        })
+        if self.checkpointer is not None:
+            self.graph.update_state(self.thread_config(thread_id), {"messages": [message, answer], "plan": ""},
+                                    as_node="llm")
+        return [message, answer]
+
+    def remember_turn(self, message: HumanMessage, turn_messages: list):
+        """Store the answer of a turn in the answer cache if it is a complete, web-searched fact answer."""
+        if self.answer_cache is None or not turn_messages:
+            return
+        final = turn_messages[-1]
+        if not isinstance(final, AIMessage) or final.tool_calls or final.response_metadata.get("forced_final") \
+                or not isinstance(final.content, str):
+            return
+        tool_results = [m for m in turn_messages if isinstance(m, ToolMessage)]
+        searched = any(m.name == "attraction_info_tool" for m in tool_results)
+        # Failed, skipped or invalid tool calls are marked by take_action
+        failed = any(m.status == "error" for m in tool_results)
+        if searched and not failed:
+            self.answer_cache.store(message.content, final.content)
+
+    def delete_thread(self, thread_id: str):
+        """Forget a conversation: its checkpoints and its memoized tool results."""
+        if self.checkpointer is not None:
+            self.checkpointer.delete_thread(thread_id)
+        if self.memo is not None:
+            self.memo.clear(thread_id)
+
+    def current_plan(self, thread_id: str):
+        """Reasoning plan of the last turn of a thread (it is not part of the messages)."""
+        if self.checkpointer is None:
+            return None
+        return self.graph.get_state(self.thread_config(thread_id)).values.get("plan") or None
 
     def exists_action(self, state: AgentState):
         """Check if the last message contains any tool calls."""
         result = state['messages'][-1]
         return hasattr(result, 'tool_calls') and len(getattr(result, 'tool_calls', [])) > 0
 
-    def add_reasoning(self, state: AgentState):
+    @staticmethod
+    def turn_index(state: AgentState) -> int:
+        """Position of the last human message - the start of the current turn."""
+        return max((i for i, m in enumerate(state['messages']) if isinstance(m, HumanMessage)), default=0)
+
+    def turn_key(self, state: AgentState, config) -> tuple:
+        """(thread ID, position of the last human message) - identifies the current turn."""
+        thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
+        return thread_id, self.turn_index(state)
+
+    def start_prefetch(self, state: AgentState, config):
+        """Run the tool calls guessed from the new human message in the background."""
+        if self.prefetch is None:
+            return
+        calls = predict_tool_calls(state['messages'][-1].content)
+        if calls:
+            self.prefetch.start(self.turn_key(state, config), self.tools, calls, self.run_tool)
+
+    def turn_deadline(self, state: AgentState) -> dict:
+        """Deadline of the current turn as state fields {'deadline', 'deadline_turn'}.
+
+        It is set once, by the first node of the turn, and stored with the
+        position of the turn's human message; later nodes of the same turn
+        only read it back.
+        """
+        turn = self.turn_index(state)
+        if state.get('deadline') and state.get('deadline_turn') == turn:
+            return {'deadline': state['deadline'], 'deadline_turn': turn}
+        return {'deadline': time.time() + self.turn_budget, 'deadline_turn': turn}
+
+    def turn_step(self, state: AgentState) -> int:
+        """Graph step of the next model call within the current turn.
+
+        (The step counter of the checkpointer runs on across turns, so it is
+        counted from the messages: reason node + one llm/action pair per tool round.)
+        """
+        messages = state['messages']
+        rounds = sum(1 for m in messages[self.turn_index(state):] if isinstance(m, AIMessage) and m.tool_calls)
+        return (1 if self.topology == "reason_act" else 0) + 2 * rounds + 1
+
+    def add_reasoning(self, state: AgentState, config=None):
         """Add reasoning as a message in the state."""
         messages = state['messages']
         last_message = messages[-1] if messages else None
@@ -289,6 +765,9 @@ class Agent:
         # Only reason about human messages
         if not isinstance(last_message, HumanMessage):
             return {'messages': []}
+        
+        # Likely tool calls start now instead of after the reasoning call
+        self.start_prefetch(state, config)
             
         # Create reasoning prompt with user's query
         reasoning_messages = [
@@ -296,49 +775,183 @@ class Agent:
             HumanMessage(content=f"User message: {last_message.content}\n\nDevelop a plan to answer this request.")
         ]
         
-        # Get reasoning plan
-        reasoning_response = reasoning_llm.invoke(reasoning_messages)
-        reasoning_content = reasoning_response.content
+        # Get reasoning plan (within the turn budget, keeping time for the answer)
+        turn_deadline = self.turn_deadline(state)
+        try:
+            with request_deadline(turn_deadline['deadline'] - time.time() - FINAL_ANSWER_RESERVE):
+                reasoning_response = chat_breaker.call(None, lambda: scheduled_invoke(reasoning_llm, reasoning_messages))
+        except (SchedulerTimeout, APITimeoutError, CircuitOpenError):
+            # No plan is better than no answer
+            metrics.inc("agent.reasoning_timeouts")
+            return {'plan': "", **turn_deadline}
         
-        # Create a system message with reasoning to add to the state
-        reasoning_msg = SystemMessage(content=f"### Reasoning Plan:\n{reasoning_content}\n\n### Now execute this plan to help the user.")
-        
-        # Return the reasoning as a message to be added to the state
-        return {'messages': [reasoning_msg]}
+        # The plan is kept in its own state field, not in the history, so the
+        # history stays an unchanged (cacheable) prefix from turn to turn
+        return {'plan': reasoning_response.content, **turn_deadline}
+
+    def assemble_messages(self, state: AgentState, extra: list = None) -> list:
+        """Prompt of a model call: static prefix first, per-turn content last.
 
-    def call_openai(self, state: AgentState):
+        [system prompt] + history + [reasoning plan] + extra instructions.
+        The history only ever grows at its end, so everything before the
+        plan is the same as in the previous call and hits the prompt cache.
+        """
+        messages = [self.system_message] if self.system_message is not None else []
+        messages += state['messages']
+        if state.get('plan'):
+            messages.append(SystemMessage(content=f"### Reasoning Plan:\n{state['plan']}\n\n### Now execute this plan to help the user."))
+        return messages + (extra or [])
+
+    def call_openai(self, state: AgentState, config=None, extra: list = None):
         """Call the language model to generate a response or tool calls."""
-        messages = state['messages']
-        
-        # Add original system message if not present
-        if self.system and not any(m.content == self.system for m in messages if isinstance(m, SystemMessage)):
-            system_msg = SystemMessage(content=self.system)
-            messages = [system_msg] + messages
+        messages = self.assemble_messages(state, extra)
             
+        # Out of time or steps: answer now from what was gathered (no tools offered)
+        turn_deadline = self.turn_deadline(state)
+        remaining = turn_deadline['deadline'] - time.time()
+        forced = None
+        if remaining < FINAL_ANSWER_RESERVE:
+            forced = "deadline"
+        elif self.turn_step(state) >= (config or {}).get("recursion_limit", 25) - 2:
+            forced = "step_limit"
+        
         # Call the model and get a response
-        message = self.model.invoke(messages)
+        if not forced:
+            try:
+                # The reserve stays free for a forced answer if this call runs out of time
+                with request_deadline(remaining - FINAL_ANSWER_RESERVE):
+                    message = chat_breaker.call(None, lambda: scheduled_invoke(self.model, messages))
+            except (SchedulerTimeout, APITimeoutError):
+                forced = "deadline"
+                remaining = turn_deadline['deadline'] - time.time()
+        if forced:
+            metrics.inc(f"agent.forced_final.{forced}")
+            # Only the time that is really left: the final answer must not overrun the budget either
+            try:
+                if remaining <= 0:
+                    raise SchedulerTimeout("turn budget used up")
+                with request_deadline(remaining):
+                    message = chat_breaker.call(None, lambda: scheduled_invoke(
+                        self.answer_model, messages + [SystemMessage(content=FINAL_ANSWER_PROMPT)]
+                    ))
+            except (SchedulerTimeout, APITimeoutError, CircuitOpenError):
+                metrics.inc("agent.final_answer_timeouts")
+                message = AIMessage(content=OUT_OF_TIME_ANSWER)
+            message = message.model_copy(update={
+                "response_metadata": {**message.response_metadata, "forced_final": forced}
+            })
+        
+        if not getattr(message, 'tool_calls', None):
+            # A final answer ends the turn; unused prefetched results are dropped
+            if self.prefetch is not None:
+                self.prefetch.finish(self.turn_key(state, config))
+            # All nodes of the turn together must have stayed within the budget
+            elapsed = time.time() - (turn_deadline['deadline'] - self.turn_budget)
+            metrics.observe("agent.turn_seconds", elapsed)
+            if elapsed > self.turn_budget:
+                metrics.inc("agent.budget_overruns")
         
         # Return the updated state with the new message
-        return {'messages': [message]}
+        return {'messages': [message], **turn_deadline}
+
+    def plan_and_act(self, state: AgentState, config=None):
+        """Call the model; on a new human message it also writes its plan (plan_act topology).
+
+        The plan is cut out of the response and stored in the plan field,
+        like the reason node's plan, so later calls and Developer Mode see
+        it, but the user does not.
+        """
+        last_message = state['messages'][-1] if state['messages'] else None
+        if not isinstance(last_message, HumanMessage):
+            return self.call_openai(state, config)
+        
+        # Ask for the plan only on the first call of the turn (the old plan is not shown)
+        self.start_prefetch(state, config)
+        result = self.call_openai({'messages': state['messages'], **self.turn_deadline(state)},
+                                  config, extra=[SystemMessage(content=PLAN_ACT_PROMPT)])
+        message = result['messages'][0]
+        content = message.content if isinstance(message.content, str) else ""
+        match = PLAN_PATTERN.search(content)
+        if not match:
+            return dict(result, plan="")
+        
+        message = message.model_copy(update={"content": PLAN_PATTERN.sub("", content, count=1)})
+        return {'messages': [message], 'plan': match.group(1).strip(), 'deadline': result['deadline'],
+                'deadline_turn': result['deadline_turn']}
+
+    def run_tool(self, t: dict) -> tuple:
+        """Execute one tool call and return (result, artifact)."""
+        tool = self.tools[t['name']]
+        if tool.response_format == "content_and_artifact":
+            # Map data etc. travels as the artifact and never reaches the model
+            message = tool.invoke({"name": t['name'], "args": t['args'], "id": t.get('id') or "prefetch", "type": "tool_call"})
+            return message.content, message.artifact
+        # Call the tool with the arguments
+        return tool.invoke(t['args']), None
 
-    def take_action(self, state: AgentState):
+    def execute_tool(self, t: dict, turn_key: tuple) -> tuple:
+        """Result of a tool call from the memo, the prefetch cache or a new run.
+
+        Returns (result, artifact, source).
+        """
+        tool = self.tools[t['name']]
+        thread_id = turn_key[0]
+        
+        # The same call earlier in this conversation
+        memoized = self.memo.get(thread_id, tool, t['name'], t['args']) if self.memo is not None else None
+        if memoized is not None:
+            return memoized[0], memoized[1], "memo"
+        
+        source = "tool"
+        prefetched = None
+        if self.prefetch is not None:
+            prefetched = self.prefetch.take(turn_key, tool, t['name'], t['args'])
+        if prefetched is not None:
+            try:
+                # Already running or done since the reasoning step
+                result, artifact = prefetched.result(timeout=remaining_time())
+                source = "prefetch"
+            except Exception:
+                prefetched = None  # Failed in the background; run it the normal way
+        if prefetched is None:
+            result, artifact = self.run_tool(t)
+        if self.memo is not None:
+            self.memo.put(thread_id, tool, t['name'], t['args'], result, artifact)
+        return result, artifact, source
+
+    def take_action(self, state: AgentState, config=None):
         """Execute any tool calls from the language model."""
         tool_calls = state['messages'][-1].tool_calls
         results = []
+        turn_key = self.turn_key(state, config)
+        deadline = self.turn_deadline(state)['deadline']
         
         # Process each tool call
         for t in tool_calls:
+            artifact = None
+            source = "tool"  # Where the result came from (shown in Developer Mode)
+            failed = True
+            remaining = deadline - time.time() - FINAL_ANSWER_RESERVE
             if t['name'] not in self.tools:
                 result = f"Invalid tool name: {t['name']}. Retry."
+            elif remaining <= 0:
+                # Keep the rest of the budget for the answer
+                result = "Skipped: the time budget of this turn is used up."
+                source = "skipped"
+                metrics.inc("agent.skipped_tool_calls")
             else:
                 try:
-                    # Call the tool with the arguments
-                    result = self.tools[t['name']].invoke(t['args'])
+                    # Tool timeouts (Maps requests, search calls) get the remaining time
+                    with request_deadline(remaining):
+                        result, artifact, source = self.execute_tool(t, turn_key)
+                    failed = is_error_result(result)
                 except Exception as e:
                     result = f"Error executing tool: {str(e)}"
                     
-            # Create a tool message with the result
-            results.append(ToolMessage(tool_call_id=t['id'], name=t['name'], content=str(result)))
+            # Create a tool message with the result; failures are marked with status="error"
+            results.append(ToolMessage(tool_call_id=t['id'], name=t['name'], content=str(result), artifact=artifact,
+                                       status="error" if failed else "success",
+                                       response_metadata={"source": source}))
             
         # Return the updated state with the tool results
         return {'messages': results}
@@ -362,6 +975,7 @@ Follow these steps when responding to users:
      * Format step numbers and use clear arrows (→) between locations
      * For transit steps, include: line number, vehicle type, departure stop, and arrival stop
    - If the user specifies a transportation mode (walking, bicycling, driving), use that mode
+   - If the user only asks how long a trip takes or how far it is, call directions_tool with summary_only=true
 
 2. For attraction recommendations:
    - Get coordinates from the route data
@@ -395,7 +1009,7 @@ Be helpful, friendly, and provide concise but complete information.
 """
 
 # Create the model instance
-model = ChatOpenAI(model="gpt-4o-mini", openai_api_key=OPENAI_API_KEY)
+model = ChatOpenAI(model="gpt-4o-mini", openai_api_key=OPENAI_API_KEY, max_retries=0)
 
 # Define the tools available to the agent
 tools = [
@@ -406,5 +1020,11 @@ tools = [
     attraction_info_tool
 ]
 
+def create_checkpointer(path: str = CHECKPOINT_DB) -> SqliteSaver:
+    """Create a durable SQLite checkpointer for conversation threads."""
+    # The saver serializes access itself, so the connection may be shared by threads
+    conn = sqlite3.connect(path, check_same_thread=False)
+    return SqliteSaver(conn)
+
 # Create the agent instance with the ReAct architecture
-budapest_agent = Agent(model, tools, system=prompt)
+budapest_agent = Agent(model, tools, system=prompt, checkpointer=create_checkpointer(), topology=AGENT_TOPOLOGY)
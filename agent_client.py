@@ -0,0 +1,66 @@
+# agent_client.py
+# Thin HTTP client for the Budapest Explorer agent service (service.py)
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+
+import requests
+
+
+class AgentServiceClient:
+    """Calls the agent service instead of running the agent in-process."""
+
+    def __init__(self, base_url: str, timeout: float = 180):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _get(self, path: str) -> dict:
+        response = requests.get(f"{self.base_url}{path}", timeout=self.timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"Agent service error ({response.status_code}): {response.text}")
+        return response.json()
+
+    def _post(self, path: str, payload: dict = None) -> dict:
+        response = requests.post(f"{self.base_url}{path}", json=payload or {}, timeout=self.timeout)
+        if response.status_code != 200:
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            raise RuntimeError(f"Agent service error ({response.status_code}): {detail}")
+        return response.json()
+
+    def create_session(self) -> str:
+        """Start a new conversation on the service."""
+        return self._post("/sessions")["session_id"]
+
+    def breakers(self) -> dict:
+        """Circuit breaker state of the external services on the service worker."""
+        return self._get("/breakers")
+
+    def answer_cache(self) -> dict:
+        """Answer cache statistics of the service worker (None if it is disabled)."""
+        return self._get("/metrics").get("answer_cache")
+
+    def chat(self, session_id: str, message: str, transport_mode: str = "transit", bypass_cache: bool = False) -> dict:
+        """Send one chat message and return the final turn summary.
+
+        The result has the keys 'session_id', 'reasoning', 'response' and 'steps'.
+        """
+        return self._post("/chat", {
+            "session_id": session_id,
+            "message": message,
+            "transport_mode": transport_mode,
+            "bypass_cache": bypass_cache
+        })
+
+    def itinerary(self, preferences: dict, report: dict = None) -> str:
+        """Create an itinerary on the service and return its text.
+
+        If a dict is passed as report, the stage cache report is stored under
+        "stages" and the map data under "map".
+        """
+        data = self._post("/itinerary", preferences)
+        if report is not None:
+            report["stages"] = data.get("stages", {})
+            report["map"] = data.get("map")
+        return data["itinerary"]
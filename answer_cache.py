@@ -0,0 +1,233 @@
+# answer_cache.py
+# Near-duplicate final-answer cache for factual attraction questions
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# "Mi az a Lánchíd?", "Mit tudsz a Lánchídról?", "mi az a lanchid" all run
+# the whole reason -> llm -> extract -> search -> llm loop for the same
+# answer. Questions asking for information about a named sight (nothing
+# personal: no route, no "near me", no "today"; and nothing that refers
+# back to the conversation, like "its history") are normalized - accents,
+# question words and filler removed - and turned into a MinHash signature
+# of their character trigrams. A locality-sensitive hash over the
+# signature bands finds earlier questions with a similar wording without
+# comparing against every entry; a candidate is only a hit if its
+# estimated similarity is high enough, it names the same landmarks and
+# it was asked in the same language. Answers expire after a freshness
+# window. Everything is local: no embeddings, no network.
+
+import os
+import re
+import time
+import zlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import metrics
+from prefetch import gazetteer
+from travel_matrix import normalize_place_name
+from text_utils import detect_language
+
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.6"))
+
+# Questions asking for facts about a sight (on the normalized text: no accents)
+INFO_PATTERN = re.compile(
+    r"\b(mi az|mik az|mit (tudsz|tudunk|erdemes tudni)|mesel\w*|mondj \w+ (rola|a|az)|ki (volt|az)|"
+    r"mikor (epult|epitettek|keszult)|mi a tortenete|tortenet\w*|"
+    r"what (is|s|are|was|were)|who (is|was)|tell me about|tell me something about|when was|history of|"
+    r"information about|info about|facts about)\b"
+)
+# Anything personal or time dependent is never answered from the cache
+PERSONAL_PATTERN = re.compile(
+    r"\b(jut\w*|utvonal\w*|hogyan megyek|mennyi ido\w*|milyen messze|kozel\w*|mellett|kornyek\w*|innen|"
+    r"nyitva|ma|mai|most|holnap|este|ajanl\w*|etterem\w*|kave\w*|hasznalj|szeretnek|nekem|vagyok|"
+    r"how (do|can|should) i|how long|how far|get to|route|directions?|near\w*|around|open|today|tonight|"
+    r"tomorrow|now|recommend\w*|restaurant\w*|cafe\w*|my|i|i m)\b"
+)
+# Questions that refer back to the conversation ("tell me about it") depend on their thread
+ANAPHORA_PATTERN = re.compile(
+    r"\b(it|its|they|them|their|this|that|these|those|there|he|she|his|her|"
+    r"ez|ezt|ennek|ezek|erre|errol|ebben|ide|itt|azt|annak|azok|arrol|abban|oda|ott|rola|roluk|"
+    r"vele|benne|ahhoz|ehhez)\b"
+)
+# Words that do not change what is asked
+FILLER_WORDS = {
+    "mi", "mik", "az", "a", "egy", "es", "is", "mit", "tudsz", "tudunk", "erdemes", "tudni",
+    "meselj", "meselnel", "mondj", "valamit", "kerlek", "legyszives", "ki", "volt", "mikor", "epult",
+    "tortenete", "tortenetet", "budapesti", "budapesten", "what", "are", "was", "were", "who", "the",
+    "an", "about", "tell", "something", "when", "history", "of", "information", "info", "facts", "please",
+    "in", "do", "you", "know", "s", "me"
+}
+
+
+def normalize_query(text: str) -> str:
+    """Question text without accents, punctuation, question words and filler; landmarks by their name."""
+    words = gazetteer.canonicalize(text).split()
+    return " ".join(word for word in words if word not in FILLER_WORDS)
+
+
+def is_cacheable(text: str) -> bool:
+    """Only impersonal, self-contained questions about a known sight may be answered from the cache."""
+    normalized = normalize_place_name(text)
+    if not INFO_PATTERN.search(normalized) or PERSONAL_PATTERN.search(normalized) \
+            or ANAPHORA_PATTERN.search(normalized):
+        return False
+    # Without a named landmark the question cannot be told apart from a follow-up
+    return bool(gazetteer.mentions(text)) and bool(normalize_query(text))
+
+
+def shingles(normalized: str) -> set:
+    """Character trigrams of every word (suffixed Hungarian forms still share most of them)."""
+    grams = set()
+    for word in normalized.split():
+        padded = f" {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class MinHasher:
+    """MinHash signatures: min over the shingles of num_perm random hash functions."""
+
+    # Mersenne prime 2^31 - 1: with a, b and x all below it, a * x + b < 2^62
+    # cannot overflow uint64 before the mod p
+    PRIME = np.uint64(2 ** 31 - 1)
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(1, 2 ** 31 - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 2 ** 31 - 1, size=num_perm, dtype=np.uint64)
+
+    def signature(self, grams: set) -> np.ndarray:
+        if not grams:
+            return np.full(self.num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+        x = np.array([zlib.crc32(gram.encode("utf-8")) for gram in grams], dtype=np.uint64) % self.PRIME
+        return ((self.a[:, None] * x[None, :] + self.b[:, None]) % self.PRIME).min(axis=1)
+
+
+class AnswerCache:
+    """Final answers of factual questions, found again for near-duplicate questions."""
+
+    def __init__(self, ttl: float = ANSWER_CACHE_TTL, threshold: float = ANSWER_CACHE_SIMILARITY,
+                 max_entries: int = 2000, num_perm: int = 64, bands: int = 16):
+        """
+        Args:
+            ttl: freshness window of an answer (seconds)
+            threshold: estimated Jaccard similarity of the questions needed for a hit
+            bands: LSH bands of the signature (num_perm / bands rows each); with
+                   64 / 16 questions from about 0.5 similarity become candidates
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _band_keys(self, signature: np.ndarray) -> list:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _describe(self, text: str) -> tuple:
+        """(signature, landmarks, language) of a question."""
+        signature = self.hasher.signature(shingles(normalize_query(text)))
+        return signature, frozenset(gazetteer.mentions(text)), detect_language(text)
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for key in self._band_keys(entry["signature"]):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def lookup(self, text: str):
+        """Cached answer of a near-duplicate question as {"answer", "query", "similarity", "age"}, or None."""
+        if not is_cacheable(text):
+            metrics.inc("answer_cache.uncacheable")
+            return None
+        metrics.inc("answer_cache.lookups")
+        signature, landmarks, language = self._describe(text)
+        now = time.time()
+        best = None
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates |= self._buckets.get(key, set())
+            for entry_id in candidates:
+                entry = self._entries.get(entry_id)
+                if entry is None:
+                    continue
+                if now - entry["created"] > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                if entry["landmarks"] != landmarks or entry["language"] != language:
+                    continue
+                similarity = float(np.mean(entry["signature"] == signature))
+                if similarity >= self.threshold and (best is None or similarity > best[0]):
+                    best = (similarity, entry_id, entry)
+            if best is not None:
+                self._entries.move_to_end(best[1])
+                best[2]["hits"] += 1
+
+        if best is None:
+            metrics.inc("answer_cache.misses")
+            return None
+        metrics.inc("answer_cache.hits")
+        similarity, _, entry = best
+        return {"answer": entry["answer"], "query": entry["query"], "similarity": similarity,
+                "age": now - entry["created"]}
+
+    def store(self, text: str, answer: str) -> bool:
+        """Remember the answer of a cacheable question; returns whether it was stored."""
+        if not answer or not is_cacheable(text):
+            return False
+        signature, landmarks, language = self._describe(text)
+        with self._lock:
+            # A fresh answer replaces the one of the same question
+            normalized = normalize_query(text)
+            for entry_id, entry in list(self._entries.items()):
+                if entry["normalized"] == normalized and entry["language"] == language:
+                    self._remove(entry_id)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {
+                "query": text, "normalized": normalized, "signature": signature, "landmarks": landmarks,
+                "language": language, "answer": answer, "created": time.time(), "hits": 0
+            }
+            for key in self._band_keys(signature):
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+        metrics.inc("answer_cache.stores")
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self) -> dict:
+        """Hit rate over the cacheable questions, and the number of answers kept."""
+        lookups = metrics.counter("answer_cache.lookups")
+        hits = metrics.counter("answer_cache.hits")
+        return {
+            "entries": len(self._entries),
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "uncacheable": metrics.counter("answer_cache.uncacheable"),
+            "bypassed": metrics.counter("answer_cache.bypassed"),
+            "stores": metrics.counter("answer_cache.stores")
+        }
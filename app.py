@@ -14,11 +14,41 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+import os
 import json
-import re
-from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, SystemMessage
-from agent import budapest_agent
-from itinerary_agent import create_itinerary  # Import the itinerary function
+import time
+import uuid
+import tracemalloc
+from langchain_core.messages import HumanMessage
+from turn_summary import summarize_turn, extract_map_data
+from route_geometry import route_deck
+from profiling import profile_call, format_categories
+from session_memory import SessionMemory, SpillStore, enforce_limits, memory_report, MB
+
+# Start of this script run (Streamlit reruns the whole script on every interaction)
+SCRIPT_START = time.perf_counter()
+
+# When AGENT_SERVICE_URL is set, the UI is a thin client of service.py
+# and the agent itself runs in the service workers
+AGENT_SERVICE_URL = os.getenv("AGENT_SERVICE_URL")
+
+if AGENT_SERVICE_URL:
+    from agent_client import AgentServiceClient
+    service_client = AgentServiceClient(AGENT_SERVICE_URL)
+else:
+    from agent import budapest_agent
+    from itinerary_agent import create_itinerary  # Import the itinerary function
+    from circuit_breaker import breaker_states
+
+# Conversation thread ID - the agent history itself lives in the checkpointer
+if "thread_id" not in st.session_state:
+    st.session_state.thread_id = uuid.uuid4().hex
+
+# Heavy session data lives in memory-accounted stores whose old entries
+# are moved to disk when the session or the whole process uses too much
+if "memory" not in st.session_state:
+    st.session_state.memory = SessionMemory(st.session_state.thread_id[:8])
+memory = st.session_state.memory
 
 # Initialize session state for chat history
 if "user_messages" not in st.session_state:
@@ -28,23 +58,30 @@ if "ai_messages" not in st.session_state:
     st.session_state.ai_messages = []  # Only AI final responses
     
 if "debug_info" not in st.session_state:
-    st.session_state.debug_info = []
+    st.session_state.debug_info = memory.spill_list("debug_info")
 
-# Initialize separate state for raw message history (for agent)
-if "raw_messages" not in st.session_state:
-    st.session_state.raw_messages = []
+# Route maps of the AI responses (message index -> map data)
+if "ai_maps" not in st.session_state:
+    st.session_state.ai_maps = memory.spill_dict("ai_maps")
 
 # Initialize session state for active tab
 if "active_tab" not in st.session_state:
     st.session_state.active_tab = "chat"
 
-# Initialize session state for itinerary
+# Initialize session state for itinerary ("text", "stages" and "map" of the last one)
 if "itinerary" not in st.session_state:
-    st.session_state.itinerary = None
+    st.session_state.itinerary = memory.spill_dict("itinerary", keep_recent=0)
+
+# Profiles of the requests run with the profiler (Developer Mode); only the newest is kept under pressure
+if "profiles" not in st.session_state:
+    st.session_state.profiles = memory.spill_list("profiles", policy="drop", keep_recent=1)
+# The profiler toggle is one-shot: it is switched off after the profiled request
+if st.session_state.pop("profile_reset", False):
+    st.session_state.profile_next = False
 
 # Initialize session state for reasoning storage
 if "reasoning_history" not in st.session_state:
-    st.session_state.reasoning_history = []
+    st.session_state.reasoning_history = memory.spill_list("reasoning_history")
 
 # Function to change tabs
 def set_tab(tab_name):
@@ -100,24 +137,132 @@ with st.sidebar:
         # Debug mode toggle
         debug_mode = st.toggle("Developer Mode", value=False)
         
+        # Profile the next chat turn or itinerary (Developer Mode only)
+        st.toggle("🔬 Következő kérés profilozása / Profile next request", key="profile_next",
+                  disabled=not debug_mode)
+        
+        # Always run the agent, even for questions answered before (Developer Mode only)
+        bypass_cache = st.toggle("♻️ Válasz gyorsítótár kihagyása / Bypass answer cache", value=False,
+                                 disabled=not debug_mode) and debug_mode
+        
     st.caption("© 2025 Budapest Explorer - Pannon Egyetem")
 
-# Function to extract reasoning from SystemMessage
-def extract_reasoning(messages):
-    for msg in messages:
-        if isinstance(msg, SystemMessage) and "### Reasoning Plan:" in msg.content:
-            # Extract the reasoning part
-            match = re.search(r"### Reasoning Plan:(.*?)###", msg.content, re.DOTALL)
-            if match:
-                return match.group(1).strip()
-    return None
+# Run one chat turn either in-process or on the agent service
+def run_agent_turn(agent_input, transport_mode_value):
+    if AGENT_SERVICE_URL:
+        # The service uses the session ID as the conversation thread ID
+        return service_client.chat(
+            st.session_state.thread_id,
+            agent_input.content,
+            transport_mode_value,
+            bypass_cache
+        )
+
+    # Add transportation mode context if needed
+    if transport_mode_value != "transit":
+        modified_content = f"{agent_input.content} (használj {transport_mode_value} közlekedési módot)"
+        agent_input = HumanMessage(content=modified_content)
 
-# Extract the final AI message from result messages
-def extract_final_response(messages):
-    for msg in reversed(messages):
-        if isinstance(msg, AIMessage):
-            return msg
-    return None
+    # Run the agent - only the new message is sent, the history is resumed from the checkpoint
+    turn_messages = budapest_agent.run_turn(st.session_state.thread_id, agent_input, recursion_limit=10,
+                                            use_cache=not bypass_cache)
+    return summarize_turn(turn_messages, budapest_agent.current_plan(st.session_state.thread_id))
+
+# Create an itinerary either in-process or on the agent service
+def run_create_itinerary(preferences, report=None):
+    if AGENT_SERVICE_URL:
+        return service_client.itinerary(preferences, report)
+    return create_itinerary(preferences, report)
+
+# Circuit breaker state of the external services, in-process or from the service
+def get_breaker_states():
+    if AGENT_SERVICE_URL:
+        return service_client.breakers()
+    return breaker_states()
+
+# Answer cache statistics, in-process or from the service
+def get_answer_cache_stats():
+    if AGENT_SERVICE_URL:
+        return service_client.answer_cache()
+    return budapest_agent.answer_cache.stats() if budapest_agent.answer_cache is not None else None
+
+# Run a request, under the profiler if it was asked for in Developer Mode
+def run_profiled(label, fn, *args):
+    if not (debug_mode and st.session_state.get("profile_next")):
+        return fn(*args)
+    # Time the Streamlit rerun spent before the request started
+    before_call = time.perf_counter() - SCRIPT_START
+    result, report = profile_call(fn, *args)
+    report.pop("stats", None)
+    st.session_state.profiles.append({"label": label, "report": report, "before_call": before_call})
+    st.session_state.profile_reset = True
+    return result
+
+# Show the stored profiles: time by category, top functions and the call tree
+def show_profiles():
+    if not st.session_state.profiles:
+        return
+    with st.expander("🔬 Profilok / Profiles"):
+        labels = [f"{i + 1}. {p['label']}" for i, p in enumerate(st.session_state.profiles)]
+        choice = st.selectbox("Profil / Profile:", labels, index=len(labels) - 1)
+        profile = st.session_state.profiles[labels.index(choice)]
+        report = profile["report"]
+        st.caption(f"{report['engine']} · kérés {report['duration']:.2f} s · "
+                   f"Streamlit újrafuttatás a kérés előtt {profile['before_call']:.2f} s")
+        if AGENT_SERVICE_URL:
+            st.caption("Vékony kliens mód: a szolgáltatás oldali munka hálózati várakozásként látszik.")
+        st.bar_chart({"másodperc": report["categories"]})
+        st.dataframe([
+            {"függvény": f["function"], "fájl": os.path.basename(f["file"]), "sor": f["line"],
+             "saját (s)": round(f["self"], 4), "összes (s)": round(f["total"], 4)}
+            for f in report["top"]
+        ])
+        if report.get("html"):
+            # pyinstrument's interactive call tree
+            import streamlit.components.v1 as components
+            components.html(report["html"], height=500, scrolling=True)
+        else:
+            st.code(format_categories(report) + "\n\n" + report["text"])
+
+# Memory used by the sessions of this process and the top allocation sites
+def show_memory():
+    with st.expander("🧠 Memória / Session memory"):
+        report = memory_report()
+        own = memory.memory_bytes()
+        st.caption(f"Ez a munkamenet {own / MB:.1f} MB (korlát {report['session_cap_bytes'] / MB:.0f} MB) · "
+                   f"összes munkamenet {report['total_bytes'] / MB:.1f} MB (korlát {report['total_cap_bytes'] / MB:.0f} MB)")
+        st.dataframe([
+            {"munkamenet": r["session"] + (" (ez)" if r["session"] == memory.label else ""),
+             "memória (MB)": round(r["memory_bytes"] / MB, 2),
+             "lemezen (MB)": round(sum(s["spilled_bytes"] for s in r["stores"].values()) / MB, 2),
+             "tétel": sum(s["entries"] for s in r["stores"].values()),
+             "utoljára aktív (s)": round(time.time() - r["last_active"])}
+            for r in report["sessions"]
+        ])
+        st.dataframe([
+            {"tároló": name, "tétel": s["entries"], "memória (KB)": round(s["memory_bytes"] / 1024, 1),
+             "lemezen (KB)": round(s["spilled_bytes"] / 1024, 1), "kiürítés": s["policy"]}
+            for name, s in memory.report()["stores"].items()
+        ])
+        if report["tracemalloc"] is None:
+            if st.button("tracemalloc indítása / Start tracing"):
+                tracemalloc.start(10)
+                st.rerun()
+        else:
+            traced = report["tracemalloc"]
+            st.caption(f"tracemalloc: jelenleg {traced['current_bytes'] / MB:.1f} MB, csúcs {traced['peak_bytes'] / MB:.1f} MB")
+            st.dataframe([
+                {"hely": t["site"], "KB": round(t["bytes"] / 1024, 1), "blokk": t["blocks"]}
+                for t in traced["top"]
+            ])
+            if st.button("tracemalloc leállítása / Stop tracing"):
+                tracemalloc.stop()
+                st.rerun()
+
+# Draw route legs and places on a map (nothing if there is no geometry)
+def show_route_map(map_data):
+    if map_data and (map_data.get("paths") or map_data.get("points")):
+        st.pydeck_chart(route_deck(map_data["paths"], map_data["points"]))
 
 # Display different content based on active tab
 if st.session_state.active_tab == "chat":
@@ -143,6 +288,7 @@ if st.session_state.active_tab == "chat":
                 if i < len(st.session_state.ai_messages):
                     with st.chat_message("assistant"):
                         st.write(st.session_state.ai_messages[i])
+                        show_route_map(st.session_state.ai_maps.get(i))
             
             # User input
             user_prompt = st.chat_input("Mit szeretnél tudni Budapest közlekedéséről vagy látnivalóiról?")
@@ -165,6 +311,37 @@ if st.session_state.active_tab == "chat":
                             st.markdown(reasoning)
                             st.markdown("---")
             
+            # Upstream health: open breakers fail fast or serve the last good result
+            with st.expander("🔌 Külső szolgáltatások / Upstreams"):
+                try:
+                    states = get_breaker_states()
+                except Exception as e:
+                    states = {}
+                    st.caption(f"Nem elérhető / Unavailable: {e}")
+                for name, info in states.items():
+                    icon = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}.get(info["state"], "⚪")
+                    line = f"{icon} **{name}** – {info['state']}, hibaarány {info['failure_rate']:.0%} ({info['recent_calls']} hívás)"
+                    if info["state"] == "open":
+                        line += f", újrapróba {info['retry_in']:.0f} s múlva"
+                    st.markdown(line)
+                    st.caption(f"Rövidre zárt hívások: {info['short_circuited']}, régi eredmény kiszolgálva: {info['stale_served']}")
+            
+            # Repeated factual questions answered without running the agent
+            with st.expander("♻️ Válasz gyorsítótár / Answer cache"):
+                try:
+                    cache_stats = get_answer_cache_stats()
+                except Exception as e:
+                    cache_stats = None
+                    st.caption(f"Nem elérhető / Unavailable: {e}")
+                if cache_stats:
+                    st.markdown(f"Találati arány: **{cache_stats['hit_rate']:.0%}** "
+                                f"({cache_stats['hits']:.0f} / {cache_stats['lookups']:.0f} gyorsítótárazható kérdés)")
+                    st.caption(f"Tárolt válaszok: {cache_stats['entries']} · nem gyorsítótárazható: "
+                               f"{cache_stats['uncacheable']:.0f} · kihagyva: {cache_stats['bypassed']:.0f}")
+            
+            show_profiles()
+            show_memory()
+            
             if st.session_state.debug_info:
                 with st.expander("Tool Calls", expanded=True):
                     for i, interaction in enumerate(st.session_state.debug_info):
@@ -176,7 +353,9 @@ if st.session_state.active_tab == "chat":
                                 st.markdown(f"**Tool Called: `{step['tool']}`**")
                                 st.code(json.dumps(step['args'], indent=2), language='json')
                             else:
-                                st.markdown(f"**Tool Result:**")
+                                # Results that did not need a new tool run
+                                badge = {"memo": " ♻️ memo", "prefetch": " ⚡ prefetch"}.get(step.get("source"), "")
+                                st.markdown(f"**Tool Result:**{badge}")
                                 st.text(step['result'][:500] + ('...' if len(step['result']) > 500 else ''))
                             st.markdown("---")
     else:
@@ -192,6 +371,7 @@ if st.session_state.active_tab == "chat":
             if i < len(st.session_state.ai_messages):
                 with st.chat_message("assistant"):
                     st.write(st.session_state.ai_messages[i])
+                    show_route_map(st.session_state.ai_maps.get(i))
         
         # User input
         user_prompt = st.chat_input("Mit szeretnél tudni Budapest közlekedéséről vagy látnivalóiról?")
@@ -201,10 +381,6 @@ if st.session_state.active_tab == "chat":
         # Add user message to displayed messages
         st.session_state.user_messages.append(user_prompt)
         
-        # Add user message to raw messages for agent context
-        user_message = HumanMessage(content=user_prompt)
-        st.session_state.raw_messages.append(user_message)
-        
         # Rerun to display the new user message
         st.rerun()
     
@@ -214,16 +390,7 @@ if st.session_state.active_tab == "chat":
         with st.chat_message("assistant"):
             with st.spinner("Gondolkodom..."):
                 # Get latest user message
-                agent_input = st.session_state.raw_messages[-1]
-                
-                # Get previous context 
-                previous_messages = st.session_state.raw_messages[:-1]
-                
-                # Add transportation mode context if needed
-                if transport_mode != "Tömegközlekedés":
-                    mode = transport_mode_map[transport_mode]
-                    modified_content = f"{agent_input.content} (használj {mode} közlekedési módot)"
-                    agent_input = HumanMessage(content=modified_content)
+                agent_input = HumanMessage(content=st.session_state.user_messages[-1])
                 
                 try:
                     # Track tool usage for debugging
@@ -234,67 +401,56 @@ if st.session_state.active_tab == "chat":
                     tool_summary = []
                     
                     # Run the agent
-                    result = budapest_agent.graph.invoke(
-                        {"messages": previous_messages + [agent_input]},
-                        {"recursion_limit": 10}
-                    )
-                    
-                    # Get all result messages
-                    all_result_messages = result["messages"]
+                    turn = run_profiled(f"Chat: {agent_input.content[:40]}", run_agent_turn,
+                                        agent_input, transport_mode_map[transport_mode])
                     
-                    # Extract reasoning and store it 
-                    reasoning = extract_reasoning(all_result_messages)
+                    # Store the reasoning 
+                    reasoning = turn["reasoning"]
                     if reasoning:
                         st.session_state.reasoning_history.append(reasoning)
                     
-                    # Get the final response (last AIMessage)
-                    final_response = extract_final_response(all_result_messages)
+                    # Get the final response
+                    response_content = turn["response"]
                     
                     # Track tool calls for debugging and summary
-                    for message in all_result_messages:
-                        if hasattr(message, 'tool_calls') and message.tool_calls:
-                            for tool_call in message.tool_calls:
-                                # Add to debug info
-                                current_debug_info["steps"].append({
-                                    "tool": tool_call["name"],
-                                    "args": tool_call["args"],
-                                    "step": "tool_call"
-                                })
-                                
-                                # Add to summary for chat display
-                                tool_name = tool_call["name"]
-                                args = tool_call["args"]
-                                
-                                # Format differently based on tool
-                                if tool_name == "attraction_info_tool":
-                                    if isinstance(args, dict) and 'attractions' in args:
-                                        attractions = args['attractions']
-                                        tool_summary.append(f"🔍 **Web keresés**: {attractions}")
-                                    else:
-                                        tool_summary.append(f"🔍 **Web keresés**: {args}")
-                                else:
-                                    arg_str = str(args)
-                                    if len(arg_str) > 50:
-                                        arg_str = arg_str[:50] + "..."
-                                    tool_summary.append(f"🛠️ **{tool_name}**({arg_str})")
-                                
-                        elif isinstance(message, ToolMessage):
-                            current_debug_info["steps"].append({
-                                "tool": message.name,
-                                "result": message.content,
-                                "step": "tool_result"
-                            })
+                    for step in turn["steps"]:
+                        # Add to debug info
+                        current_debug_info["steps"].append(step)
+                        if step["step"] != "tool_call":
+                            continue
+                        
+                        # Add to summary for chat display
+                        tool_name = step["tool"]
+                        args = step["args"]
+                        
+                        # Format differently based on tool
+                        if tool_name == "attraction_info_tool":
+                            if isinstance(args, dict) and 'attractions' in args:
+                                attractions = args['attractions']
+                                tool_summary.append(f"🔍 **Web keresés**: {attractions}")
+                            else:
+                                tool_summary.append(f"🔍 **Web keresés**: {args}")
+                        else:
+                            arg_str = str(args)
+                            if len(arg_str) > 50:
+                                arg_str = arg_str[:50] + "..."
+                            tool_summary.append(f"🛠️ **{tool_name}**({arg_str})")
+                    
+                    # Answers cut short by the time or step budget are marked in Developer Mode
+                    if turn.get("forced_final"):
+                        tool_summary.append(f"⏱️ **Korai válasz** ({turn['forced_final']})")
+                    # ...as are answers reused from an earlier, similar question
+                    if turn.get("cached_query"):
+                        tool_summary.append(f"♻️ **Gyorsítótárból** (korábbi kérdés: {turn['cached_query']})")
                     
                     # Add debug info to session state
                     st.session_state.debug_info.append(current_debug_info)
                     
-                    # Save all result messages to raw message history (for agent context)
-                    st.session_state.raw_messages.extend(all_result_messages)
+                    # Routes and places found in this turn go on a map under the answer
+                    st.session_state.ai_maps[len(st.session_state.ai_messages)] = extract_map_data(turn["steps"])
                     
                     # Display and store the response
-                    if final_response:
-                        response_content = final_response.content
-                        
+                    if response_content:
                         # If tool summary exists, add it to the response in developer mode
                         if tool_summary and debug_mode:
                             tool_section = "\n\n---\n### Használt eszközök:\n" + "\n".join(tool_summary)
@@ -417,17 +573,34 @@ else:
                     
                     # Call the itinerary function
                     try:
-                        itinerary = create_itinerary(preferences)
-                        st.session_state.itinerary = itinerary
+                        report = {}
+                        itinerary = run_profiled(f"Útiterv: {start_location}", run_create_itinerary,
+                                                 preferences, report)
+                        st.session_state.itinerary.clear()
+                        st.session_state.itinerary["text"] = itinerary
+                        st.session_state.itinerary["stages"] = report.get("stages", {})
+                        st.session_state.itinerary["map"] = report.get("map")
                     except Exception as e:
                         st.error(f"Hiba történt: {str(e)}")
-                        st.session_state.itinerary = "Sajnos hiba történt az útiterv készítése során."
+                        st.session_state.itinerary.clear()
+                        st.session_state.itinerary["text"] = "Sajnos hiba történt az útiterv készítése során."
     
     with col2:
         # Display the itinerary if available
-        if st.session_state.itinerary:
+        if st.session_state.itinerary.get("text"):
+            itinerary_stages = st.session_state.itinerary.get("stages")
             st.subheader("Az útiterved / Your Itinerary")
-            st.markdown(st.session_state.itinerary)
+            show_route_map(st.session_state.itinerary.get("map"))
+            st.markdown(st.session_state.itinerary["text"])
+            
+            # Which stages were reused from the cache
+            if debug_mode and itinerary_stages:
+                with st.expander("Gyorsítótár / Stage cache"):
+                    for stage, status in itinerary_stages.items():
+                        icon = {"hit": "✅", "miss": "🔄"}.get(status, "⏭️")
+                        st.markdown(f"{icon} **{stage}**: {status}")
+            if debug_mode:
+                show_profiles()
         else:
             # Show instructions or sample itinerary
             st.info("Töltsd ki az űrlapot az útiterv elkészítéséhez! / Fill out the form to create your itinerary!")
@@ -474,6 +647,11 @@ else:
                 Ez csak egy minta útiterv. A te személyre szabott útiterved az érdeklődési köreid és a rendelkezésre álló időd alapján készül el.
                 """)
 
+# Account the rest of the session state and keep the sessions within their memory caps
+memory.account_state({key: value for key, value in st.session_state.items()
+                      if key != "memory" and not isinstance(value, SpillStore)})
+enforce_limits(memory)
+
 # Simple footer
 st.markdown("---")
 st.caption("Fejlesztette: Szalay Miklós Márton | Pannon Egyetem")
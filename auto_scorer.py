@@ -0,0 +1,278 @@
+# auto_scorer.py
+# Automatic scoring of evaluation results (rubric checks + optional LLM judge)
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# Fills the Accuracy / Completeness / Usability columns (1-5) of an
+# evaluator result file. Every row gets rubric scores computed from the
+# row itself: were the expected tools called (in order), does a route
+# answer look like a route (durations, lines, steps), is the answer in the
+# language of the question. With the LLM judge enabled the unscored rows
+# are also graded by a model in batches, several batches at a time; the
+# judgments are cached by the hash of (query, response), so re-scoring a
+# file or scoring the same answers again costs nothing.
+
+import os
+import re
+import csv
+import json
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from pydantic import BaseModel, Field
+
+from text_utils import detect_language
+
+SCORE_COLUMNS = ("Accuracy", "Completeness", "Usability")
+
+# Judge prompt version: changing the prompt invalidates the cached judgments
+JUDGE_VERSION = "1"
+
+# Signs of a usable route answer
+DURATION_PATTERN = re.compile(r"\d+\s*(perc|óra|min|hour)", re.IGNORECASE)
+TRANSPORT_PATTERN = re.compile(
+    r"\b(M[1-4]|HÉV|busz\w*|villamos\w*|metró\w*|troli\w*|gyalog\w*|sétál\w*|kerékpár\w*|bus|tram|metro|walk\w*)",
+    re.IGNORECASE
+)
+STEP_PATTERN = re.compile(r"^\s*(\d+[.)]|[-*•])\s+", re.MULTILINE)
+
+
+def split_list(value) -> list:
+    """A ;-separated list column (or an already parsed list)."""
+    if isinstance(value, list):
+        return value
+    return [item for item in (value or "").split(";") if item]
+
+
+def expected_tool_coverage(expected: list, called: list) -> float:
+    """Share of the expected tool calls found in the called ones, in order (1.0 if none expected)."""
+    if not expected:
+        return 1.0
+    position = 0
+    matched = 0
+    for tool in expected:
+        try:
+            position = called.index(tool, position) + 1
+            matched += 1
+        except ValueError:
+            continue
+    return matched / len(expected)
+
+
+def route_structure_score(response: str) -> float:
+    """Share of the route features present: durations, transport lines/modes, separate steps."""
+    checks = [
+        bool(DURATION_PATTERN.search(response)),
+        bool(TRANSPORT_PATTERN.search(response)),
+        len(STEP_PATTERN.findall(response)) >= 2 or len(re.findall(r"\b(majd|then)\b", response, re.IGNORECASE)) >= 2
+    ]
+    return sum(checks) / len(checks)
+
+
+def _scale(value: float) -> int:
+    """0..1 to a 1..5 score."""
+    return 1 + int(round(4 * max(0.0, min(1.0, value))))
+
+
+def rubric_scores(row: dict) -> dict:
+    """Rubric scores of one result row, with a short Hungarian note."""
+    response = row.get("Response") or ""
+    # The CSV keeps only the start of the response; its full length is in ResponseLength
+    length = int(row.get("ResponseLength") or len(response))
+    expected = split_list(row.get("ExpectedTools"))
+    called = split_list(row.get("ToolSequence"))
+    tags = split_list(row.get("Tags"))
+    is_route = "route" in tags or "directions_tool" in expected
+
+    coverage = expected_tool_coverage(expected, called)
+    route = route_structure_score(response) if is_route else None
+    query_language = detect_language(row.get("Query") or "")
+    language_match = query_language == "unknown" or detect_language(response) == query_language
+    # Answers cut short by the turn budget are partial by definition
+    partial = row.get("ErrorType") in ("DeadlineHit", "StepLimitHit")
+
+    accuracy = [coverage] + ([route] if route is not None else [])
+    completeness = [coverage, min(1.0, length / 400), 0.5 if partial else 1.0]
+    usability = [1.0 if language_match else 0.0,
+                 1.0 if "\n" in response.strip() else 0.5,
+                 1.0 if length < 4000 else 0.5]
+
+    notes = [f"eszközök {coverage:.0%}"]
+    if route is not None:
+        notes.append(f"útvonal {route:.0%}")
+    notes.append("nyelv ok" if language_match else "más nyelvű válasz")
+    return {
+        "Accuracy": _scale(sum(accuracy) / len(accuracy)),
+        "Completeness": _scale(sum(completeness) / len(completeness)),
+        "Usability": _scale(sum(usability) / len(usability)),
+        "note": ", ".join(notes)
+    }
+
+
+def judgment_key(query: str, response: str, model: str) -> str:
+    """Cache key of a judgment: hash of the query, the response, the judge model and prompt version."""
+    payload = "\x00".join((JUDGE_VERSION, model, query or "", response or ""))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class JudgmentCache:
+    """SQLite cache of LLM judgments (safe to share between threads and processes)."""
+
+    def __init__(self, path: str = "judgments.db"):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS judgments (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+
+    def _connect(self):
+        # A new connection per call keeps the cache safe to use from any thread
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM judgments WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, judgment: dict):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO judgments (key, data) VALUES (?, ?)",
+                         (key, json.dumps(judgment, ensure_ascii=False)))
+
+
+class Judgment(BaseModel):
+    index: int = Field(description="Index of the graded item")
+    accuracy: int = Field(ge=1, le=5, description="Factual and route correctness for Budapest")
+    completeness: int = Field(ge=1, le=5, description="How fully the request is answered")
+    usability: int = Field(ge=1, le=5, description="Clarity, structure, language matching the question")
+    comment: str = Field(default="", description="One short sentence")
+
+
+class JudgmentBatch(BaseModel):
+    judgments: List[Judgment]
+
+
+JUDGE_PROMPT = """You grade answers of a Budapest travel assistant (public transport routes, attractions, places).
+For every item give integer scores from 1 (bad) to 5 (excellent):
+- accuracy: are the routes, lines, durations and facts plausible and correct for Budapest?
+- completeness: does the answer cover every part of the request?
+- usability: is it clear, well structured and in the language of the question?
+Grade every item independently and return one judgment per item index.
+
+Items:
+{items}"""
+
+
+class LLMJudge:
+    """Grades result rows with a model, several rows per call, with a judgment cache."""
+
+    def __init__(self, model: str = "gpt-4o-mini", batch_size: int = 8, workers: int = 4,
+                 cache: JudgmentCache = None):
+        self.model_name = model
+        self.batch_size = batch_size
+        self.workers = workers
+        self.cache = cache or JudgmentCache()
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _judge_model(self):
+        with self._lock:
+            if self._model is None:
+                from langchain_openai import ChatOpenAI
+                model = ChatOpenAI(model=self.model_name, openai_api_key=os.getenv("OPENAI_API_KEY"), temperature=0,
+                                   max_retries=0)
+                self._model = model.with_structured_output(JudgmentBatch)
+        return self._model
+
+    def _judge_batch(self, rows: list) -> dict:
+        from langchain_core.messages import HumanMessage
+        from scheduler import request_priority, scheduled_invoke
+
+        items = "\n\n".join(
+            f"[{i}] Question: {row.get('Query')}\nAnswer: {(row.get('Response') or '')[:2000]}"
+            for i, row in enumerate(rows)
+        )
+        messages = [HumanMessage(content=JUDGE_PROMPT.format(items=items))]
+        # Offline work: lowest priority, like the evaluator runs themselves
+        with request_priority("evaluator"):
+            batch = scheduled_invoke(self._judge_model(), messages, expected_output_tokens=80 * len(rows))
+
+        judged = {}
+        for judgment in batch.judgments:
+            if 0 <= judgment.index < len(rows):
+                judged[judgment.index] = judgment.model_dump(exclude={"index"})
+        for i, judgment in judged.items():
+            row = rows[i]
+            self.cache.put(judgment_key(row.get("Query"), row.get("Response"), self.model_name), judgment)
+        return judged
+
+    def judge(self, rows: list) -> list:
+        """Judgment dict (or None if it failed) for every row, cached ones without a call."""
+        results = [self.cache.get(judgment_key(row.get("Query"), row.get("Response"), self.model_name))
+                   for row in rows]
+        missing = [i for i, result in enumerate(results) if result is None]
+        batches = [missing[start:start + self.batch_size] for start in range(0, len(missing), self.batch_size)]
+
+        def run(batch):
+            try:
+                return batch, self._judge_batch([rows[i] for i in batch])
+            except Exception as e:
+                print(f"  Bírálat hiba ({len(batch)} sor): {type(e).__name__}: {e}")
+                return batch, {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for batch, judged in pool.map(run, batches):
+                for position, i in enumerate(batch):
+                    results[i] = judged.get(position)
+        return results
+
+
+def score_rows(rows: list, judge: LLMJudge = None, rescore: bool = False) -> int:
+    """Fill the score columns of the rows in place; returns the number of rows scored.
+
+    Failed runs get N/A like in the manual evaluation. With a judge the
+    final score is the rounded mean of the rubric and the judge scores.
+    """
+    todo = [row for row in rows if rescore or not row.get("Accuracy")]
+    for row in todo:
+        if row.get("Success") in (False, "False"):
+            for column in SCORE_COLUMNS:
+                row[column] = "N/A"
+    todo = [row for row in todo if row.get("Success") not in (False, "False")]
+
+    judgments = judge.judge(todo) if judge is not None and todo else [None] * len(todo)
+    for row, judgment in zip(todo, judgments):
+        scores = rubric_scores(row)
+        note = f"auto: {scores['note']}"
+        for column in SCORE_COLUMNS:
+            value = scores[column]
+            if judgment is not None:
+                value = int((value + judgment[column.lower()]) / 2 + 0.5)
+            row[column] = value
+        if judgment is not None and judgment.get("comment"):
+            note += f"; bíráló: {judgment['comment']}"
+        # Notes of earlier runs (e.g. partial answer) are kept
+        previous = re.sub(r"\s*\|?\s*auto: .*$", "", row.get("Notes") or "")
+        row["Notes"] = f"{previous} | {note}" if previous else note
+    return len(todo)
+
+
+def score_file(path: str, use_judge: bool = False, rescore: bool = False, judge_model: str = "gpt-4o-mini",
+               batch_size: int = 8, workers: int = 4, cache_path: str = "judgments.db") -> list:
+    """Score an evaluator result CSV in place and return its rows."""
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+
+    judge = LLMJudge(judge_model, batch_size, workers, JudgmentCache(cache_path)) if use_judge else None
+    scored = score_rows(rows, judge, rescore)
+
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"{scored} sor pontozva: {path}")
+    return rows
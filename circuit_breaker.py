@@ -0,0 +1,189 @@
+# circuit_breaker.py
+# Circuit breakers with stale-while-error fallback for the external services
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# Every upstream (Directions, Places, search model, chat model) has its own
+# breaker. It watches the outcome of the last calls; when too many failed or
+# were too slow it opens and calls fail fast for a while instead of waiting
+# out the outage. After the pause a few probe calls are let through
+# (half-open); if they succeed the breaker closes again. While a call
+# cannot be made or fails, the last good result for the same key is served
+# if there is one ("stale while error").
+
+import time
+import threading
+from collections import deque, OrderedDict
+
+import requests
+from openai import APIError
+
+from metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a call is short-circuited and there is no stale result."""
+
+
+class CircuitBreaker:
+    """Failure/latency based breaker of one upstream plus its stale result cache."""
+
+    def __init__(self, name: str, failure_threshold: float = 0.5, min_calls: int = 5, window: int = 20,
+                 slow_call_seconds: float = 10.0, open_seconds: float = 30.0, probe_calls: int = 1,
+                 failure_exceptions: tuple = (Exception,), stale_ttl: float = 3600, stale_size: int = 256):
+        """
+        Args:
+            failure_threshold: share of failed (or slow) calls in the window that opens the breaker
+            min_calls: calls needed in the window before the breaker may open
+            window: number of recent calls considered
+            slow_call_seconds: calls slower than this count as failures
+            open_seconds: how long the breaker stays open before probing
+            probe_calls: calls let through at the same time while half-open
+            failure_exceptions: exceptions that count as upstream failures (others pass through)
+            stale_ttl: how old a stale result may be (seconds)
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.probe_calls = probe_calls
+        self.failure_exceptions = failure_exceptions
+        self.stale_ttl = stale_ttl
+        self.stale_size = stale_size
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._stale = OrderedDict()
+
+    def _admit(self) -> bool:
+        """Whether a call may go upstream now (may move open -> half-open)."""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._state = HALF_OPEN
+                self._probes = 0
+                metrics.inc(f"breaker.{self.name}.half_open")
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes < self.probe_calls:
+                self._probes += 1
+                return True
+            return False
+
+    def _record(self, failed: bool):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if failed:
+                    self._trip()
+                else:
+                    # The probe went through: start over with a clean window
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                    metrics.inc(f"breaker.{self.name}.closed")
+                return
+            self._outcomes.append(failed)
+            if (self._state == CLOSED and len(self._outcomes) >= self.min_calls
+                    and sum(self._outcomes) / len(self._outcomes) >= self.failure_threshold):
+                self._trip()
+
+    def _trip(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        metrics.inc(f"breaker.{self.name}.opened")
+
+    def _stale_result(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._stale.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.stale_ttl:
+            return None
+        metrics.inc(f"breaker.{self.name}.stale_served")
+        return entry
+
+    def call(self, key, fn, is_failure=None):
+        """Run fn() through the breaker.
+
+        key identifies the request for the stale cache (None: no stale results).
+        is_failure(result) marks error results that came back without an exception.
+        When the call is short-circuited or fails, the last good result of the
+        key is returned if there is one; otherwise CircuitOpenError is raised
+        (short circuit), the exception is re-raised, or the error result returned.
+        """
+        if not self._admit():
+            metrics.inc(f"breaker.{self.name}.short_circuited")
+            stale = self._stale_result(key)
+            if stale is not None:
+                return stale[1]
+            raise CircuitOpenError(f"{self.name} is temporarily unavailable (circuit open)")
+
+        start = time.monotonic()
+        try:
+            result = fn()
+        except self.failure_exceptions:
+            self._record(True)
+            stale = self._stale_result(key)
+            if stale is not None:
+                return stale[1]
+            raise
+        except BaseException:
+            # Not an upstream failure (e.g. a local rate limit timeout); release a probe slot
+            with self._lock:
+                if self._state == HALF_OPEN:
+                    self._probes = max(0, self._probes - 1)
+            raise
+
+        failed = bool(is_failure and is_failure(result))
+        self._record(failed or time.monotonic() - start > self.slow_call_seconds)
+        if failed:
+            stale = self._stale_result(key)
+            return stale[1] if stale is not None else result
+
+        if key is not None:
+            with self._lock:
+                self._stale[key] = (time.monotonic(), result)
+                self._stale.move_to_end(key)
+                while len(self._stale) > self.stale_size:
+                    self._stale.popitem(last=False)
+        return result
+
+    def state(self) -> dict:
+        """Current state for monitoring (Developer Mode, /breakers)."""
+        with self._lock:
+            outcomes = list(self._outcomes)
+            state = self._state
+            retry_in = max(0.0, self.open_seconds - (time.monotonic() - self._opened_at)) if state == OPEN else 0.0
+            stale_entries = len(self._stale)
+        return {
+            "state": state,
+            "failure_rate": sum(outcomes) / len(outcomes) if outcomes else 0.0,
+            "recent_calls": len(outcomes),
+            "retry_in": retry_in,
+            "stale_entries": stale_entries,
+            "short_circuited": metrics.counter(f"breaker.{self.name}.short_circuited"),
+            "stale_served": metrics.counter(f"breaker.{self.name}.stale_served")
+        }
+
+
+# One breaker per upstream
+directions_breaker = CircuitBreaker("directions", failure_exceptions=(requests.RequestException,),
+                                    slow_call_seconds=8.0)
+places_breaker = CircuitBreaker("places", failure_exceptions=(requests.RequestException,),
+                                slow_call_seconds=8.0)
+search_breaker = CircuitBreaker("search", failure_exceptions=(APIError,), slow_call_seconds=45.0,
+                                stale_ttl=24 * 3600)
+chat_breaker = CircuitBreaker("chat", failure_exceptions=(APIError,), slow_call_seconds=30.0)
+
+breakers = {b.name: b for b in (directions_breaker, places_breaker, search_breaker, chat_breaker)}
+
+
+def breaker_states() -> dict:
+    return {name: breaker.state() for name, breaker in breakers.items()}
@@ -18,6 +18,8 @@ try:
     from agent import tools, prompt, Agent
     from langchain_core.messages import HumanMessage, SystemMessage
     from langgraph.errors import GraphRecursionError
+    from scheduler import request_priority, cached_token_ratio
+    from metrics import metrics
 except ImportError as e:
     print(f"Hiba a függőségek importálásakor: {e}")
     print("Győződj meg arról, hogy telepítetted a szükséges csomagokat:")
@@ -30,16 +32,22 @@ test_cases = [
     {
         "id": "basic_route_1",
         "category": "basic",
+        "tags": ["route"],
+        "expected_tools": ["directions_tool"],
         "query": "Hogyan juthatok el a Keleti pályaudvarról a Budai Várba?"
     },
     {
         "id": "basic_attraction_1",
         "category": "basic",
+        "tags": ["attraction"],
+        "expected_tools": ["attraction_info_tool"],
         "query": "Mi az a Lánchíd?"
     },
     {
         "id": "basic_restaurant_1",
         "category": "basic",
+        "tags": ["restaurant"],
+        "expected_tools": ["attractions_tool"],
         "query": "Mutass éttermeket a Váci utca közelében."
     },
     
@@ -47,16 +55,22 @@ test_cases = [
     {
         "id": "complex_route_1",
         "category": "complex",
+        "tags": ["route", "restaurant"],
+        "expected_tools": ["directions_tool", "attractions_tool"],
         "query": "Szeretnék eljutni a Hősök teréről a Parlamenthez, majd onnan a Budai Várhoz. Útközben szeretnék ebédelni valahol."
     },
     {
         "id": "complex_thematic_1",
         "category": "complex",
+        "tags": ["itinerary"],
+        "expected_tools": ["attractions_tool"],
         "query": "Szeretnék egy történelmi látványosságokat bemutató útitervet a Deák térről indulva, ami 4 órát vesz igénybe."
     },
     {
         "id": "complex_special_1",
         "category": "complex",
+        "tags": ["itinerary"],
+        "expected_tools": [],
         "query": "Mutass egy útitervet, ami kerüli a zsúfolt helyeket, és főként szabadtéri látnivalókat tartalmaz."
     },
     
@@ -64,42 +78,112 @@ test_cases = [
     {
         "id": "edge_nonexistent_1",
         "category": "edge",
+        "tags": ["route"],
+        "expected_tools": ["directions_tool"],
         "query": "Hogyan juthatok el a Keleti pályaudvarról a Nem Létező Múzeumba?"
     },
     {
         "id": "edge_long_1",
         "category": "edge",
+        "tags": ["itinerary"],
+        "expected_tools": [],
         "query": "Szeretnék egy részletes útitervet, amely Budapesten a következő helyszíneket tartalmazza kronológiai sorrendben: Keleti pályaudvar, Nemzeti Múzeum, Váci utca, Vörösmarty tér, Duna-part, Lánchíd, Budai Vár, Halászbástya, Mátyás-templom, Gellért-hegy, Citadella, Szabadság-szobor, Margit-sziget, Parlamentet, és a végén szeretnék egy jó vacsorázó helyet találni, amely autentikus magyar ételeket kínál. Útközben szeretnék ebédelni valahol a Budai Vár környékén, lehetőleg terasszal rendelkező étteremben. A teljes útiterv 8 órában férjen bele, és részletes leírást szeretnék minden látnivalóról, külön kiemelve azok történelmi jelentőségét."
     },
     {
         "id": "edge_contradiction_1",
         "category": "edge",
+        "tags": ["itinerary"],
+        "expected_tools": [],
         "query": "Szeretnék egy 2 órás útitervet, amely tartalmazza az összes fontos budapesti látnivalót, és részletesen elmagyarázza mindegyiket."
     },
     {
         "id": "edge_gibberish_1",
         "category": "edge",
+        "tags": [],
+        "expected_tools": [],
         "query": "Qwerty xyzabc deák tér múzeum látnivaló?"
     }
 ]
 
+# Tesztkészlet betöltése fájlból (JSONL, JSON vagy YAML)
+def load_test_cases(path):
+    """Teszteseteket tölt be egy JSONL/JSON/YAML fájlból
+    
+    Minden esetnek kell egy 'query' mező; az 'id', 'category', 'tags' és
+    'expected_tools' (a várt eszközhívások sorrendben) opcionális.
+    """
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            cases = [json.loads(line) for line in f if line.strip()]
+        elif path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("YAML tesztkészlethez telepítsd a PyYAML csomagot: pip install pyyaml")
+            cases = yaml.safe_load(f)
+        else:
+            cases = json.load(f)
+    
+    # A YAML/JSON fájl lehet lista vagy {"cases": [...]}
+    if isinstance(cases, dict):
+        cases = cases.get("cases", [])
+    
+    loaded = []
+    for i, case in enumerate(cases):
+        if not case.get("query"):
+            raise ValueError(f"{path}: a(z) {i + 1}. tesztesetből hiányzik a 'query' mező")
+        loaded.append({
+            "id": str(case.get("id") or f"case_{i + 1}"),
+            "category": case.get("category", "general"),
+            "tags": list(case.get("tags", [])),
+            "expected_tools": list(case.get("expected_tools", [])),
+            "query": case["query"]
+        })
+    return loaded
+
+def filter_test_cases(cases, categories=None, tags=None, limit=None):
+    """Tesztesetek szűrése kategória és címke szerint"""
+    if categories:
+        cases = [case for case in cases if case["category"] in categories]
+    if tags:
+        cases = [case for case in cases if set(tags) & set(case.get("tags", []))]
+    return cases[:limit] if limit else cases
+
+# Ágens konfigurációk: név -> (modell, eszközökkel, gráf topológia)
+CONFIGURATIONS = {
+    "GPT-4o with tools": ("gpt-4o", True, "reason_act"),
+    "GPT-4o-mini with tools": ("gpt-4o-mini", True, "reason_act"),
+    "GPT-4o-mini with tools (plan-act)": ("gpt-4o-mini", True, "plan_act"),
+    "GPT-4o no tools": ("gpt-4o", False, "reason_act")
+}
+
 # Ágens konfigurációk létrehozása
-def create_agent_with_model(model_name="gpt-4o-mini", use_tools=True):
-    """Adott modellel és eszközkészlettel hoz létre egy ágenst"""
-    model = ChatOpenAI(model=model_name, openai_api_key=os.environ["OPENAI_API_KEY"], temperature=0.3)
+def create_agent_with_model(model_name="gpt-4o-mini", use_tools=True, topology="reason_act"):
+    """Adott modellel, eszközkészlettel és gráf topológiával hoz létre egy ágenst"""
+    model = ChatOpenAI(model=model_name, openai_api_key=os.environ["OPENAI_API_KEY"], temperature=0.3,
+                       max_retries=0)
     
     if use_tools:
-        return Agent(model, tools, system=prompt)
+        return Agent(model, tools, system=prompt, topology=topology)
     else:
         # Módosított prompt az eszközök nélküli használathoz
         no_tools_prompt = prompt.replace("using parse_input_tool", "by thinking about").replace(
             "call directions_tool", "consider").replace("use attractions_tool", "think about places")
         return Agent(model, [], system=no_tools_prompt)
 
+# Az eredmény CSV oszlopai
+COLUMNS = [
+    'TestID', 'Category', 'Tags', 'Configuration', 'Query',
+    'ResponseTime', 'FirstToolCallTime', 'ToolCalls', 'ToolSequence', 'ExpectedTools',
+    'Success', 'ErrorType',
+    'Accuracy', 'Completeness', 'Usability',
+    'Notes', 'ResponseLength', 'Response'
+]
+
 # Eredmények naplózására szolgáló osztály
 class TestLogger:
     def __init__(self, filename=None):
-        """Inicializálja a naplózót"""
+        """Inicializálja a naplózót (létező fájl esetén a korábbi eredményeket is betölti)"""
         if filename is None:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"test_results_{timestamp}.csv"
@@ -108,52 +192,54 @@ class TestLogger:
             self.new_file = not os.path.exists(filename)
         
         self.filename = filename
-        self.results = []
+        self.results = [] if self.new_file else read_results(filename)
+        # Régebbi fájlba a saját fejléce szerint írunk (pl. ResponseLength oszlop nélkül)
+        self.columns = COLUMNS if self.new_file else read_columns(filename)
         
         # CSV fejléc létrehozása ha új fájl
         if self.new_file:
             with open(self.filename, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    'TestID', 'Category', 'Configuration', 'Query', 
-                    'ResponseTime', 'ToolCalls', 'Success', 'ErrorType',
-                    'Accuracy', 'Completeness', 'Usability', 
-                    'Notes', 'Response'
-                ])
+                csv.writer(f).writerow(COLUMNS)
+    
+    def completed(self):
+        """A már lefuttatott (TestID, Configuration) párok - folytatáskor ezek kimaradnak"""
+        return {(result['TestID'], result['Configuration']) for result in self.results}
     
     def log_result(self, test_id, category, config, query, response_time, 
-                  tool_calls=0, success=True, error_type="", 
+                  tool_calls=0, success=True, error_type="", first_tool_call_time=None,
                   accuracy=None, completeness=None, usability=None, 
-                  notes="", response=""):
+                  notes="", response="", tags=None, tool_sequence=None, expected_tools=None):
         """Eredmény hozzáadása a naplóhoz"""
         result = {
             'TestID': test_id,
             'Category': category,
+            'Tags': tags or [],
             'Configuration': config,
             'Query': query,
             'ResponseTime': response_time,
+            'FirstToolCallTime': first_tool_call_time,
             'ToolCalls': tool_calls,
+            'ToolSequence': tool_sequence or [],
+            'ExpectedTools': expected_tools or [],
             'Success': success,
             'ErrorType': error_type,
             'Accuracy': accuracy,
             'Completeness': completeness,
             'Usability': usability,
             'Notes': notes,
+            'ResponseLength': len(response),
             'Response': response
         }
         
         self.results.append(result)
         
-        # Eredmény mentése CSV-be
+        # Eredmény mentése CSV-be (a listák ;-vel elválasztva, a válasz első 2000 karaktere,
+        # a teljes hossza a ResponseLength oszlopban)
+        row = dict(result, Response=result['Response'][:2000])
+        for column in ('Tags', 'ToolSequence', 'ExpectedTools'):
+            row[column] = ";".join(row[column])
         with open(self.filename, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                result['TestID'], result['Category'], result['Configuration'], 
-                result['Query'], result['ResponseTime'], result['ToolCalls'],
-                result['Success'], result['ErrorType'],
-                result['Accuracy'], result['Completeness'], result['Usability'],
-                result['Notes'], result['Response'][:2000]  # Csak az első 500 karakter
-            ])
+            csv.DictWriter(f, fieldnames=self.columns, extrasaction='ignore').writerow(row)
         
         return result
     
@@ -175,11 +261,17 @@ class TestLogger:
             
             # Konfigurációk szerinti csoportosítás
             if config not in configs:
-                configs[config] = {'count': 0, 'total_time': 0, 'success_count': 0, 'tool_calls': 0}
+                configs[config] = {'count': 0, 'total_time': 0, 'success_count': 0, 'tool_calls': 0,
+                                   'first_tool_count': 0, 'first_tool_time': 0, 'deadline_hits': 0}
             
             configs[config]['count'] += 1
             configs[config]['total_time'] += response_time
             configs[config]['tool_calls'] += result['ToolCalls']
+            if result['ErrorType'] in ('DeadlineHit', 'StepLimitHit'):
+                configs[config]['deadline_hits'] += 1
+            if result['FirstToolCallTime'] is not None:
+                configs[config]['first_tool_count'] += 1
+                configs[config]['first_tool_time'] += result['FirstToolCallTime']
             if success:
                 configs[config]['success_count'] += 1
             
@@ -199,8 +291,13 @@ class TestLogger:
         avg_response_times = {}
         success_rates = {}
         avg_tool_calls = {}
+        avg_first_tool_call_times = {}
+        deadline_hits = {config: data['deadline_hits'] for config, data in configs.items()}
         
         for config, data in configs.items():
+            # Csak azokból a tesztekből, ahol volt eszközhívás
+            if data['first_tool_count'] > 0:
+                avg_first_tool_call_times[config] = data['first_tool_time'] / data['first_tool_count']
             if data['count'] > 0:
                 avg_response_times[config] = data['total_time'] / data['count']
                 success_rates[config] = (data['success_count'] / data['count']) * 100
@@ -232,11 +329,34 @@ class TestLogger:
             'avg_response_time': avg_response_times,
             'success_rates': success_rates,
             'avg_tool_calls': avg_tool_calls,
+            'avg_first_tool_call_time': avg_first_tool_call_times,
+            'deadline_hits': deadline_hits,
             'category_stats': category_stats
         }
         
         return summary
 
+# Eredményfájl beolvasása (a generate_summary által várt típusokkal)
+def read_results(filename):
+    """Beolvassa egy eredmény CSV sorait"""
+    results = []
+    with open(filename, 'r', newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            row['ResponseTime'] = float(row['ResponseTime'] or 0)
+            row['FirstToolCallTime'] = float(row['FirstToolCallTime']) if row.get('FirstToolCallTime') else None
+            row['ToolCalls'] = int(row['ToolCalls'] or 0)
+            row['ResponseLength'] = int(row['ResponseLength']) if row.get('ResponseLength') else None
+            row['Success'] = row['Success'] == 'True'
+            for column in ('Tags', 'ToolSequence', 'ExpectedTools'):
+                row[column] = [item for item in (row.get(column) or "").split(";") if item]
+            results.append(row)
+    return results
+
+def read_columns(filename):
+    """Egy eredmény CSV fejléce"""
+    with open(filename, 'r', newline='', encoding='utf-8') as f:
+        return next(csv.reader(f), COLUMNS)
+
 # Eszközhívások számlálása a válaszból
 def count_tool_calls(result):
     """Megszámolja az eszközhívások számát a válaszban"""
@@ -246,105 +366,246 @@ def count_tool_calls(result):
             tool_calls += len(message.tool_calls)
     return tool_calls
 
+def tool_sequence(result):
+    """Az eszközhívások nevei sorrendben"""
+    return [tool_call["name"] for message in result.get("messages", [])
+            for tool_call in (getattr(message, 'tool_calls', None) or [])]
+
+# Egy teszteset futtatása egy konfigurációval
+def run_test_case(test_case, config_name, agent, logger, verbose=True):
+    """Lefuttat egy tesztesetet és naplózza az eredményt"""
+    log = print if verbose else (lambda *args, **kwargs: None)
+    case_fields = {
+        "test_id": test_case["id"],
+        "category": test_case["category"],
+        "config": config_name,
+        "query": test_case["query"],
+        "tags": test_case.get("tags", []),
+        "expected_tools": test_case.get("expected_tools", [])
+    }
+    
+    # Mérjük az időt
+    start_time = time.time()
+    first_tool_call_time = None
+    
+    try:
+        # Futtatjuk az ágenst (alacsony prioritással, hogy ne vegye el a kvótát az élő chat elől)
+        # A lépésenkénti állapotokból látszik, mikor született az első eszközhívás
+        result = None
+        with request_priority("evaluator"):
+            for result in agent.graph.stream(
+                {"messages": [HumanMessage(content=test_case["query"])]},
+                {"recursion_limit": 15},  # Növelt recursion limit
+                stream_mode="values"
+            ):
+                last_message = result["messages"][-1]
+                if first_tool_call_time is None and getattr(last_message, "tool_calls", None):
+                    first_tool_call_time = time.time() - start_time
+        
+        # Számoljuk az időt
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        log(f"    Válaszidő: {elapsed_time:.2f} másodperc")
+        if first_tool_call_time is not None:
+            log(f"    Első eszközhívásig: {first_tool_call_time:.2f} másodperc")
+        
+        # Eszközhívások számolása
+        tool_calls = count_tool_calls(result)
+        log(f"    Eszközhívások: {tool_calls}")
+        
+        # Válasz kinyerése
+        response_content = ""
+        forced_final = None
+        if result["messages"] and len(result["messages"]) > 0:
+            response_content = result["messages"][-1].content
+            # Idő- vagy lépéskeret miatt kényszerített (részleges) válasz
+            forced_final = result["messages"][-1].response_metadata.get("forced_final")
+        if forced_final:
+            log(f"    Kényszerített válasz: {forced_final}")
+        
+        # Eredmény naplózása - sikeres
+        return logger.log_result(
+            **case_fields,
+            response_time=elapsed_time,
+            tool_calls=tool_calls,
+            tool_sequence=tool_sequence(result),
+            success=True,
+            error_type={"deadline": "DeadlineHit", "step_limit": "StepLimitHit"}.get(forced_final, ""),
+            first_tool_call_time=first_tool_call_time,
+            notes="Részleges válasz a keret kimerülése miatt" if forced_final else "",
+            response=response_content
+        )
+        
+    except GraphRecursionError as e:
+        # Recursion limit hiba esetén
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        log(f"    HIBA: Recursion limit túllépve: {str(e)}")
+        
+        # Eredmény naplózása - recursion hiba
+        return logger.log_result(
+            **case_fields,
+            response_time=elapsed_time,
+            tool_calls=0,
+            success=False,
+            error_type="RecursionError",
+            notes=f"Recursion limit hiba: {str(e)}",
+            response="A model túllépte a megengedett eszközhívások számát."
+        )
+        
+    except Exception as e:
+        # Egyéb hibák esetén
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        log(f"    HIBA: {type(e).__name__}: {str(e)}")
+        
+        # Eredmény naplózása - egyéb hiba
+        return logger.log_result(
+            **case_fields,
+            response_time=elapsed_time,
+            tool_calls=0,
+            success=False,
+            error_type=type(e).__name__,
+            notes=f"Hiba: {str(e)}",
+            response="Hiba történt a feldolgozás során."
+        )
+
 # Teszt végrehajtó függvény
-def run_tests(continue_from=None):
-    """Végrehajtja a teszteket és naplózza az eredményeket"""
+def run_tests(continue_from=None, cases=None, config_names=None, verbose=True, print_results=True,
+              profile_dir=None, skip=None):
+    """Végrehajtja a teszteket és naplózza az eredményeket
+    
+    Folytatáskor (continue_from) a fájlban már szereplő teszt/konfiguráció
+    párok kimaradnak, ahogy a skip halmazban megadottak is (pl. más shard
+    fájlokban már lefutottak). profile_dir megadásakor minden futás
+    profilozva van, a profilok ebbe a mappába kerülnek (lásd profiling.py).
+    """
     # Logger inicializálása
     logger = TestLogger(continue_from)
+    done = logger.completed() | set(skip or ())
+    cases = test_cases if cases is None else cases
     
     # Ágens konfigurációk létrehozása
-    configs = {
-        "GPT-4o with tools": create_agent_with_model("gpt-4o", True),
-        "GPT-4o-mini with tools": create_agent_with_model("gpt-4o-mini", True),
-        "GPT-4o no tools": create_agent_with_model("gpt-4o", False)
-    }
+    configs = {name: create_agent_with_model(*CONFIGURATIONS[name])
+               for name in (config_names or CONFIGURATIONS)}
     
     # Tesztek végrehajtása
-    for test_case in test_cases:
-        print(f"\nFuttatás: {test_case['id']} - {test_case['query'][:50]}...")
+    for test_case in cases:
+        if verbose:
+            print(f"\nFuttatás: {test_case['id']} - {test_case['query'][:50]}...")
         
         for config_name, agent in configs.items():
-            print(f"  Konfiguráció: {config_name}")
-            
-            # Mérjük az időt
-            start_time = time.time()
+            if (test_case["id"], config_name) in done:
+                continue
+            if verbose:
+                print(f"  Konfiguráció: {config_name}")
+            if profile_dir is None:
+                run_test_case(test_case, config_name, agent, logger, verbose)
+                continue
             
-            try:
-                # Futtatjuk az ágenst
-                result = agent.graph.invoke(
-                    {"messages": [HumanMessage(content=test_case["query"])]},
-                    {"recursion_limit": 15}  # Növelt recursion limit
-                )
-                
-                # Számoljuk az időt
-                end_time = time.time()
-                elapsed_time = end_time - start_time
-                print(f"    Válaszidő: {elapsed_time:.2f} másodperc")
-                
-                # Eszközhívások számolása
-                tool_calls = count_tool_calls(result)
-                print(f"    Eszközhívások: {tool_calls}")
-                
-                # Válasz kinyerése
-                response_content = ""
-                if result["messages"] and len(result["messages"]) > 0:
-                    response_content = result["messages"][-1].content
-                
-                # Eredmény naplózása - sikeres
-                logger.log_result(
-                    test_id=test_case["id"],
-                    category=test_case["category"],
-                    config=config_name,
-                    query=test_case["query"],
-                    response_time=elapsed_time,
-                    tool_calls=tool_calls,
-                    success=True,
-                    response=response_content
-                )
-                
-            except GraphRecursionError as e:
-                # Recursion limit hiba esetén
-                end_time = time.time()
-                elapsed_time = end_time - start_time
-                print(f"    HIBA: Recursion limit túllépve: {str(e)}")
-                
-                # Eredmény naplózása - recursion hiba
-                logger.log_result(
-                    test_id=test_case["id"],
-                    category=test_case["category"],
-                    config=config_name,
-                    query=test_case["query"],
-                    response_time=elapsed_time,
-                    tool_calls=0,
-                    success=False,
-                    error_type="RecursionError",
-                    notes=f"Recursion limit hiba: {str(e)}",
-                    response="A model túllépte a megengedett eszközhívások számát."
-                )
-                
-            except Exception as e:
-                # Egyéb hibák esetén
-                end_time = time.time()
-                elapsed_time = end_time - start_time
-                print(f"    HIBA: {type(e).__name__}: {str(e)}")
-                
-                # Eredmény naplózása - egyéb hiba
-                logger.log_result(
-                    test_id=test_case["id"],
-                    category=test_case["category"],
-                    config=config_name,
-                    query=test_case["query"],
-                    response_time=elapsed_time,
-                    tool_calls=0,
-                    success=False,
-                    error_type=type(e).__name__,
-                    notes=f"Hiba: {str(e)}",
-                    response="Hiba történt a feldolgozás során."
-                )
-    
-    # Statisztika létrehozása és kiírása
+            # Profilozott futtatás: a profil a teszt és a konfiguráció nevét kapja
+            from profiling import profile_call, save_report, format_categories
+            _, report = profile_call(run_test_case, test_case, config_name, agent, logger, verbose)
+            safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in f"{test_case['id']}__{config_name}")
+            save_report(report, os.path.join(profile_dir, safe_name))
+            if verbose:
+                print("    " + format_categories(report).replace("\n", "\n    "))
+    
+    if print_results:
+        print("\nTesztelés befejezve!")
+        print_summary(logger)
+    return logger
+
+# Párhuzamos (shardolt) futtatás több folyamatban
+def _init_shard_worker(workers):
+    """A folyamatonkénti rate limit kereteket a workerek számával osztja el"""
+    from scheduler import scheduler, TokenBucket
+    for limiter in scheduler.providers.values():
+        limiter.requests = TokenBucket(limiter.requests.capacity / workers)
+        if limiter.tokens is not None:
+            limiter.tokens = TokenBucket(limiter.tokens.capacity / workers)
+
+def _run_shard(args):
+    """Egy shard futtatása a saját eredményfájljába (worker folyamatban)
+    
+    A prompt cache számlálói is visszamennek, hogy az összesítő arány a
+    fő folyamatban is helyes legyen.
+    """
+    shard_file, cases, config_names, profile_dir, done = args
+    logger = run_tests(shard_file, cases, config_names, verbose=False, print_results=False, profile_dir=profile_dir,
+                       skip=done)
+    print(f"  Shard kész: {shard_file} ({len(logger.results)} eredmény)")
+    return {name: metrics.counter(name) for name in ("openai.input_tokens", "openai.cached_input_tokens")}
+
+def run_sharded(cases, config_names=None, workers=4, run_dir=None, output=None, profile_dir=None):
+    """A teszteseteket workers darab folyamat között osztja szét
+    
+    Minden shard a run_dir/shard_XXX.csv fájlba ír, a végén ezek egy közös
+    eredményfájlba kerülnek. Egy megszakadt futás ugyanazzal a run_dir-rel
+    folytatható: a már meglévő eredmények nem futnak újra.
+    """
+    import multiprocessing
+    
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    run_dir = run_dir or os.path.join("eval_runs", timestamp)
+    output = output or f"test_results_{timestamp}.csv"
+    os.makedirs(run_dir, exist_ok=True)
+    
+    # Folytatás: a korábbi shard fájlokban szereplő párok kimaradnak, bármelyik
+    # shardba kerül is most az eset, és csak a hiányzó konfigurációk futnak
+    config_names = list(config_names or CONFIGURATIONS)
+    existing = sorted(os.path.join(run_dir, name) for name in os.listdir(run_dir) if name.startswith("shard_"))
+    done = set()
+    for filename in existing:
+        done |= TestLogger(filename).completed()
+    pending = [case for case in cases if any((case["id"], name) not in done for name in config_names)]
+    
+    workers = max(1, min(workers, len(pending)))
+    shards = [(os.path.join(run_dir, f"shard_{i:03d}.csv"), pending[i::workers], config_names, profile_dir, done)
+              for i in range(workers)]
+    print(f"{len(pending)} teszteset {workers} shardon ({run_dir})")
+    
+    if pending:
+        # spawn: minden worker tiszta folyamatban, saját ágensekkel indul
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(workers, initializer=_init_shard_worker, initargs=(workers,)) as pool:
+            for counters in pool.imap_unordered(_run_shard, shards):
+                for name, value in counters.items():
+                    metrics.inc(name, value)
+    
+    shard_files = sorted(set(existing) | {shard[0] for shard in shards if os.path.exists(shard[0])})
+    logger = merge_results(shard_files, output)
     print("\nTesztelés befejezve!")
+    print_summary(logger)
+    return logger
+
+def merge_results(shard_files, output):
+    """A shard eredményfájlok összefűzése egy eredményfájlba
+    
+    Minden teszt/konfiguráció pár egyszer kerül be (az első előfordulása).
+    """
+    if os.path.exists(output):
+        os.remove(output)
+    seen = set()
+    with open(output, 'w', newline='', encoding='utf-8') as out:
+        writer = csv.DictWriter(out, fieldnames=COLUMNS)
+        writer.writeheader()
+        for filename in shard_files:
+            with open(filename, 'r', newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    key = (row['TestID'], row['Configuration'])
+                    if key not in seen:
+                        seen.add(key)
+                        writer.writerow(row)
+    return TestLogger(output)
+
+# Összesítő statisztikák kiírása
+def print_summary(logger):
+    """Kiírja egy eredményfájl összesítő statisztikáit"""
     summary = logger.generate_summary()
+    if isinstance(summary, str):
+        print(summary)
+        return
     print("\nÖsszesítő statisztikák:")
     
     print(f"  Összes teszt: {summary['total_tests']}")
@@ -357,6 +618,14 @@ def run_tests(continue_from=None):
     for config, rate in summary['success_rates'].items():
         print(f"    {config}: {rate:.1f}%")
     
+    print("  Átlagos idő az első eszközhívásig:")
+    for config, avg_time in summary['avg_first_tool_call_time'].items():
+        print(f"    {config}: {avg_time:.2f} másodperc")
+    
+    print("  Idő- vagy lépéskeret miatti korai válaszok:")
+    for config, hits in summary['deadline_hits'].items():
+        print(f"    {config}: {hits}")
+    
     print("  Átlagos eszközhívások száma:")
     for config, avg_calls in summary['avg_tool_calls'].items():
         print(f"    {config}: {avg_calls:.2f}")
@@ -369,9 +638,9 @@ def run_tests(continue_from=None):
             print(f"        Átlagos válaszidő: {stats['avg_time']:.2f} másodperc")
             print(f"        Sikerességi arány: {stats['success_rate']:.1f}%")
     
-    print(f"\nA részletes eredmények itt érhetők el: {logger.filename}")
+    print(f"  Prompt cache-ből kiszolgált input tokenek aránya: {cached_token_ratio() * 100:.1f}%")
     
-    return logger
+    print(f"\nA részletes eredmények itt érhetők el: {logger.filename}")
 
 # Manual accuracy evaluation helper
 def manual_evaluation():
@@ -381,11 +650,10 @@ def manual_evaluation():
     
     if not results_file:
         # Legutóbbi fájl keresése
-        files = [f for f in os.listdir('.') if f.startswith('test_results_') and f.endswith('.csv')]
-        if not files:
+        results_file = latest_results_file()
+        if results_file is None:
             print("Nem található eredményfájl!")
             return
-        results_file = max(files)  # A legutolsó fájl (időbélyeg alapján)
     
     print(f"Fájl: {results_file}")
     
@@ -466,7 +734,12 @@ def manual_evaluation():
     print(f"\nAz értékelések mentve a következő fájlba: {results_file}")
     
     # Értékelés összesítése
-    evaluated_rows = [row for row in updated_rows if row.get('Accuracy') and row.get('Accuracy') != 'N/A']
+    print_score_summary(updated_rows)
+
+# Pontszámok összesítése konfigurációnként
+def print_score_summary(rows):
+    """Kiírja a konfigurációnkénti átlagos pontszámokat"""
+    evaluated_rows = [row for row in rows if row.get('Accuracy') and row.get('Accuracy') != 'N/A']
     if evaluated_rows:
         print("\nÉrtékelés összesítés:")
         
@@ -483,11 +756,11 @@ def manual_evaluation():
                 }
             
             config_stats[config]['total'] += 1
-            if row.get('Accuracy') and row['Accuracy'].isdigit():
+            if str(row.get('Accuracy', '')).isdigit():
                 config_stats[config]['accuracy_sum'] += int(row['Accuracy'])
-            if row.get('Completeness') and row['Completeness'].isdigit():
+            if str(row.get('Completeness', '')).isdigit():
                 config_stats[config]['completeness_sum'] += int(row['Completeness'])
-            if row.get('Usability') and row['Usability'].isdigit():
+            if str(row.get('Usability', '')).isdigit():
                 config_stats[config]['usability_sum'] += int(row['Usability'])
         
         # Eredmények kiírása
@@ -503,30 +776,86 @@ def manual_evaluation():
                 print(f"  Átlagos teljesség: {avg_completeness:.2f}")
                 print(f"  Átlagos használhatóság: {avg_usability:.2f}")
 
-# Ha közvetlenül futtatjuk a fájlt
-if __name__ == "__main__":
-    print("Budapest Explorer - Értékelő eszköz (javított verzió)")
-    print("=" * 60)
-    print("API kulcsok beállítva: OPENAI_API_KEY és MAPS_API_KEY")
+# Automatikus pontozás (rubrika + opcionális LLM bíráló)
+def automatic_evaluation(results_file=None, use_judge=False, rescore=False, batch_size=8, workers=4):
+    """Egy eredményfájl automatikus pontozása a manuális értékelés helyett"""
+    from auto_scorer import score_file
+    
+    results_file = results_file or latest_results_file()
+    if results_file is None:
+        print("Nem található eredményfájl!")
+        return
+    rows = score_file(results_file, use_judge=use_judge, rescore=rescore, batch_size=batch_size, workers=workers)
+    print_score_summary(rows)
+
+def latest_results_file():
+    """A legutolsó test_results_*.csv fájl (időbélyeg alapján), vagy None"""
+    files = [f for f in os.listdir('.') if f.startswith('test_results_') and f.endswith('.csv')]
+    return max(files) if files else None
+
+# Parancssori felület
+def main(argv=None):
+    """Parancssori belépési pont
     
-    choice = input("Válassz műveletet:\n1. Tesztek futtatása\n2. Eredmények manuális értékelése\n3. Folytatás a legutóbbi fájlból\nVálasztás: ")
+    Példák:
+      python evaluator.py run --suite suites/budapest.jsonl --workers 8
+      python evaluator.py run --category basic --config "GPT-4o-mini with tools"
+      python evaluator.py run --limit 5 --profile profiles/
+      python evaluator.py run --resume eval_runs/20250101_120000 --suite suites/budapest.jsonl
+      python evaluator.py summary test_results_20250101_120000.csv
+      python evaluator.py score --judge
+      python evaluator.py manual
+    """
+    import argparse
     
-    if choice == "1":
-        print("\nTesztek futtatása...")
-        run_tests()
-    elif choice == "2":
-        print("\nEredmények manuális értékelése...")
-        manual_evaluation()
-    elif choice == "3":
-        print("\nTesztek folytatása a legutóbbi fájlból...")
-        # Legutóbbi fájl keresése
-        files = [f for f in os.listdir('.') if f.startswith('test_results_') and f.endswith('.csv')]
-        if not files:
-            print("Nem található eredményfájl! Új tesztek indítása...")
-            run_tests()
+    parser = argparse.ArgumentParser(description="Budapest Explorer - Értékelő eszköz")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    run_parser = subparsers.add_parser("run", help="Tesztek futtatása")
+    run_parser.add_argument("--suite", help="Tesztkészlet fájl (JSONL/JSON/YAML); alapértelmezés: beépített 10 eset")
+    run_parser.add_argument("--config", action="append", choices=list(CONFIGURATIONS), dest="configs",
+                            help="Futtatandó konfiguráció (többször is megadható; alapértelmezés: mind)")
+    run_parser.add_argument("--category", action="append", dest="categories", help="Csak ezek a kategóriák")
+    run_parser.add_argument("--tag", action="append", dest="tags", help="Csak az ilyen címkéjű esetek")
+    run_parser.add_argument("--limit", type=int, help="Legfeljebb ennyi teszteset")
+    run_parser.add_argument("--workers", type=int, default=1, help="Párhuzamos worker folyamatok száma")
+    run_parser.add_argument("--resume", metavar="RUN_DIR",
+                            help="Megszakadt shardolt futás folytatása (workers > 1 esetén)")
+    run_parser.add_argument("--continue-from", metavar="CSV",
+                            help="Eredményfájl folytatása (egy folyamatos futásnál)")
+    run_parser.add_argument("--output", help="Az összesített eredményfájl neve")
+    run_parser.add_argument("--profile", metavar="DIR",
+                            help="Minden futás profilozása (pyinstrument, ha telepítve van, különben cProfile)")
+    
+    summary_parser = subparsers.add_parser("summary", help="Eredményfájl összesítése")
+    summary_parser.add_argument("results_file")
+    
+    score_parser = subparsers.add_parser("score", help="Eredmények automatikus pontozása")
+    score_parser.add_argument("results_file", nargs="?", help="Alapértelmezés: a legutolsó eredményfájl")
+    score_parser.add_argument("--judge", action="store_true", help="LLM bíráló a rubrika mellé")
+    score_parser.add_argument("--rescore", action="store_true", help="A már pontozott sorok újrapontozása")
+    score_parser.add_argument("--batch-size", type=int, default=8, help="Bírálandó válaszok hívásonként")
+    score_parser.add_argument("--workers", type=int, default=4, help="Párhuzamos bíráló hívások")
+    
+    subparsers.add_parser("manual", help="Eredmények manuális értékelése")
+    
+    args = parser.parse_args(argv)
+    
+    if args.command == "run":
+        cases = load_test_cases(args.suite) if args.suite else test_cases
+        cases = filter_test_cases(cases, args.categories, args.tags, args.limit)
+        print(f"Budapest Explorer - Értékelés: {len(cases)} teszteset")
+        if args.workers > 1 or args.resume:
+            run_sharded(cases, args.configs, args.workers, args.resume, args.output, args.profile)
         else:
-            most_recent_file = max(files)  # A legutolsó fájl (időbélyeg alapján)
-            print(f"Folytatás a következő fájlból: {most_recent_file}")
-            run_tests(most_recent_file)
+            run_tests(args.continue_from or args.output, cases, args.configs, profile_dir=args.profile)
+    elif args.command == "summary":
+        print_summary(TestLogger(args.results_file))
+    elif args.command == "score":
+        automatic_evaluation(args.results_file, args.judge, args.rescore, args.batch_size, args.workers)
     else:
-        print("Érvénytelen választás!")
+        manual_evaluation()
+
+# Ha közvetlenül futtatjuk a fájlt
+if __name__ == "__main__":
+    main()
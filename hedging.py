@@ -0,0 +1,138 @@
+# hedging.py
+# Hedged requests against slow upstream responses
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# A hedged call starts the request and, if it has not answered within the
+# usual latency of the upstream (a high percentile of the recent calls), it
+# starts an identical second request and takes whichever answers first.
+# Only idempotent calls may be hedged. Extra requests are limited by a
+# budget: every call earns a fraction of a hedge, so at most about that
+# share of the calls are doubled, even when the upstream is slow for all.
+
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextvars import copy_context
+
+from metrics import metrics
+
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+
+_pool = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_WORKERS", "16")), thread_name_prefix="hedge")
+
+
+class Hedger:
+    """Hedging policy and latency statistics of one upstream."""
+
+    def __init__(self, name: str, percentile: float = 0.95, initial_delay: float = 1.0,
+                 min_delay: float = 0.05, max_delay: float = 10.0, budget_ratio: float = 0.1,
+                 max_tokens: float = 5.0, window: int = 200, min_samples: int = 20, enabled: bool = None):
+        """
+        Args:
+            percentile: latency percentile after which the hedge is sent
+            initial_delay: delay used until min_samples latencies are known (seconds)
+            budget_ratio: hedges earned per call (0.1: at most ~10% extra requests)
+            max_tokens: hedges that can be saved up for a burst of slow calls
+        """
+        self.name = name
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.max_tokens = max_tokens
+        self.min_samples = min_samples
+        self.enabled = HEDGE_REQUESTS if enabled is None else enabled
+
+        self._latencies = deque(maxlen=window)
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        """Current hedge delay: the chosen percentile of the recent latencies."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        index = min(len(latencies) - 1, int(self.percentile * len(latencies)))
+        return min(self.max_delay, max(self.min_delay, latencies[index]))
+
+    def _record(self, started: float):
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+
+    def _take_token(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def call(self, fn):
+        """Return fn(), hedged with a second fn() call if the first one is slow."""
+        if not self.enabled:
+            return fn()
+
+        metrics.inc(f"hedge.{self.name}.calls")
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.budget_ratio)
+
+        def attempt():
+            started = time.monotonic()
+            try:
+                return fn()
+            finally:
+                self._record(started)
+
+        # Copy the context so the priority and deadline of the request apply
+        primary = _pool.submit(copy_context().run, attempt)
+        done, _ = wait([primary], timeout=self.delay())
+        if done:
+            return primary.result()
+
+        if not self._take_token():
+            metrics.inc(f"hedge.{self.name}.budget_denied")
+            return primary.result()
+
+        metrics.inc(f"hedge.{self.name}.hedged")
+        hedge = _pool.submit(copy_context().run, attempt)
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # Prefer a successful answer; a failure only counts when both failed
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        metrics.inc(f"hedge.{self.name}.wins")
+                    return future.result()
+            if not pending:
+                return primary.result()
+
+    def stats(self) -> dict:
+        """Hedge delay, hedged calls and how often the hedge answered first."""
+        hedged = metrics.counter(f"hedge.{self.name}.hedged")
+        wins = metrics.counter(f"hedge.{self.name}.wins")
+        return {
+            "enabled": self.enabled,
+            "delay": self.delay(),
+            "calls": metrics.counter(f"hedge.{self.name}.calls"),
+            "hedged": hedged,
+            "wins": wins,
+            "win_rate": wins / hedged if hedged else 0.0,
+            "budget_denied": metrics.counter(f"hedge.{self.name}.budget_denied")
+        }
+
+
+# Maps calls are cheap, so they may be doubled more often than the search model
+directions_hedger = Hedger("directions", initial_delay=1.5)
+places_hedger = Hedger("places", initial_delay=1.5)
+search_hedger = Hedger("search", initial_delay=15.0, max_delay=30.0, budget_ratio=0.05, max_tokens=2.0)
+
+hedgers = {h.name: h for h in (directions_hedger, places_hedger, search_hedger)}
+
+
+def hedge_stats() -> dict:
+    return {name: hedger.stats() for name, hedger in hedgers.items()}
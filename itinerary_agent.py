@@ -8,23 +8,51 @@ load_dotenv()
 
 import os
 import json
+import time
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from typing import List, Dict, Any
 
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_openai import ChatOpenAI
 
+import numpy as np
+
+from metrics import metrics
+from singleflight import search_flight
+from circuit_breaker import search_breaker, chat_breaker
+from hedging import search_hedger
+from travel_matrix import travel_matrix
+from itinerary_optimizer import (
+    optimize_itinerary,
+    estimate_travel_minutes,
+    default_visit_minutes,
+    DEFAULT_VISIT_MINUTES
+)
+from scheduler import request_priority, scheduled_invoke
+
 # Import the raw functions from agent.py instead of the tool wrappers
 from agent import (
     OPENAI_API_KEY,
     parse_trip_input,
     get_directions,
-    get_local_attractions,
+    route_summary,
+    iter_local_attractions,
+    PlacesAPIError,
     extract_attraction_names
 )
 
 # Initialize the LLMs - regular for planning and search-enabled for attraction info
-planning_llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=OPENAI_API_KEY, temperature=0.3)
-search_llm = ChatOpenAI(model="gpt-4o-search-preview-2025-03-11", openai_api_key=OPENAI_API_KEY)
+planning_llm = ChatOpenAI(model="gpt-4o-mini", openai_api_key=OPENAI_API_KEY, temperature=0.3, max_retries=0)
+search_llm = ChatOpenAI(model="gpt-4o-search-preview-2025-03-11", openai_api_key=OPENAI_API_KEY, max_retries=0)
+
+# Score of the attractions the user explicitly asked for (always preferred)
+MUST_SEE_SCORE = 10.0
+# Time kept free for a meal on itineraries of 4+ hours
+MEAL_BREAK_MINUTES = 60
 
 # System prompt for itinerary planning
 ITINERARY_PROMPT = """
@@ -38,8 +66,64 @@ Készíts részletes útitervet, amely tartalmazza:
 - Rövid leírást minden helyszínről
 """
 
-def create_itinerary(preferences):
-    """Create an itinerary based on user preferences"""
+class StageCache:
+    """LRU cache of intermediate itinerary results, one key space per stage."""
+    
+    def __init__(self, max_entries=512, ttl=6 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get_or_compute(self, stage, key, compute, stages, cacheable=None):
+        """Return the cached value of (stage, key) or compute and store it.
+        
+        Records "hit" or "miss" for the stage in the `stages` report dict.
+        A computed value is not stored if cacheable(value) is false (e.g.
+        results of a failed API call, which should be retried next time).
+        """
+        with self._lock:
+            entry = self._entries.get((stage, key))
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self._entries.move_to_end((stage, key))
+                stages[stage] = "hit"
+                metrics.inc(f"itinerary_cache.{stage}.hits")
+                return entry[1]
+        
+        value = compute()
+        stages[stage] = "miss"
+        if cacheable is not None and not cacheable(value):
+            metrics.inc(f"itinerary_cache.{stage}.uncached")
+            return value
+        with self._lock:
+            self._entries[(stage, key)] = (time.time(), value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        metrics.inc(f"itinerary_cache.{stage}.misses")
+        return value
+
+# Shared cache, so resubmitting a slightly changed form only reruns what changed
+itinerary_cache = StageCache()
+
+def create_itinerary(preferences, report=None):
+    """Create an itinerary based on user preferences
+    
+    If a dict is passed as report, report["stages"] tells for every stage
+    whether it came from the cache ("hit"), was recomputed ("miss") or
+    was not needed ("skipped").
+    """
+    # Itinerary calls yield to interactive chat turns when the quotas are tight
+    with request_priority("itinerary"):
+        return build_itinerary(preferences, report)
+
+def build_itinerary(preferences, report=None):
+    """Run the itinerary stages (use create_itinerary to get the right priority)
+    
+    Every stage is cached under the preference fields and earlier results
+    it depends on, e.g. changing only the transport mode reuses the
+    extracted and found attractions (and their descriptions when the same
+    stops are selected) and recomputes the stop order, routes and text.
+    """
     # Get starting location
     start_location = preferences.get("start_location", "Deák Ferenc tér")
     interests = preferences.get("interests", [])
@@ -47,22 +131,108 @@ def create_itinerary(preferences):
     transport_mode = preferences.get("transport_mode", "transit")
     special_requests = preferences.get("special_requests", "")
     
-    # Step 1: Find attractions based on interests
-    attractions = []
+    stages = {}
+    if report is not None:
+        report["stages"] = stages
     
-    # Extract attraction names from special requests if any
+    # Step 1: Attractions named in the special requests (depends on: special requests)
+    must_see = []
     if special_requests:
         # Use the raw function directly
-        extracted_attractions = extract_attraction_names(special_requests)
-        attractions.extend(extracted_attractions)
+        must_see = itinerary_cache.get_or_compute(
+            "extract", special_requests,
+            lambda: tuple(extract_attraction_names(special_requests)),
+            stages
+        )
+    else:
+        stages["extract"] = "skipped"
+    
+    # Step 2: Candidate attractions (depends on: start location, interests, must-see list)
+    candidates_key = (start_location, tuple(sorted(interests)), tuple(must_see))
+    found = itinerary_cache.get_or_compute(
+        "candidates", candidates_key,
+        lambda: collect_candidates(start_location, interests, must_see),
+        stages,
+        cacheable=lambda found: found["complete"]
+    )
+    
+    # Step 3: Select and order the stops (depends on: the found candidates, available time, transport mode)
+    found_key = (found["start_coords"], tuple(
+        (c["name"], c["score"], c["mandatory"], c["location"], c["visit_minutes"]) for c in found["candidates"]
+    ))
+    stops = itinerary_cache.get_or_compute(
+        "stops", (start_location, found_key, int(available_time), transport_mode),
+        lambda: plan_stops(start_location, found["start_coords"], found["candidates"],
+                           available_time, transport_mode),
+        stages
+    )
+    
+    # If no attractions were found, add some default attractions
+    if not stops:
+        stops = [{"name": name, "visit_minutes": DEFAULT_VISIT_MINUTES}
+                 for name in ["Parliament", "Buda Castle", "Fisherman's Bastion"]]
+    selected_attractions = [stop["name"] for stop in stops]
+    
+    # Step 4: Get attraction information using the search-enabled model (depends on: the selected set)
+    attraction_descriptions = itinerary_cache.get_or_compute(
+        "descriptions", tuple(sorted(selected_attractions)),
+        lambda: get_attraction_descriptions_with_search(selected_attractions),
+        stages
+    )
+    
+    # Step 5: Plan routes between attractions (depends on: start, stop order, transport mode)
+    routes = itinerary_cache.get_or_compute(
+        "routes", (start_location, tuple(selected_attractions), transport_mode),
+        lambda: plan_routes(start_location, selected_attractions, transport_mode),
+        stages,
+        cacheable=lambda routes: not any("error" in route for route in routes)
+    )
+    
+    travel_lines = [
+        f"- {route['from']} → {route['to']}: {route['duration_text']} ({route['distance_text']})"
+        for route in routes if "error" not in route
+    ]
+    if report is not None:
+        report["map"] = itinerary_map(start_location, found["start_coords"], stops, routes, transport_mode)
+    
+    # Step 6: Generate the final itinerary with the LLM (depends on: everything above)
+    final_key = (start_location, tuple(interests), available_time, transport_mode, special_requests,
+                 tuple((stop["name"], stop["visit_minutes"]) for stop in stops),
+                 attraction_descriptions, tuple(travel_lines))
+    return itinerary_cache.get_or_compute(
+        "final", final_key,
+        lambda: write_itinerary(start_location, interests, available_time, transport_mode,
+                                special_requests, stops, attraction_descriptions, travel_lines),
+        stages
+    )
+
+def collect_candidates(start_location, interests, must_see):
+    """Candidate stops: the must-see attractions plus places matching the interests.
+    
+    'complete' is false if a lookup failed (no start coordinates, a failed
+    Places search or no candidates at all); such results are not cached.
+    """
+    candidates = []
+    failures = []
+    
+    # Attractions named in the special requests are must-see stops
+    for name in must_see:
+        candidates.append({
+            "name": name,
+            "score": MUST_SEE_SCORE,
+            "mandatory": True,
+            "location": travel_matrix.location_of(name),
+            "visit_minutes": DEFAULT_VISIT_MINUTES
+        })
     
     # If interests include specific categories, find more attractions
-    if not attractions or len(attractions) < 3:
-        # Use get_directions function directly
+    start_coords = travel_matrix.location_of(start_location)
+    if len(candidates) < 3:
+        # Only the start coordinates are needed, so the mode does not matter
         route_data = get_directions(
             from_place=start_location,
             to_place="Hősök tere, Budapest",
-            mode=transport_mode
+            mode="walking"
         )
         
         # Extract coordinates from the route
@@ -70,48 +240,69 @@ def create_itinerary(preferences):
             leg = route_data["routes"][0]["legs"][0]
             lat = leg["start_location"]["lat"]
             lng = leg["start_location"]["lng"]
+            start_coords = (lat, lng)
             
-            # Get attractions for each interest category
-            for interest in interests:
-                category = map_interest_to_category(interest)
-                # Use get_local_attractions function directly
-                attractions_result = get_local_attractions(
-                    lat=lat,
-                    lng=lng,
-                    category=category,
-                    radius=1000
-                )
-                
-                if "places" in attractions_result:
-                    for place in attractions_result["places"]:
-                        attractions.append(place["name"])
-    
-    # Limit to top attractions based on available time
-    max_attractions = min(int(available_time) // 2 + 1, 5)
-    selected_attractions = attractions[:max_attractions]
+            # Search all interest categories in one pass (places come back merged)
+            known_names = {c["name"] for c in candidates}
+            for place in find_attractions_for_interests(lat, lng, interests, radius=1000, failures=failures):
+                if place["name"] in known_names:
+                    continue
+                known_names.add(place["name"])
+                location = place.get("location")
+                candidates.append({
+                    "name": place["name"],
+                    # Places satisfying several interests are worth more
+                    "score": place["score"] + len(place["interests"]),
+                    "mandatory": False,
+                    "location": (location["lat"], location["lng"]) if location else None,
+                    "visit_minutes": default_visit_minutes(place.get("types", []) + place["categories"])
+                })
     
-    # If no attractions were found, add some default attractions
-    if not selected_attractions:
-        selected_attractions = ["Parliament", "Buda Castle", "Fisherman's Bastion"]
-    
-    # Step 2: Get attraction information using the search-enabled model
-    attraction_descriptions = get_attraction_descriptions_with_search(selected_attractions)
-    
-    # Step 3: Plan routes between attractions
+    complete = start_coords is not None and bool(candidates) and not failures
+    return {"start_coords": start_coords, "candidates": candidates, "complete": complete}
+
+def plan_routes(start_location, attractions, transport_mode):
+    """Travel summaries of the legs from the start through the attractions in order."""
     routes = []
     current_location = start_location
     
-    for attraction in selected_attractions:
-        # Use get_directions function directly  
-        route = get_directions(
+    for attraction in attractions:
+        # Landmark pairs come from the precomputed travel matrix, others from the Directions API
+        route = route_summary(
             from_place=current_location,
             to_place=attraction + ", Budapest",
-            mode=transport_mode
+            mode=transport_mode,
+            with_path=True
         )
         routes.append(route)
         current_location = attraction + ", Budapest"
+    return routes
+
+def itinerary_map(start_location, start_coords, stops, routes, transport_mode):
+    """Map data of the itinerary: the stops as points and the legs as paths.
+    
+    Legs without geometry (e.g. from the travel matrix) are drawn as straight lines.
+    """
+    points = [{"name": start_location, "lat": start_coords[0], "lng": start_coords[1]}] if start_coords else []
+    coords = [start_coords]
+    for stop in stops:
+        location = stop.get("location")
+        coords.append(location)
+        if location:
+            points.append({"name": stop["name"], "lat": location[0], "lng": location[1]})
     
-    # Step 4: Generate the final itinerary with the LLM
+    paths = []
+    for k, route in enumerate(routes):
+        path = route.get("path")
+        if not path and k + 1 < len(coords) and coords[k] and coords[k + 1]:
+            path = [[coords[k][1], coords[k][0]], [coords[k + 1][1], coords[k + 1][0]]]
+        if path:
+            paths.append({"from": route["from"], "to": route["to"], "mode": transport_mode, "path": path})
+    return {"paths": paths, "points": points}
+
+def write_itinerary(start_location, interests, available_time, transport_mode,
+                    special_requests, stops, attraction_descriptions, travel_lines):
+    """Generate the final itinerary text with the planning LLM."""
     prompt = f"""
     Create a Budapest itinerary based on these details:
     
@@ -121,12 +312,15 @@ def create_itinerary(preferences):
     Transportation mode: {transport_mode}
     Special requests: {special_requests}
     
-    Selected attractions:
-    {json.dumps(selected_attractions)}
+    Selected attractions (in visiting order, with planned visit time in minutes):
+    {json.dumps({stop["name"]: stop["visit_minutes"] for stop in stops}, ensure_ascii=False)}
     
     Attraction information (from web search):
     {attraction_descriptions}
     
+    Travel between the stops ({transport_mode}):
+    {chr(10).join(travel_lines) or "unknown"}
+    
     Format the itinerary with:
     1. A title and brief introduction
     2. A time schedule starting at 10:00 AM
@@ -144,7 +338,7 @@ def create_itinerary(preferences):
         HumanMessage(content=prompt)
     ]
     
-    response = planning_llm.invoke(messages)
+    response = chat_breaker.call(None, lambda: scheduled_invoke(planning_llm, messages, expected_output_tokens=1500))
     return response.content
 
 def get_attraction_descriptions_with_search(attractions):
@@ -165,9 +359,88 @@ def get_attraction_descriptions_with_search(attractions):
     Format each description with the attraction name as a header followed by 3-4 informative sentences.
     """
     
-    response = search_llm.invoke([HumanMessage(content=prompt)])
+    # Identical concurrent lookups (e.g. the same default attractions) share one call;
+    # the last good descriptions are served while the search model is failing
+    key = ("itinerary_descriptions", json.dumps(attractions, ensure_ascii=False))
+    response = search_flight.do(key, lambda: search_breaker.call(key, lambda: search_hedger.call(
+        lambda: scheduled_invoke(search_llm, [HumanMessage(content=prompt)], expected_output_tokens=1500)
+    )))
     return response.content
 
+def plan_stops(start_location, start_coords, candidates, available_time, transport_mode):
+    """Choose and order the candidate stops that fit into the available time.
+    
+    Travel times come from the precomputed travel matrix where both places
+    are landmarks and from straight-line estimates otherwise.
+    """
+    if not candidates:
+        return []
+    
+    names = [start_location] + [c["name"] for c in candidates]
+    coords = [start_coords] + [c["location"] for c in candidates]
+    travel = estimate_travel_minutes(coords, transport_mode)
+    known = travel_matrix.durations(names, transport_mode) / 60
+    travel = np.where(np.isnan(known), travel, known)
+    
+    # Keep an hour for a meal on longer days
+    budget = int(available_time) * 60 - (MEAL_BREAK_MINUTES if int(available_time) >= 4 else 0)
+    result = optimize_itinerary(
+        travel,
+        scores=[c["score"] for c in candidates],
+        visit_minutes=[c["visit_minutes"] for c in candidates],
+        budget_minutes=budget,
+        mandatory=[c["mandatory"] for c in candidates]
+    )
+    return [candidates[i] for i in result["order"]]
+
+def find_attractions_for_interests(lat, lng, interests, radius=1000, per_category=10, failures=None):
+    """Search the places for several interests at once.
+    
+    Interests mapping to the same Places category (e.g. history, architecture
+    and culture) share one query, the distinct categories are queried in
+    parallel, and the results are merged by place identity. Every returned
+    place lists the interests it satisfies in its 'interests' field; places
+    matching more interests come first, then by ranking score. Categories
+    whose search failed are appended to the `failures` list if one is given.
+    """
+    # Deduplicate the categories up front
+    interests_by_category = {}
+    for interest in interests:
+        interests_by_category.setdefault(map_interest_to_category(interest), []).append(interest)
+    
+    if not interests_by_category:
+        return []
+    
+    def search(category):
+        try:
+            return list(itertools.islice(iter_local_attractions(lat, lng, category, radius), per_category))
+        except PlacesAPIError:
+            if failures is not None:
+                failures.append(category)
+            return []
+    
+    # Each task gets its own copy of the context, so the request priority is kept
+    with ThreadPoolExecutor(max_workers=len(interests_by_category)) as pool:
+        futures = {
+            category: pool.submit(copy_context().run, search, category)
+            for category in interests_by_category
+        }
+        results = {category: future.result() for category, future in futures.items()}
+    
+    # Merge by place identity and record which interests each place satisfies
+    merged = {}
+    for category, places in results.items():
+        for place in places:
+            entry = merged.get(place["place_id"])
+            if entry is None:
+                entry = dict(place, interests=[], categories=[])
+                merged[place["place_id"]] = entry
+            entry["categories"].append(category)
+            entry["interests"].extend(i for i in interests_by_category[category] if i not in entry["interests"])
+            entry["score"] = max(entry["score"], place["score"])
+    
+    return sorted(merged.values(), key=lambda p: (len(p["interests"]), p["score"]), reverse=True)
+
 def map_interest_to_category(interest):
     """Map user interests to Google Places API categories"""
     interest_map = {
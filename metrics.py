@@ -0,0 +1,89 @@
+# metrics.py
+# Lightweight in-process counters and timings for Budapest Explorer
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Thread-safe registry of named counters and timing summaries."""
+
+    def __init__(self, window: int = 500):
+        """Keep the last `window` samples of every timing for percentiles."""
+        self._lock = threading.Lock()
+        self._window = window
+        self._counters = {}
+        self._timings = {}
+
+    def inc(self, name: str, value: float = 1):
+        """Increase a counter by `value`."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        """Record one timing sample (in seconds)."""
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = {"count": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=self._window)}
+                self._timings[name] = timing
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+            timing["samples"].append(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Context manager that records the duration of its block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def counter(self, name: str) -> float:
+        """Return the current value of a counter (0 if never increased)."""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def percentile(self, name: str, q: float):
+        """Return the q-th percentile (0-100) of the recent samples, or None."""
+        with self._lock:
+            timing = self._timings.get(name)
+            samples = sorted(timing["samples"]) if timing else []
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(q / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self) -> dict:
+        """Return a JSON-serializable copy of all counters and timings."""
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {name: (t["count"], t["total"], t["max"], sorted(t["samples"]))
+                       for name, t in self._timings.items()}
+
+        summary = {}
+        for name, (count, total, max_value, samples) in timings.items():
+            summary[name] = {
+                "count": count,
+                "avg": total / count if count else 0.0,
+                "p50": samples[len(samples) // 2] if samples else None,
+                "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else None,
+                "max": max_value
+            }
+        return {"counters": counters, "timings": summary}
+
+    def reset(self):
+        """Drop all counters and timings."""
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+# Process-wide registry used by all modules
+metrics = Metrics()
@@ -0,0 +1,526 @@
+# osm_router.py
+# Local walking and bicycling router over an OpenStreetMap street graph
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# Build (offline, from an OSM XML extract of Budapest, e.g. an Overpass
+# export or `osmium cat budapest.osm.pbf -o budapest.osm`):
+#   python osm_router.py build budapest.osm --out data/osm
+# Files written to the output directory (memory-mapped when loaded):
+#   lat.npy, lng.npy             float32 node coordinates, nodes sorted by grid cell
+#   cell_ptr.npy                 CSR offsets of the grid cells into the node arrays
+#   <mode>_indptr.npy            CSR offsets of the outgoing edges of every node
+#   <mode>_indices.npy           int32 edge targets
+#   <mode>_length.npy            float32 edge lengths in meters
+#   <mode>_name.npy              int32 street name of every edge (-1 = unnamed)
+#   <mode>_lm_from.npy           float32 (k, n) distances from the ALT landmarks
+#   <mode>_lm_to.npy             float32 (k, n) distances to the ALT landmarks
+#   osm_index.json               street names, named places and grid parameters
+#
+# Queries are A* searches whose heuristic comes from the landmark distances
+# (ALT: by the triangle inequality d(v,t) >= d(L,t) - d(L,v) and
+# d(v,t) >= d(v,L) - d(t,L)), so only a narrow corridor around the shortest
+# path is explored. The result has the shape of a Directions API response.
+
+import os
+import re
+import bz2
+import gzip
+import json
+import math
+import heapq
+import argparse
+import threading
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from metrics import metrics
+from poi_index import to_xy
+from route_geometry import encode_polyline
+from travel_matrix import normalize_place_name, format_duration, format_distance, travel_matrix
+
+INDEX_FILE = "osm_index.json"
+
+# Average speeds (m/s) used for the durations
+MODE_SPEEDS = {"walking": 5 / 3.6, "bicycling": 15 / 3.6}
+
+# Highway types usable without an explicit foot=/bicycle= permission
+MODE_HIGHWAYS = {
+    "walking": {
+        "footway", "pedestrian", "path", "steps", "living_street", "residential", "service",
+        "unclassified", "tertiary", "tertiary_link", "secondary", "secondary_link", "primary",
+        "primary_link", "track", "corridor", "bridleway", "cycleway", "road"
+    },
+    "bicycling": {
+        "cycleway", "living_street", "residential", "service", "unclassified", "tertiary",
+        "tertiary_link", "secondary", "secondary_link", "primary", "primary_link", "track", "road"
+    }
+}
+MODE_ACCESS_KEY = {"walking": "foot", "bicycling": "bicycle"}
+
+# Tags that make a node or area a named place we can route to
+PLACE_KEYS = ("tourism", "historic", "amenity", "railway", "public_transport", "leisure", "place")
+
+# Snapping: the nearest routable node within this distance
+SNAP_RADIUS = 300.0
+GRID_CELL = 250.0
+
+# Landmarks used by one query (the ones giving the best bound at the start)
+ACTIVE_LANDMARKS = 4
+
+COORDINATE_PATTERN = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$")
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meters (scalars or arrays)."""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371000 * np.arcsin(np.sqrt(a))
+
+
+def way_directions(tags: dict, mode: str) -> tuple:
+    """(forward, backward) usability of a highway way in a mode."""
+    permission = tags.get(MODE_ACCESS_KEY[mode])
+    if permission in ("no", "use_sidepath") or (mode == "bicycling" and permission == "dismount"):
+        return False, False
+    if permission not in ("yes", "designated", "permissive"):
+        if tags["highway"] not in MODE_HIGHWAYS[mode] or tags.get("access") in ("no", "private"):
+            return False, False
+    if mode == "walking":
+        return True, True
+
+    if tags.get("oneway:bicycle") == "no" or tags.get("cycleway", "").startswith("opposite"):
+        return True, True
+    oneway = tags.get("oneway")
+    if oneway in ("yes", "1", "true") or (tags.get("junction") == "roundabout" and oneway != "no"):
+        return True, False
+    if oneway == "-1":
+        return False, True
+    return True, True
+
+
+def parse_osm(path: str):
+    """Node coordinates, highway ways and named places of an OSM XML file (.osm, .bz2, .gz)."""
+    opener = bz2.open if path.endswith(".bz2") else gzip.open if path.endswith(".gz") else open
+    nodes = {}
+    ways = []
+    places = []
+    keep = ("highway", "name", "oneway", "oneway:bicycle", "cycleway", "junction", "access", "foot", "bicycle")
+
+    with opener(path, "rb") as f:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event != "end" or elem.tag not in ("node", "way"):
+                continue
+            tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+            if elem.tag == "node":
+                lat, lng = float(elem.get("lat")), float(elem.get("lon"))
+                nodes[int(elem.get("id"))] = (lat, lng)
+                if tags.get("name") and any(key in tags for key in PLACE_KEYS):
+                    places.append({"name": tags["name"], "lat": lat, "lng": lng})
+            else:
+                refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                if "highway" in tags and len(refs) > 1:
+                    ways.append((refs, {key: tags[key] for key in keep if key in tags}))
+                elif tags.get("name") and any(key in tags for key in PLACE_KEYS):
+                    # Named areas (buildings, parks) are placed at the center of their outline
+                    coords = [nodes[ref] for ref in refs if ref in nodes]
+                    if coords:
+                        lat, lng = np.mean(coords, axis=0)
+                        places.append({"name": tags["name"], "lat": float(lat), "lng": float(lng)})
+            # Keep the memory flat on large extracts
+            root.clear()
+    return nodes, ways, places
+
+
+def _dijkstra(indptr: list, indices: list, weights: list, source: int) -> np.ndarray:
+    """Distances from source over CSR lists (inf = unreachable)."""
+    dist = [math.inf] * (len(indptr) - 1)
+    dist[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for e in range(indptr[u], indptr[u + 1]):
+            v = indices[e]
+            nd = d + weights[e]
+            if nd < dist[v]:
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return np.array(dist, dtype=np.float64)
+
+
+def _csr(n: int, u: np.ndarray, v: np.ndarray, *columns):
+    """CSR arrays of the edges u -> v (columns are sorted along)."""
+    order = np.lexsort((v, u))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(u, minlength=n), out=indptr[1:])
+    return (indptr, v[order].astype(np.int32)) + tuple(column[order] for column in columns)
+
+
+def select_landmarks(forward: tuple, backward: tuple, center: int, k: int):
+    """Farthest-point ALT landmarks and their distance tables.
+
+    Only the strongly connected part of the graph around the center node is
+    used; nodes outside it get infinite distances and are never snapped to.
+    """
+    forward_lists = [a.tolist() for a in forward]
+    backward_lists = [a.tolist() for a in backward]
+    from_center = _dijkstra(*forward_lists, center)
+    component = np.isfinite(from_center) & np.isfinite(_dijkstra(*backward_lists, center))
+
+    landmarks, lm_from, lm_to = [], [], []
+    coverage = np.where(component, from_center, -1.0)
+    for _ in range(k):
+        landmark = int(np.argmax(coverage))
+        if landmarks and coverage[landmark] <= 0:
+            break
+        landmarks.append(landmark)
+        lm_from.append(_dijkstra(*forward_lists, landmark))
+        lm_to.append(_dijkstra(*backward_lists, landmark))
+        # Next landmark: the node farthest from the center and all chosen ones
+        coverage = np.where(component, np.minimum(coverage, lm_from[-1]), -1.0)
+    return landmarks, np.array(lm_from, dtype=np.float32), np.array(lm_to, dtype=np.float32)
+
+
+def build(osm_path: str, out_dir: str = "data/osm", modes: list = None, landmarks: int = 8):
+    """Import an OSM extract and write the routing arrays to out_dir."""
+    modes = modes or list(MODE_SPEEDS)
+    print(f"Reading {osm_path}...")
+    nodes, ways, places = parse_osm(osm_path)
+
+    usable = {}
+    for refs, tags in ways:
+        directions = {mode: way_directions(tags, mode) for mode in modes}
+        if any(any(d) for d in directions.values()):
+            usable[id(tags)] = directions
+    used = sorted({ref for refs, tags in ways if id(tags) in usable for ref in refs if ref in nodes})
+    coords = np.array([nodes[ref] for ref in used], dtype=np.float64).reshape(-1, 2)
+
+    # Nodes are ordered by grid cell: snapping reads contiguous slices and
+    # nearby nodes are near in memory too
+    x, y = to_xy(coords[:, 0], coords[:, 1])
+    x0, y0 = float(x.min()), float(y.min())
+    cols = int((x.max() - x0) // GRID_CELL) + 1
+    rows = int((y.max() - y0) // GRID_CELL) + 1
+    cells = ((y - y0) // GRID_CELL).astype(np.int64) * cols + ((x - x0) // GRID_CELL).astype(np.int64)
+    order = np.argsort(cells, kind="stable")
+    coords, cells = coords[order], cells[order]
+    index_of = {used[old]: new for new, old in enumerate(order.tolist())}
+    cell_ptr = np.zeros(rows * cols + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells, minlength=rows * cols), out=cell_ptr[1:])
+    n = len(coords)
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "lat.npy"), coords[:, 0].astype(np.float32))
+    np.save(os.path.join(out_dir, "lng.npy"), coords[:, 1].astype(np.float32))
+    np.save(os.path.join(out_dir, "cell_ptr.npy"), cell_ptr)
+
+    street_names = []
+    name_ids = {}
+    for mode in modes:
+        u, v, names = [], [], []
+        for refs, tags in ways:
+            forward, backward = usable.get(id(tags), {}).get(mode, (False, False))
+            if not (forward or backward):
+                continue
+            name = tags.get("name")
+            if name is not None and name not in name_ids:
+                name_ids[name] = len(street_names)
+                street_names.append(name)
+            name_id = name_ids.get(name, -1)
+            path = [index_of[ref] for ref in refs if ref in index_of]
+            for a, b in zip(path, path[1:]):
+                if forward:
+                    u.append(a), v.append(b), names.append(name_id)
+                if backward:
+                    u.append(b), v.append(a), names.append(name_id)
+
+        u, v = np.array(u, dtype=np.int64), np.array(v, dtype=np.int64)
+        edge_length = haversine(coords[u, 0], coords[u, 1], coords[v, 0], coords[v, 1]).astype(np.float32)
+        indptr, indices, length, name = _csr(n, u, v, edge_length, np.array(names, dtype=np.int32))
+        reverse = _csr(n, v, u, edge_length)
+
+        # Landmarks are spread from the node closest to the middle of the graph
+        degree = np.diff(indptr)
+        middle = coords.mean(axis=0)
+        center = int(np.argmin(np.where(degree > 0, haversine(coords[:, 0], coords[:, 1], *middle), np.inf)))
+        print(f"  {mode}: {n} nodes, {len(indices)} edges, computing {landmarks} landmarks...")
+        _, lm_from, lm_to = select_landmarks((indptr, indices, length), reverse, center, landmarks)
+
+        for suffix, array in (("indptr", indptr), ("indices", indices), ("length", length), ("name", name),
+                              ("lm_from", lm_from), ("lm_to", lm_to)):
+            np.save(os.path.join(out_dir, f"{mode}_{suffix}.npy"), array)
+
+    with open(os.path.join(out_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "source": os.path.basename(osm_path),
+            "modes": modes,
+            "nodes": n,
+            "grid": {"x0": x0, "y0": y0, "cols": cols, "rows": rows, "cell_size": GRID_CELL},
+            "street_names": street_names,
+            "places": places
+        }, f, ensure_ascii=False)
+    print(f"Wrote {out_dir}")
+
+
+class OSMRouter:
+    """Read-only router over the built arrays (loaded lazily, memory-mapped)."""
+
+    def __init__(self, directory: str = "data/osm"):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.modes = []
+        self._graphs = {}
+        self._places = {}
+
+    def _load(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            index_path = os.path.join(self.directory, INDEX_FILE)
+            if os.path.exists(index_path):
+                with open(index_path, encoding="utf-8") as f:
+                    index = json.load(f)
+                self.grid = index["grid"]
+                self.street_names = index["street_names"]
+                for place in index["places"]:
+                    self._places.setdefault(normalize_place_name(place["name"]), (place["lat"], place["lng"]))
+                load = lambda name: np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode="r")
+                self.lat, self.lng, self.cell_ptr = load("lat"), load("lng"), load("cell_ptr")
+                for mode in index["modes"]:
+                    graph = {key: load(f"{mode}_{key}")
+                             for key in ("indptr", "indices", "length", "name", "lm_from", "lm_to")}
+                    # Nodes of the main connected part (reachable from and to the landmarks)
+                    graph["routable"] = np.isfinite(graph["lm_from"][0]) & np.isfinite(graph["lm_to"][0])
+                    self._graphs[mode] = graph
+                self.modes = list(self._graphs)
+            self._loaded = True
+
+    @property
+    def available(self) -> bool:
+        self._load()
+        return bool(self._graphs)
+
+    def locate(self, place: str):
+        """(lat, lng) of a place: "lat,lng" text, a landmark or a named OSM place."""
+        self._load()
+        match = COORDINATE_PATTERN.match(place)
+        if match:
+            return float(match.group(1)), float(match.group(2))
+        return travel_matrix.location_of(place) or self._places.get(normalize_place_name(place))
+
+    def snap(self, lat: float, lng: float, mode: str):
+        """Nearest routable node of the mode within SNAP_RADIUS, or None."""
+        graph = self._graphs[mode]
+        x, y = to_xy(lat, lng)
+        cx = int((float(x) - self.grid["x0"]) // self.grid["cell_size"])
+        cy = int((float(y) - self.grid["y0"]) // self.grid["cell_size"])
+        reach = int(math.ceil(SNAP_RADIUS / self.grid["cell_size"]))
+
+        candidates = []
+        for row in range(max(0, cy - reach), min(self.grid["rows"], cy + reach + 1)):
+            first = row * self.grid["cols"] + max(0, cx - reach)
+            last = row * self.grid["cols"] + min(self.grid["cols"] - 1, cx + reach)
+            if first <= last:
+                # The cells of a row are contiguous in the node order
+                candidates.append(np.arange(self.cell_ptr[first], self.cell_ptr[last + 1]))
+        if not candidates:
+            return None
+        candidates = np.concatenate(candidates)
+        candidates = candidates[graph["routable"][candidates]]
+        if not len(candidates):
+            return None
+        distances = haversine(lat, lng, self.lat[candidates], self.lng[candidates])
+        best = int(np.argmin(distances))
+        return int(candidates[best]) if distances[best] <= SNAP_RADIUS else None
+
+    def _potential(self, graph: dict, source: int, target: int) -> np.ndarray:
+        """ALT lower bounds of the distance to target for every node."""
+        lm_from, lm_to = graph["lm_from"], graph["lm_to"]
+        bounds = np.maximum(lm_from[:, target] - lm_from[:, source], lm_to[:, source] - lm_to[:, target])
+        active = np.argsort(-bounds)[:ACTIVE_LANDMARKS]
+        from_active = np.asarray(lm_from[active], dtype=np.float64)
+        to_active = np.asarray(lm_to[active], dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            potential = np.maximum(from_active[:, target, None] - from_active,
+                                   to_active - to_active[:, target, None]).max(axis=0)
+        return np.nan_to_num(np.maximum(potential, 0.0), nan=0.0, posinf=np.inf)
+
+    def shortest_path(self, source: int, target: int, mode: str):
+        """Edge indices of the shortest path (A* with ALT bounds), or None if unreachable."""
+        graph = self._graphs[mode]
+        indptr, indices, length = graph["indptr"], graph["indices"], graph["length"]
+        potential = self._potential(graph, source, target)
+
+        dist = {source: 0.0}
+        via = {}
+        closed = set()
+        heap = [(float(potential[source]), source)]
+        while heap:
+            _, u = heapq.heappop(heap)
+            if u == target:
+                break
+            if u in closed:
+                continue
+            closed.add(u)
+            du = dist[u]
+            first, last = int(indptr[u]), int(indptr[u + 1])
+            for edge, (v, w) in enumerate(zip(indices[first:last].tolist(), length[first:last].tolist()), first):
+                nd = du + w
+                if nd < dist.get(v, math.inf):
+                    h = potential[v]
+                    if h == math.inf:
+                        continue
+                    dist[v] = nd
+                    via[v] = edge
+                    heapq.heappush(heap, (nd + float(h), v))
+        metrics.observe("osm_router.settled_nodes", len(closed))
+        if target not in dist:
+            return None
+
+        edges = []
+        node = target
+        while node != source:
+            edge = via[node]
+            edges.append(edge)
+            # The tail of an edge is the node whose CSR slice contains it
+            node = int(np.searchsorted(indptr, edge, side="right") - 1)
+        return edges[::-1]
+
+    def _step(self, mode: str, name: int, nodes: list, meters: float) -> dict:
+        street = self.street_names[name] if name >= 0 else None
+        seconds = meters / MODE_SPEEDS[mode]
+        points = np.column_stack((self.lat[nodes], self.lng[nodes])).astype(np.float64)
+        return {
+            "travel_mode": mode.upper(),
+            "html_instructions": f"Haladj a(z) <b>{street}</b> mentén" if street else "Haladj tovább",
+            "distance": {"value": int(round(meters)), "text": format_distance(meters)},
+            "duration": {"value": int(round(seconds)), "text": format_duration(seconds)},
+            "start_location": {"lat": float(points[0, 0]), "lng": float(points[0, 1])},
+            "end_location": {"lat": float(points[-1, 0]), "lng": float(points[-1, 1])},
+            "polyline": {"points": encode_polyline(points)}
+        }
+
+    def directions(self, from_place: str, to_place: str, mode: str = "walking"):
+        """Route between two places in the Directions API response shape, or None.
+
+        None means the router cannot answer (unknown mode or place, nothing
+        routable nearby, unreachable); the caller then uses the Directions API.
+        """
+        self._load()
+        if mode not in self._graphs:
+            return None
+        start, end = self.locate(from_place), self.locate(to_place)
+        if start is None or end is None:
+            metrics.inc("osm_router.unknown_place")
+            return None
+        source, target = self.snap(*start, mode), self.snap(*end, mode)
+        if source is None or target is None:
+            metrics.inc("osm_router.no_snap")
+            return None
+
+        edges = self.shortest_path(source, target, mode) if source != target else []
+        if edges is None:
+            metrics.inc("osm_router.unreachable")
+            return None
+        metrics.inc("osm_router.routes")
+
+        graph = self._graphs[mode]
+        targets = graph["indices"][edges].tolist() if edges else []
+        lengths = graph["length"][edges].tolist() if edges else []
+        names = graph["name"][edges].tolist() if edges else []
+
+        # Consecutive edges of the same street form one step
+        steps = []
+        nodes, meters = [source], 0.0
+        for k, (node, meters_k, name) in enumerate(zip(targets, lengths, names)):
+            nodes.append(node)
+            meters += meters_k
+            if k + 1 == len(names) or names[k + 1] != name:
+                steps.append(self._step(mode, name, nodes, meters))
+                nodes, meters = [node], 0.0
+
+        total = sum(lengths)
+        seconds = total / MODE_SPEEDS[mode]
+        path = [source] + targets
+        overview = np.column_stack((self.lat[path], self.lng[path])).astype(np.float64)
+        named = [self.street_names[n] for n in names if n >= 0]
+        return {
+            "status": "OK",
+            "source": "local osm router",
+            "routes": [{
+                "summary": max(set(named), key=named.count) if named else "",
+                "copyrights": "© OpenStreetMap contributors",
+                "overview_polyline": {"points": encode_polyline(overview)},
+                "legs": [{
+                    "start_address": from_place,
+                    "end_address": to_place,
+                    "start_location": {"lat": float(overview[0, 0]), "lng": float(overview[0, 1])},
+                    "end_location": {"lat": float(overview[-1, 0]), "lng": float(overview[-1, 1])},
+                    "distance": {"value": int(round(total)), "text": format_distance(total)},
+                    "duration": {"value": int(round(seconds)), "text": format_duration(seconds)},
+                    "steps": steps
+                }]
+            }]
+        }
+
+
+# Shared instance used by get_directions
+osm_router = OSMRouter(os.getenv("OSM_ROUTER_DIR", "data/osm"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenStreetMap walking/bicycling router")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Import an OSM XML extract")
+    build_parser.add_argument("osm_file")
+    build_parser.add_argument("--out", default="data/osm")
+    build_parser.add_argument("--modes", nargs="+", default=list(MODE_SPEEDS))
+    build_parser.add_argument("--landmarks", type=int, default=8)
+
+    route_parser = subparsers.add_parser("route", help="Route between two places")
+    route_parser.add_argument("from_place")
+    route_parser.add_argument("to_place")
+    route_parser.add_argument("--mode", default="walking")
+    route_parser.add_argument("--dir", default="data/osm")
+
+    bench_parser = subparsers.add_parser("bench", help="Time random queries")
+    bench_parser.add_argument("--mode", default="walking")
+    bench_parser.add_argument("--queries", type=int, default=100)
+    bench_parser.add_argument("--dir", default="data/osm")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build(args.osm_file, args.out, args.modes, args.landmarks)
+    elif args.command == "route":
+        route = OSMRouter(args.dir).directions(args.from_place, args.to_place, args.mode)
+        if route is None:
+            print("No local route")
+        else:
+            leg = route["routes"][0]["legs"][0]
+            print(f"{leg['distance']['text']}, {leg['duration']['text']}")
+            for step in leg["steps"]:
+                print(f"  {re.sub('<[^>]+>', '', step['html_instructions'])} ({step['distance']['text']})")
+    else:
+        import time
+
+        router = OSMRouter(args.dir)
+        router._load()
+        graph = router._graphs[args.mode]
+        nodes = np.flatnonzero(graph["routable"])
+        rng = np.random.default_rng(0)
+        pairs = rng.choice(nodes, size=(args.queries, 2))
+        start = time.perf_counter()
+        for source, target in pairs.tolist():
+            router.shortest_path(source, target, args.mode)
+        elapsed = time.perf_counter() - start
+        print(f"{args.mode}: {args.queries} queries, {1000 * elapsed / args.queries:.1f} ms/query "
+              f"over {len(router.lat)} nodes")
@@ -0,0 +1,305 @@
+# poi_index.py
+# Local store of known Budapest POIs with a grid spatial index
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# The store is fed from Places results and from an optional bulk dataset
+# (POI_DATASET environment variable, JSON / JSONL / CSV), and answers
+# k-nearest and radius queries without calling the Places API. POIs found
+# by the API remember when they were seen, so the local tier can leave out
+# stale entries. Dataset rows are dated by their own "updated" column (Unix
+# time or ISO date); rows without it are curated data that never go stale.
+
+import os
+import csv
+import json
+import math
+import time
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from metrics import metrics
+
+# Projection center (Deák Ferenc tér); an equirectangular projection is
+# accurate to well below a meter within the city
+REF_LAT = 47.4979
+REF_LNG = 19.0541
+METERS_PER_DEG_LAT = 111320.0
+METERS_PER_DEG_LNG = 111320.0 * math.cos(math.radians(REF_LAT))
+
+
+def _rating(value):
+    """Numeric rating (CSV rows carry it as text), or "N/A"."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return "N/A"
+
+
+def _timestamp(value):
+    """Unix time of an 'updated' field (number or ISO date), or None if empty or unreadable."""
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return None
+
+
+def to_xy(lat, lng):
+    """Project coordinates (scalars or arrays) to local meters."""
+    return (np.asarray(lng, dtype=np.float64) - REF_LNG) * METERS_PER_DEG_LNG, \
+           (np.asarray(lat, dtype=np.float64) - REF_LAT) * METERS_PER_DEG_LAT
+
+
+class POIStore:
+    """Known POIs indexed by a uniform grid over NumPy coordinate arrays.
+
+    Points are sorted by grid cell, so every cell is a contiguous slice of
+    the index arrays (CSR layout). The index is rebuilt lazily on the first
+    query after new POIs were added.
+    """
+
+    def __init__(self, cell_size: float = 250.0):
+        """cell_size is the grid cell edge in meters."""
+        self.cell_size = cell_size
+        self._pois = {}
+        self._lock = threading.Lock()
+        self._index = None
+
+    def __len__(self):
+        return len(self._pois)
+
+    def add(self, place: dict, dated: bool = True):
+        """Add or refresh one POI (its types are merged with the known ones).
+
+        The place needs 'name' and either 'location': {'lat', 'lng'} or
+        'lat'/'lng'. 'place_id', 'types', 'rating', 'user_ratings_total'
+        and 'address' are kept when present. The place is dated by its own
+        'updated' field, otherwise by now - or left undated (never stale)
+        if dated is false.
+        """
+        location = place.get("location") or {}
+        lat = location.get("lat", place.get("lat"))
+        lng = location.get("lng", place.get("lng"))
+        if lat is None or lng is None or not place.get("name"):
+            return
+
+        types = place.get("types") or []
+        if isinstance(types, str):
+            types = [t for t in types.split("|") if t]
+        if place.get("category") and place["category"] not in types:
+            types = types + [place["category"]]
+
+        poi = {
+            "place_id": place.get("place_id") or place["name"],
+            "name": place["name"],
+            "lat": float(lat),
+            "lng": float(lng),
+            "types": list(types),
+            "rating": _rating(place.get("rating")),
+            "user_ratings_total": int(place.get("user_ratings_total") or 0),
+            "address": place.get("address") or place.get("vicinity"),
+            "updated": _timestamp(place.get("updated")) or (time.time() if dated else None)
+        }
+        with self._lock:
+            known = self._pois.get(poi["place_id"])
+            if known is not None:
+                # Keep the types the place was found under in earlier searches
+                poi["types"] += [t for t in known["types"] if t not in poi["types"]]
+            self._pois[poi["place_id"]] = poi
+            self._index = None
+
+    def add_many(self, places, dated: bool = True):
+        for place in places:
+            self.add(place, dated)
+
+    def load_dataset(self, path: str) -> int:
+        """Import POIs from a JSON array, JSONL or CSV file. Returns the number read.
+
+        Rows without an 'updated' field stay undated: the local tier always uses them.
+        """
+        if path.endswith(".csv"):
+            with open(path, newline="", encoding="utf-8") as f:
+                places = list(csv.DictReader(f))
+        elif path.endswith(".jsonl"):
+            with open(path, encoding="utf-8") as f:
+                places = [json.loads(line) for line in f if line.strip()]
+        else:
+            with open(path, encoding="utf-8") as f:
+                places = json.load(f)
+
+        self.add_many(places, dated=False)
+        return len(places)
+
+    def save(self, path: str):
+        """Write all known POIs as a JSON array (readable by load_dataset)."""
+        with self._lock:
+            pois = list(self._pois.values())
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(pois, f, ensure_ascii=False)
+
+    def _build(self):
+        with self._lock:
+            if self._index is not None:
+                return self._index
+            pois = list(self._pois.values())
+
+            x, y = to_xy([p["lat"] for p in pois], [p["lng"] for p in pois])
+            cx = np.floor(x / self.cell_size).astype(np.int64)
+            cy = np.floor(y / self.cell_size).astype(np.int64)
+            order = np.lexsort((cy, cx))
+
+            cells = {}
+            if len(pois):
+                sorted_cx, sorted_cy = cx[order], cy[order]
+                # Boundaries where the cell changes in the sorted order
+                breaks = np.flatnonzero((np.diff(sorted_cx) != 0) | (np.diff(sorted_cy) != 0)) + 1
+                starts = np.concatenate(([0], breaks))
+                ends = np.concatenate((breaks, [len(order)]))
+                for start, end in zip(starts.tolist(), ends.tolist()):
+                    cells[(int(sorted_cx[start]), int(sorted_cy[start]))] = (start, end)
+
+            type_index = {}
+            for position, poi_index in enumerate(order.tolist()):
+                for place_type in pois[poi_index]["types"]:
+                    type_index.setdefault(place_type, []).append(position)
+            type_masks = {}
+            for place_type, positions in type_index.items():
+                mask = np.zeros(len(order), dtype=bool)
+                mask[positions] = True
+                type_masks[place_type] = mask
+
+            self._index = {
+                "pois": [pois[i] for i in order.tolist()],
+                "x": x[order],
+                "y": y[order],
+                "cells": cells,
+                "type_masks": type_masks
+            }
+            return self._index
+
+    def _candidates(self, index, x, y, reach):
+        """Positions of the points in the cells overlapping the square around (x, y)."""
+        x0, x1 = int(math.floor((x - reach) / self.cell_size)), int(math.floor((x + reach) / self.cell_size))
+        y0, y1 = int(math.floor((y - reach) / self.cell_size)), int(math.floor((y + reach) / self.cell_size))
+        cells = index["cells"]
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(cells):
+            # Cheaper to scan the occupied cells than the whole square
+            slices = [range(*span) for (cx, cy), span in cells.items() if x0 <= cx <= x1 and y0 <= cy <= y1]
+        else:
+            slices = [range(*cells[(cx, cy)]) for cx in range(x0, x1 + 1)
+                      for cy in range(y0, y1 + 1) if (cx, cy) in cells]
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(r.start, r.stop) for r in slices])
+
+    def _filter(self, index, positions, category):
+        if category is None or not len(positions):
+            return positions
+        mask = index["type_masks"].get(category)
+        if mask is None:
+            return np.empty(0, dtype=np.int64)
+        return positions[mask[positions]]
+
+    def radius_query(self, lat: float, lng: float, radius: float, category: str = None) -> list:
+        """POIs within `radius` meters, nearest first, as (poi, distance_m) pairs."""
+        index = self._build()
+        x, y = to_xy(lat, lng)
+        positions = self._filter(index, self._candidates(index, float(x), float(y), radius), category)
+        distances = np.hypot(index["x"][positions] - x, index["y"][positions] - y)
+        inside = distances <= radius
+        positions, distances = positions[inside], distances[inside]
+        order = np.argsort(distances, kind="stable")
+        return [(index["pois"][p], float(d)) for p, d in zip(positions[order].tolist(), distances[order].tolist())]
+
+    def nearest(self, lat: float, lng: float, k: int = 5, category: str = None, max_radius: float = 5000) -> list:
+        """The k nearest POIs within max_radius meters as (poi, distance_m) pairs."""
+        index = self._build()
+        x, y = to_xy(lat, lng)
+        reach = self.cell_size
+        while True:
+            positions = self._filter(index, self._candidates(index, float(x), float(y), reach), category)
+            distances = np.hypot(index["x"][positions] - x, index["y"][positions] - y)
+            # Every point within `reach` is guaranteed to be among the candidates
+            found = np.count_nonzero(distances <= min(reach, max_radius))
+            if found >= k or reach >= max_radius:
+                break
+            reach = min(reach * 2, max_radius)
+
+        keep = distances <= max_radius
+        positions, distances = positions[keep], distances[keep]
+        order = np.argsort(distances, kind="stable")[:k]
+        return [(index["pois"][p], float(d)) for p, d in zip(positions[order].tolist(), distances[order].tolist())]
+
+    def local_places(self, lat: float, lng: float, place_type: str, radius: float, minimum: int,
+                     max_age: float = None):
+        """Places answering a Nearby Search from the store, or None if it knows too few.
+
+        Used as the first tier before the Places API. With max_age (seconds)
+        only places seen within that window (and undated dataset rows)
+        count; the API results of a fallback refresh the store.
+        """
+        matches = self.radius_query(lat, lng, radius, category=place_type)
+        if max_age is not None:
+            oldest = time.time() - max_age
+            fresh = [(poi, distance) for poi, distance in matches if poi["updated"] is None or poi["updated"] >= oldest]
+            if len(fresh) < len(matches):
+                metrics.inc("poi_index.stale", len(matches) - len(fresh))
+            matches = fresh
+        if len(matches) < minimum:
+            metrics.inc("poi_index.misses")
+            return None
+        metrics.inc("poi_index.hits")
+        return [
+            {
+                "place_id": poi["place_id"],
+                "name": poi["name"],
+                "rating": poi["rating"],
+                "user_ratings_total": poi["user_ratings_total"],
+                "address": poi["address"],
+                "open_now": "unknown",  # Opening state is not cached
+                "location": {"lat": poi["lat"], "lng": poi["lng"]},
+                "types": poi["types"],
+                "distance_m": distance
+            }
+            for poi, distance in matches
+        ]
+
+
+# Shared store of the process
+poi_store = POIStore()
+if os.getenv("POI_DATASET") and os.path.exists(os.getenv("POI_DATASET")):
+    poi_store.load_dataset(os.getenv("POI_DATASET"))
+
+
+if __name__ == "__main__":
+    # Quick benchmark on random points around the city center
+    store = POIStore()
+    rng = np.random.default_rng(0)
+    categories = ["tourist_attraction", "restaurant", "cafe", "museum", "park"]
+    for i in range(5000):
+        store.add({
+            "place_id": f"poi{i}",
+            "name": f"POI {i}",
+            "lat": REF_LAT + rng.normal(0, 0.03),
+            "lng": REF_LNG + rng.normal(0, 0.04),
+            "types": [categories[i % len(categories)]]
+        })
+    store.nearest(REF_LAT, REF_LNG)  # Build the index
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        store.nearest(REF_LAT + rng.normal(0, 0.02), REF_LNG + rng.normal(0, 0.02), k=5, category="museum")
+    print(f"k-nearest: {(time.perf_counter() - start) * 1000:.1f} µs/query")
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        store.radius_query(REF_LAT + rng.normal(0, 0.02), REF_LNG + rng.normal(0, 0.02), 1000, category="restaurant")
+    print(f"radius: {(time.perf_counter() - start) * 1000:.1f} µs/query")
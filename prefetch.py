@@ -0,0 +1,195 @@
+# prefetch.py
+# Speculative tool prefetch while the agent is still planning
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# Before the reasoning model has answered we can often guess the first tool
+# call: a message naming two known places almost always leads to a
+# directions_tool call between them. The guessed calls run in the
+# background and their results wait in a per-turn cache; if the model then
+# asks for the same call (same canonical arguments) the result is served
+# from there, otherwise it is thrown away at the end of the turn.
+
+import os
+import re
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from metrics import metrics
+from travel_matrix import normalize_place_name
+
+LANDMARKS_PATH = os.getenv(
+    "LANDMARKS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "landmarks.json")
+)
+
+# Entries of turns that never finished (e.g. errors) are dropped after this
+TURN_TTL = 600
+
+# Words hinting at the transport mode or at a duration-only question
+# (whole words of the normalized text; "autobusz" is a bus, "bring" is not a bike)
+MODE_KEYWORDS = {
+    "walking": r"\b(gyalog\w*|seta\w*|walk|walks|walking)\b",
+    "bicycling": r"\b(bicikli\w*|kerekpar\w*|bringa\w*|bike|bikes|biking|bicycle\w*|cycling)\b",
+    "driving": r"\b(auto(val|t|m|mmal)?|kocsi\w*|car|cars|drive|driving)\b"
+}
+SUMMARY_KEYWORDS = r"\b(mennyi ido\w*|meddig tart\w*|milyen messze|how long|how far)\b"
+
+
+class Gazetteer:
+    """Known place names (the landmark list) found in free text."""
+
+    def __init__(self, path: str = LANDMARKS_PATH):
+        self.path = path
+        self._patterns = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._patterns is None:
+                names = []
+                if os.path.exists(self.path):
+                    with open(self.path, encoding="utf-8") as f:
+                        for landmark in json.load(f):
+                            for alias in [landmark["name"]] + landmark.get("aliases", []):
+                                normalized = normalize_place_name(alias)
+                                if normalized:
+                                    names.append((normalized, landmark["name"]))
+                # Longest names first, so "keleti palyaudvar" wins over "keleti"
+                names.sort(key=lambda item: -len(item[0]))
+                # Hungarian suffixes are allowed after the name (Parlamenthez, Keletiből)
+                self._patterns = [(re.compile(r"\b" + re.escape(alias) + r"[a-z]*\b"), name)
+                                  for alias, name in names]
+        return self._patterns
+
+    def canonical(self, text: str) -> str:
+        """Landmark name for a known alias, else the normalized text."""
+        normalized = normalize_place_name(text)
+        for pattern, name in self._load():
+            if pattern.fullmatch(normalized):
+                return name
+        return normalized
+
+    def mentions(self, text: str) -> list:
+        """Landmarks mentioned in the text, in order of appearance."""
+        normalized = normalize_place_name(text)
+        taken = []
+        found = []
+        for pattern, name in self._load():
+            for match in pattern.finditer(normalized):
+                span = match.span()
+                if any(span[0] < end and start < span[1] for start, end in taken):
+                    continue
+                taken.append(span)
+                found.append((span[0], name))
+        ordered = []
+        for _, name in sorted(found):
+            if name not in ordered:
+                ordered.append(name)
+        return ordered
+
+    def canonicalize(self, text: str) -> str:
+        """Normalized text with every landmark alias (and its suffix) replaced by the landmark name."""
+        normalized = normalize_place_name(text)
+        for pattern, name in self._load():
+            normalized = pattern.sub(normalize_place_name(name), normalized)
+        return normalized
+
+
+gazetteer = Gazetteer()
+
+
+def predict_tool_calls(text: str) -> list:
+    """Guess the first tool calls for a user message as [{"name", "args"}]."""
+    places = gazetteer.mentions(text)
+    if len(places) < 2:
+        return []
+
+    normalized = normalize_place_name(text)
+    mode = "transit"
+    for candidate, pattern in MODE_KEYWORDS.items():
+        if re.search(pattern, normalized):
+            mode = candidate
+            break
+    return [{
+        "name": "directions_tool",
+        "args": {
+            "from_place": places[0],
+            "to_place": places[1],
+            "mode": mode,
+            "summary_only": bool(re.search(SUMMARY_KEYWORDS, normalized))
+        }
+    }]
+
+
+def canonical_args(tool, args: dict) -> str:
+    """Comparable form of tool arguments: defaults filled in, place names canonical."""
+    full = {}
+    schema = getattr(tool, "args_schema", None)
+    if schema is not None and hasattr(schema, "model_fields"):
+        full = {key: field.default for key, field in schema.model_fields.items() if not field.is_required()}
+    full.update(args)
+    return json.dumps(
+        {key: gazetteer.canonical(value) if isinstance(value, str) else value for key, value in full.items()},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+
+
+class PrefetchCache:
+    """Background tool results of the current turn, keyed by (thread, turn)."""
+
+    def __init__(self, max_workers: int = 4):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._turns = {}
+        self._lock = threading.Lock()
+
+    def start(self, turn_key, tools: dict, calls: list, runner):
+        """Start the predicted calls; runner(call) executes one like take_action does."""
+        self._expire()
+        entries = {}
+        for call in calls:
+            tool = tools.get(call["name"])
+            if tool is None:
+                continue
+            # Copy the context so the priority and deadline of the request apply
+            future = self._pool.submit(copy_context().run, runner, call)
+            entries[(call["name"], canonical_args(tool, call["args"]))] = future
+            metrics.inc("prefetch.started")
+        if entries:
+            with self._lock:
+                self._turns[turn_key] = (time.monotonic(), entries)
+
+    def take(self, turn_key, tool, name: str, args: dict):
+        """Future of a matching prefetched call (removed from the cache), or None."""
+        with self._lock:
+            turn = self._turns.get(turn_key)
+            if turn is None:
+                return None
+            future = turn[1].pop((name, canonical_args(tool, args)), None)
+        if future is not None:
+            metrics.inc("prefetch.hits")
+        else:
+            metrics.inc("prefetch.misses")
+        return future
+
+    def finish(self, turn_key):
+        """Drop what the turn did not use; unused results count as waste."""
+        with self._lock:
+            turn = self._turns.pop(turn_key, None)
+        if turn:
+            self._discard(turn[1])
+
+    def _discard(self, entries: dict):
+        for future in entries.values():
+            future.cancel()
+            metrics.inc("prefetch.wasted")
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            stale = [key for key, (started, _) in self._turns.items() if now - started > TURN_TTL]
+            expired = [self._turns.pop(key)[1] for key in stale]
+        for entries in expired:
+            self._discard(entries)
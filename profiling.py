@@ -0,0 +1,165 @@
+# profiling.py
+# On-demand profiling of agent turns, itineraries and evaluator runs
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# pyinstrument (a sampling profiler, listed in requirements.txt) is used; it
+# gives an interactive HTML call tree. If it is missing the standard library
+# cProfile is the fallback. Both are reduced to the same report: the top
+# functions by own time and the own time grouped by where it was spent
+# (network, LangGraph/LangChain, serialization, Streamlit, our code...).
+# Only the calling thread is profiled: work handed to pool threads
+# (prefetch, hedged requests) shows up as waiting on threads.
+
+import os
+import io
+import re
+import time
+import cProfile
+import pstats
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Where the time went, by the file path (or for built-ins the name) of the function; first match wins
+CATEGORIES = [
+    ("network", ("requests", "urllib3", "http", "ssl", "_ssl", "socket", "_socket", "select", "selectors",
+                 "httpx", "httpcore", "openai", "anyio")),
+    ("threads", ("concurrent", "threading", "queue", "_thread", "lock")),
+    ("langgraph / langchain", ("langgraph", "langchain", "langsmith")),
+    ("serialization", ("json", "_json", "pydantic", "pydantic_core", "copy", "pickle", "ormsgpack", "msgpack")),
+    ("streamlit", ("streamlit", "tornado", "pyarrow", "altair")),
+    ("numpy", ("numpy",)),
+    ("sqlite", ("sqlite3",))
+]
+
+
+def categorize(path: str, function: str = "") -> str:
+    """Category of a function by its source file (built-ins by their name)."""
+    normalized = (path or "").replace("\\", "/")
+    if normalized.startswith(PROJECT_DIR.replace("\\", "/")) and "site-packages" not in normalized:
+        return "app"
+    parts = set(re.split(r"[^a-z0-9_]+", (normalized + " " + (function or "")).lower()))
+    for category, packages in CATEGORIES:
+        if parts & set(packages):
+            return category
+    return "other"
+
+
+def _report(engine: str, duration: float, functions: list, text: str, html: str = None,
+            attributions: list = None) -> dict:
+    """Common report of both profilers; functions are dicts with own/total time.
+
+    attributions are (file, function, seconds) for the category breakdown,
+    by default the own time of every function.
+    """
+    if attributions is None:
+        attributions = [(f["file"], f["function"], f["self"]) for f in functions]
+    categories = {}
+    for path, function, seconds in attributions:
+        category = categorize(path, function)
+        categories[category] = categories.get(category, 0.0) + seconds
+    top = sorted(functions, key=lambda f: f["self"], reverse=True)[:30]
+    return {
+        "engine": engine,
+        "duration": duration,
+        "categories": dict(sorted(categories.items(), key=lambda item: -item[1])),
+        "top": top,
+        "text": text,
+        "html": html
+    }
+
+
+def _pyinstrument_functions(frame, functions: dict):
+    """Own and total time per function over the pyinstrument call tree."""
+    if frame is None:
+        return
+    key = (frame.function, frame.file_path, frame.line_no)
+    entry = functions.setdefault(key, {"function": frame.function, "file": frame.file_path or "",
+                                       "line": frame.line_no, "self": 0.0, "total": 0.0, "calls": None})
+    entry["self"] += frame.self_time
+    entry["total"] += frame.time
+    for child in frame.children:
+        _pyinstrument_functions(child, functions)
+
+
+def profile_call(fn, *args, engine: str = None, **kwargs):
+    """Run fn(*args, **kwargs) under a profiler; returns (result, report).
+
+    engine is "pyinstrument" or "cprofile" (default: pyinstrument when installed).
+    If fn raises, the exception propagates and the profile is lost.
+    """
+    engine = engine or ("pyinstrument" if Profiler is not None else "cprofile")
+    start = time.perf_counter()
+
+    if engine == "pyinstrument":
+        profiler = Profiler(interval=0.001)
+        profiler.start()
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            profiler.stop()
+        duration = time.perf_counter() - start
+        functions = {}
+        _pyinstrument_functions(profiler.last_session.root_frame(), functions)
+        report = _report(engine, duration, list(functions.values()),
+                         profiler.output_text(unicode=True, color=False), profiler.output_html())
+        return result, report
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+    duration = time.perf_counter() - start
+
+    stats = pstats.Stats(profiler)
+    functions = []
+    attributions = []
+    for (path, line, name), (_, calls, tottime, cumtime, callers) in stats.stats.items():
+        functions.append({"function": name, "file": path, "line": line, "self": tottime, "total": cumtime,
+                          "calls": calls})
+        if path == "~" and categorize(path, name) == "other" and callers:
+            # Generic built-ins (sleep, len...) count where they were called from,
+            # e.g. time.sleep in the OpenAI client's retry loop is network time
+            for (caller_path, _, caller_name), caller_stats in callers.items():
+                attributions.append((caller_path, caller_name, caller_stats[2]))
+        else:
+            attributions.append((path, name, tottime))
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(40)
+    report = _report(engine, duration, functions, text.getvalue(), attributions=attributions)
+    report["stats"] = profiler
+    return result, report
+
+
+def save_report(report: dict, path_base: str) -> list:
+    """Write a report next to path_base (.html or .prof, plus .txt); returns the written files."""
+    os.makedirs(os.path.dirname(path_base) or ".", exist_ok=True)
+    written = []
+    if report.get("html"):
+        with open(path_base + ".html", "w", encoding="utf-8") as f:
+            f.write(report["html"])
+        written.append(path_base + ".html")
+    if report.get("stats") is not None:
+        # Viewable as a flame graph with e.g. snakeviz or flameprof
+        report["stats"].dump_stats(path_base + ".prof")
+        written.append(path_base + ".prof")
+    with open(path_base + ".txt", "w", encoding="utf-8") as f:
+        f.write(format_categories(report) + "\n\n" + report["text"])
+    written.append(path_base + ".txt")
+    return written
+
+
+def format_categories(report: dict) -> str:
+    """One line per category: own time and share of the profiled duration."""
+    total = sum(report["categories"].values()) or 1.0
+    lines = [f"{report['engine']}: {report['duration']:.2f} s"]
+    for category, seconds in report["categories"].items():
+        lines.append(f"  {category:<24} {seconds:7.3f} s  {100 * seconds / total:5.1f}%")
+    return "\n".join(lines)
@@ -0,0 +1,231 @@
+# route_geometry.py
+# Route geometry: polyline decoding, simplification and map rendering
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# The Directions API describes every step with an encoded polyline
+# (Google's polyline algorithm, 1e-5 degree precision). The geometry is
+# decoded into (n, 2) NumPy arrays of [lat, lng], simplified with the
+# Douglas–Peucker algorithm at a tolerance matching the map zoom level,
+# and kept out of the LLM prompt: the tools hand it to the UI as an
+# artifact, which draws it with pydeck.
+
+import copy
+import math
+
+import numpy as np
+
+# Default map view (Deák Ferenc tér)
+DEFAULT_CENTER = (47.4979, 19.0541)
+DEFAULT_ZOOM = 14
+
+# Colors of the route legs by transport mode (RGB)
+MODE_COLORS = {
+    "transit": [0, 114, 206],
+    "walking": [46, 160, 67],
+    "bicycling": [230, 126, 34],
+    "driving": [192, 57, 43]
+}
+
+
+def decode_polyline(encoded: str) -> np.ndarray:
+    """Decode an encoded polyline into an (n, 2) array of [lat, lng]."""
+    if not encoded:
+        return np.empty((0, 2))
+    chunks = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+
+    # Every value is a run of 5-bit chunks; the last chunk has no continuation bit
+    ends = np.flatnonzero((chunks & 0x20) == 0)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    position = np.arange(len(chunks)) - np.repeat(starts, ends - starts + 1)
+    values = np.add.reduceat((chunks & 0x1F) << (5 * position), starts)
+
+    # Zigzag sign decoding, then the deltas are summed up
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(values[:len(values) // 2 * 2].reshape(-1, 2), axis=0) / 1e5
+
+
+def encode_polyline(points) -> str:
+    """Encode [lat, lng] points with the polyline algorithm (inverse of decode_polyline)."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if not len(points):
+        return ""
+    rounded = np.round(points * 1e5).astype(np.int64)
+    deltas = np.diff(rounded, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    out = []
+    for value in values.tolist():
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1F)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+    return "".join(out)
+
+
+def tolerance_for_zoom(zoom: float, latitude: float = DEFAULT_CENTER[0], pixels: float = 1.0) -> float:
+    """Simplification tolerance (meters) that stays below `pixels` on a web map at `zoom`."""
+    meters_per_pixel = 156543.03392 * math.cos(math.radians(latitude)) / 2 ** zoom
+    return pixels * meters_per_pixel
+
+
+def _to_meters(points: np.ndarray) -> np.ndarray:
+    """Local equirectangular projection (accurate within a city)."""
+    latitude = math.radians(float(points[:, 0].mean()))
+    return np.column_stack((
+        points[:, 1] * 111320.0 * math.cos(latitude),
+        points[:, 0] * 111320.0
+    ))
+
+
+def simplify(points, tolerance_m: float) -> np.ndarray:
+    """Douglas–Peucker simplification of a [lat, lng] path with a tolerance in meters."""
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    if n < 3 or tolerance_m <= 0:
+        return points
+
+    xy = _to_meters(points)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    # Explicit stack instead of recursion; each segment is checked in one vectorized step
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = xy[first], xy[last]
+        inner = xy[first + 1:last]
+        direction = end - start
+        length = math.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(inner[:, 0] - start[0], inner[:, 1] - start[1])
+        else:
+            # Perpendicular distance from the chord
+            distances = np.abs(direction[0] * (inner[:, 1] - start[1])
+                               - direction[1] * (inner[:, 0] - start[0])) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+
+def leg_path(leg: dict) -> np.ndarray:
+    """Full-detail geometry of a Directions leg (its step polylines joined)."""
+    parts = [decode_polyline(step.get("polyline", {}).get("points", "")) for step in leg.get("steps", [])]
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return np.empty((0, 2))
+    # Consecutive steps share their end/start point
+    return np.concatenate([parts[0]] + [part[1:] for part in parts[1:]])
+
+
+def directions_paths(directions: dict, mode: str = "transit", zoom: float = DEFAULT_ZOOM) -> list:
+    """Simplified leg geometries of a Directions response for the map.
+
+    Paths are lists of [lng, lat] (the order pydeck expects).
+    """
+    paths = []
+    tolerance = tolerance_for_zoom(zoom)
+    for route in directions.get("routes", [])[:1]:
+        for leg in route.get("legs", []):
+            path = leg_path(leg)
+            if not len(path):
+                path = decode_polyline(route.get("overview_polyline", {}).get("points", ""))
+            path = simplify(path, tolerance)
+            paths.append({
+                "from": leg.get("start_address"),
+                "to": leg.get("end_address"),
+                "mode": mode,
+                "path": path[:, ::-1].round(6).tolist()
+            })
+    return paths
+
+
+def compact_directions(directions: dict) -> dict:
+    """Copy of a Directions response without the polylines (they are only for the map)."""
+    compact = copy.deepcopy(directions)
+
+    def strip(steps):
+        for step in steps:
+            step.pop("polyline", None)
+            strip(step.get("steps", []))
+
+    for route in compact.get("routes", []):
+        route.pop("overview_polyline", None)
+        for leg in route.get("legs", []):
+            strip(leg.get("steps", []))
+    return compact
+
+
+def route_deck(paths: list, points: list = None, zoom: float = DEFAULT_ZOOM):
+    """pydeck map of route legs (directions_paths format) and POIs.
+
+    points are dicts with 'name', 'lat' and 'lng'.
+    """
+    import pydeck as pdk
+
+    points = points or []
+    coordinates = [c for p in paths for c in p["path"]] + [[p["lng"], p["lat"]] for p in points]
+    if coordinates:
+        lng, lat = np.asarray(coordinates, dtype=np.float64).mean(axis=0)
+    else:
+        lat, lng = DEFAULT_CENTER
+
+    layers = [
+        pdk.Layer(
+            "PathLayer",
+            data=[dict(p, color=MODE_COLORS.get(p["mode"], MODE_COLORS["transit"]),
+                       name=f"{p.get('from') or ''} → {p.get('to') or ''}") for p in paths],
+            get_path="path",
+            get_color="color",
+            width_min_pixels=4,
+            pickable=True
+        ),
+        pdk.Layer(
+            "ScatterplotLayer",
+            data=points,
+            get_position="[lng, lat]",
+            get_fill_color=[220, 20, 60],
+            get_radius=40,
+            radius_min_pixels=5,
+            pickable=True
+        )
+    ]
+    return pdk.Deck(
+        layers=layers,
+        initial_view_state=pdk.ViewState(latitude=float(lat), longitude=float(lng), zoom=zoom),
+        tooltip={"text": "{name}"},
+        map_style=None
+    )
+
+
+if __name__ == "__main__":
+    # Benchmark: a long itinerary of 40 legs, 2000 points each
+    import time
+
+    rng = np.random.default_rng(0)
+    legs = []
+    for _ in range(40):
+        steps = rng.normal(0, 2e-5, (2000, 2)) + np.array([4e-6, 6e-6])
+        legs.append(encode_polyline(np.array(DEFAULT_CENTER) + np.cumsum(steps, axis=0)))
+    total_points = 40 * 2000
+    encoded_bytes = sum(len(leg) for leg in legs)
+
+    start = time.perf_counter()
+    decoded = [decode_polyline(leg) for leg in legs]
+    elapsed = time.perf_counter() - start
+    print(f"decode: {total_points / elapsed / 1e6:.2f} M points/s ({encoded_bytes / 1024:.0f} KiB encoded)")
+
+    for zoom in (12, 14, 16):
+        tolerance = tolerance_for_zoom(zoom)
+        start = time.perf_counter()
+        simplified = [simplify(path, tolerance) for path in decoded]
+        elapsed = time.perf_counter() - start
+        kept = sum(len(path) for path in simplified)
+        size = sum(len(encode_polyline(path)) for path in simplified)
+        print(f"simplify zoom {zoom} ({tolerance:.1f} m): {total_points / elapsed / 1e6:.2f} M points/s, "
+              f"{kept} of {total_points} points kept, {size / 1024:.1f} KiB encoded")
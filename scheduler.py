@@ -0,0 +1,271 @@
+# scheduler.py
+# Quota-aware rate limiting and priority scheduling for OpenAI and Google calls
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+
+import os
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from openai import RateLimitError, APIConnectionError, InternalServerError
+
+from metrics import metrics
+
+# Priority classes - lower value is served first
+PRIORITIES = {
+    "interactive": 0,  # Chat turns in the UI / service
+    "itinerary": 1,    # Itinerary generation
+    "evaluator": 2     # Offline evaluation runs
+}
+
+# How long a call may wait in the queue by default, per priority (seconds)
+DEFAULT_QUEUE_TIMEOUTS = {
+    "interactive": 30,
+    "itinerary": 60,
+    "evaluator": 300
+}
+
+# Retries of a failed OpenAI call outside a request deadline. The clients are
+# created with max_retries=0: their own retries do not know about the deadline
+OPENAI_MAX_RETRIES = 2
+
+# Priority and absolute deadline of the current request (set by the entry points)
+current_priority = ContextVar("current_priority", default="interactive")
+current_deadline = ContextVar("current_deadline", default=None)
+
+
+class SchedulerTimeout(TimeoutError):
+    """Raised when a call could not get a rate limit slot before its deadline."""
+
+
+@contextmanager
+def request_priority(name: str):
+    """Run the block with the given priority class."""
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown priority class: {name}")
+    token = current_priority.set(name)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+@contextmanager
+def request_deadline(seconds: float):
+    """Run the block with an absolute deadline `seconds` from now.
+
+    An already active, earlier deadline is kept.
+    """
+    deadline = time.monotonic() + seconds
+    outer = current_deadline.get()
+    token = current_deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining_time(default: float = None):
+    """Seconds left until the current deadline, or `default` if there is none."""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return default
+    return max(0.0, deadline - time.monotonic())
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `per_minute` tokens per minute."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available (0 if available now)."""
+        self._refill()
+        # Requests larger than the whole bucket are allowed once it is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        """Remove tokens; may go negative when correcting an estimate."""
+        self._refill()
+        self.tokens -= amount
+
+
+class ProviderLimiter:
+    """Request and token budgets of one provider plus its priority queue."""
+
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float = None):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.queue = []
+        self.cond = threading.Condition()
+        self.paused_until = 0.0
+
+    def _wait_time(self, tokens: float) -> float:
+        wait = max(self.paused_until - time.monotonic(), self.requests.wait_time(1))
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def acquire(self, tokens: float = 0, priority: str = None, deadline: float = None):
+        """Block until the call may start. Raises SchedulerTimeout after the deadline."""
+        priority = priority or current_priority.get()
+        ticket = (PRIORITIES[priority], next(_sequence))
+        start = time.monotonic()
+
+        with self.cond:
+            heapq.heappush(self.queue, ticket)
+            try:
+                while True:
+                    wait = None
+                    # Only the head of the queue may take budget, so higher priorities go first
+                    if self.queue[0] == ticket:
+                        wait = self._wait_time(tokens)
+                        if wait <= 0:
+                            heapq.heappop(self.queue)
+                            self.requests.take(1)
+                            if self.tokens is not None and tokens:
+                                self.tokens.take(tokens)
+                            break
+
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.queue.remove(ticket)
+                            heapq.heapify(self.queue)
+                            metrics.inc(f"scheduler.{self.name}.expired")
+                            raise SchedulerTimeout(
+                                f"No {self.name} rate limit slot within the deadline ({priority})"
+                            )
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self.cond.wait(wait)
+            finally:
+                # Let the next ticket re-check whether it is now at the head
+                self.cond.notify_all()
+
+        waited = time.monotonic() - start
+        metrics.observe(f"scheduler.{self.name}.queue_wait", waited)
+        metrics.observe(f"scheduler.{self.name}.{priority}.queue_wait", waited)
+        metrics.inc(f"scheduler.{self.name}.admitted")
+
+    def correct_tokens(self, delta: float):
+        """Adjust the token budget once the real usage of a call is known."""
+        if self.tokens is not None and delta:
+            with self.cond:
+                self.tokens.take(delta)
+
+    def pause(self, seconds: float):
+        """Stop admitting calls for a while (after the provider reported a rate limit)."""
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            metrics.inc(f"scheduler.{self.name}.throttled")
+
+
+_sequence = itertools.count()
+
+
+class Scheduler:
+    """Central registry of the per-provider limiters."""
+
+    def __init__(self):
+        self.providers = {}
+
+    def add_provider(self, name: str, requests_per_minute: float, tokens_per_minute: float = None):
+        self.providers[name] = ProviderLimiter(name, requests_per_minute, tokens_per_minute)
+
+    def acquire(self, provider: str, tokens: float = 0, priority: str = None, timeout: float = None):
+        """Wait for a slot of `provider`.
+
+        The queue deadline is the earliest of the explicit timeout, the request
+        deadline (request_deadline) and the default timeout of the priority class.
+        """
+        priority = priority or current_priority.get()
+        if timeout is None:
+            timeout = DEFAULT_QUEUE_TIMEOUTS[priority]
+        deadline = time.monotonic() + timeout
+        if current_deadline.get() is not None:
+            deadline = min(deadline, current_deadline.get())
+        self.providers[provider].acquire(tokens, priority, deadline)
+
+
+scheduler = Scheduler()
+scheduler.add_provider(
+    "openai",
+    requests_per_minute=float(os.getenv("OPENAI_RPM", "500")),
+    tokens_per_minute=float(os.getenv("OPENAI_TPM", "200000"))
+)
+scheduler.add_provider(
+    "google_maps",
+    requests_per_minute=float(os.getenv("MAPS_RPM", "3000"))
+)
+
+
+def estimate_tokens(messages) -> int:
+    """Rough prompt size estimate (about 4 characters per token)."""
+    return sum(len(str(getattr(m, "content", m))) for m in messages) // 4 + 4 * len(messages)
+
+
+def scheduled_invoke(model, messages, expected_output_tokens: int = 500, **kwargs):
+    """Invoke a chat model once the OpenAI budget allows it.
+
+    Within a request deadline the HTTP timeout of the call is the time left
+    and a failed call is not retried (a retry could only overrun the deadline).
+    Otherwise timeouts, connection, server and rate limit errors are retried
+    up to OPENAI_MAX_RETRIES times with exponential backoff.
+    """
+    estimate = estimate_tokens(messages) + expected_output_tokens
+    scheduler.acquire("openai", tokens=estimate)
+    if remaining_time() is not None and "timeout" not in kwargs:
+        kwargs["timeout"] = max(remaining_time(), 1.0)
+    for attempt in itertools.count():
+        try:
+            response = model.invoke(messages, **kwargs)
+            break
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            if isinstance(e, RateLimitError):
+                # Hold back everyone else for a moment
+                scheduler.providers["openai"].pause(5)
+            if remaining_time() is not None or attempt >= OPENAI_MAX_RETRIES:
+                raise
+            metrics.inc("scheduler.openai.retries")
+            time.sleep(min(0.5 * 2 ** attempt, 8.0))
+
+    # True up the token budget with the real usage when the provider reports it
+    usage = getattr(response, "usage_metadata", None)
+    if usage and usage.get("total_tokens"):
+        scheduler.providers["openai"].correct_tokens(usage["total_tokens"] - estimate)
+        record_cache_usage(usage)
+    return response
+
+
+def record_cache_usage(usage: dict):
+    """Count prompt tokens and the part served from the provider's prompt cache."""
+    input_tokens = usage.get("input_tokens") or 0
+    cached = (usage.get("input_token_details") or {}).get("cache_read") or 0
+    metrics.inc("openai.input_tokens", input_tokens)
+    metrics.inc("openai.cached_input_tokens", cached)
+    if input_tokens:
+        # Recorded like a timing so the summary shows the average and percentiles
+        metrics.observe("openai.cached_token_ratio", cached / input_tokens)
+
+
+def cached_token_ratio() -> float:
+    """Share of all prompt tokens so far that came from the prompt cache."""
+    total = metrics.counter("openai.input_tokens")
+    return metrics.counter("openai.cached_input_tokens") / total if total else 0.0
@@ -0,0 +1,241 @@
+# service.py
+# ASGI service exposing the Budapest agent over HTTP and WebSocket
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# Run with several workers, e.g.:
+#   uvicorn service:app --host 0.0.0.0 --port 8000 --workers 4
+# The agent history of a session is resumed from the graph checkpointer
+# (thread ID = session ID) and the display history lives in the session
+# store, both SQLite by default, so any worker can serve any session.
+
+import json
+import time
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from starlette.concurrency import iterate_in_threadpool
+
+from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, SystemMessage
+
+from agent import budapest_agent
+from itinerary_agent import create_itinerary
+from circuit_breaker import breaker_states
+from hedging import hedge_stats
+from metrics import metrics
+from scheduler import cached_token_ratio
+from session_store import create_session_store
+from turn_summary import summarize_turn, extract_reasoning, visible_stream_text
+
+app = FastAPI(title="Budapest Explorer Agent Service")
+store = create_session_store()
+
+# Same step limit the Streamlit UI uses
+RECURSION_LIMIT = 10
+
+
+class ChatRequest(BaseModel):
+    message: str
+    session_id: Optional[str] = None
+    transport_mode: str = "transit"
+    stream: bool = False
+    bypass_cache: bool = False
+
+
+class ItineraryRequest(BaseModel):
+    start_location: str = "Deák Ferenc tér"
+    available_time: int = 4
+    interests: list = []
+    transport_mode: str = "transit"
+    special_requests: str = ""
+
+
+def message_events(message):
+    """Convert one graph message into streaming events."""
+    if isinstance(message, SystemMessage):
+        reasoning = extract_reasoning([message])
+        if reasoning:
+            yield {"type": "reasoning", "content": reasoning}
+    elif isinstance(message, AIMessage) and message.tool_calls:
+        for tool_call in message.tool_calls:
+            yield {"type": "tool_call", "tool": tool_call["name"], "args": tool_call["args"]}
+    elif isinstance(message, ToolMessage):
+        event = {"type": "tool_result", "tool": message.name, "result": message.content}
+        if message.artifact:
+            event["artifact"] = message.artifact
+        if message.response_metadata.get("source"):
+            event["source"] = message.response_metadata["source"]
+        yield event
+
+
+def run_chat_turn(session_id: str, user_message: str, transport_mode: str = "transit", bypass_cache: bool = False):
+    """Run one agent turn for a session and yield events as they happen.
+
+    The last event is always either 'final' or 'error'. The session is only
+    written back to the store when the turn succeeds. A near-duplicate of an
+    earlier factual question is answered from the answer cache unless
+    bypass_cache is set.
+    """
+    start_time = time.perf_counter()
+    session = store.load(session_id) or {"history": []}
+
+    # Add transportation mode context if needed (same convention as app.py)
+    content = user_message
+    if transport_mode and transport_mode != "transit":
+        content = f"{user_message} (használj {transport_mode} közlekedési módot)"
+    new_messages = [HumanMessage(content=content)]
+
+    try:
+        plan = None
+        cached = budapest_agent.cached_turn(session_id, new_messages[0], bypass=bypass_cache)
+        if cached is not None:
+            new_messages = cached
+            yield {"type": "token", "content": cached[-1].content}
+        else:
+            # Only the new message is sent, the history is resumed from the checkpoint
+            stream = budapest_agent.graph.stream(
+                {"messages": new_messages},
+                budapest_agent.thread_config(session_id, RECURSION_LIMIT),
+                stream_mode=["updates", "messages"]
+            )
+            streamed = {}
+            for mode, chunk in stream:
+                if mode == "messages":
+                    # Token stream of the answering model only, not the reasoning step
+                    message_chunk, metadata = chunk
+                    if metadata.get("langgraph_node") == "llm" and isinstance(message_chunk.content, str):
+                        text = visible_stream_text(streamed, message_chunk)
+                        if text:
+                            yield {"type": "token", "content": text}
+                    continue
+
+                for update in chunk.values():
+                    # The reasoning plan arrives as a state field, not as a message
+                    if (update or {}).get("plan"):
+                        plan = update["plan"]
+                        yield {"type": "reasoning", "content": plan}
+                    for message in (update or {}).get("messages", []):
+                        new_messages.append(message)
+                        yield from message_events(message)
+            budapest_agent.remember_turn(new_messages[0], new_messages)
+    except Exception as e:
+        metrics.inc("service.chat.errors")
+        yield {"type": "error", "session_id": session_id, "message": str(e)}
+        return
+
+    summary = summarize_turn(new_messages, plan)
+    session["history"].append({"user": user_message, "assistant": summary["response"]})
+    store.save(session_id, session)
+
+    metrics.inc("service.chat.turns")
+    metrics.observe("service.chat.turn_seconds", time.perf_counter() - start_time)
+    yield {"type": "final", "session_id": session_id, **summary}
+
+
+@app.get("/health")
+def health():
+    """Liveness check for the load balancer."""
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Counters and timings collected by this worker."""
+    answer_cache = budapest_agent.answer_cache.stats() if budapest_agent.answer_cache is not None else None
+    return dict(metrics.snapshot(), cached_token_ratio=cached_token_ratio(), hedging=hedge_stats(),
+                answer_cache=answer_cache)
+
+
+@app.get("/breakers")
+def get_breakers():
+    """Circuit breaker state of the external services (as seen by this worker)."""
+    return breaker_states()
+
+
+@app.post("/sessions")
+def create_session():
+    """Create an empty conversation and return its ID."""
+    session_id = store.new_session_id()
+    store.save(session_id, {"history": []})
+    return {"session_id": session_id}
+
+
+@app.get("/sessions/{session_id}")
+def get_session(session_id: str):
+    """Return the displayable history (user questions and answers) of a session."""
+    session = store.load(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown session")
+    return {"session_id": session_id, "history": session["history"]}
+
+
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str):
+    """Forget a conversation."""
+    store.delete(session_id)
+    # The conversation itself lives in the graph checkpoints of the thread
+    budapest_agent.delete_thread(session_id)
+    return {"session_id": session_id, "deleted": True}
+
+
+@app.post("/chat")
+def chat(request: ChatRequest):
+    """Answer a chat message. With stream=true the events are sent as NDJSON lines."""
+    session_id = request.session_id or store.new_session_id()
+    events = run_chat_turn(session_id, request.message, request.transport_mode, request.bypass_cache)
+
+    if request.stream:
+        lines = (json.dumps(event, ensure_ascii=False, default=str) + "\n" for event in events)
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    last_event = None
+    for last_event in events:
+        pass
+    if last_event is None or last_event["type"] == "error":
+        raise HTTPException(status_code=500, detail=last_event["message"] if last_event else "No response")
+    return last_event
+
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """Streaming chat over WebSocket.
+
+    The client sends {"message": ..., "session_id": ..., "transport_mode": ...}
+    and receives the same events as the NDJSON stream of /chat.
+    """
+    await websocket.accept()
+    try:
+        while True:
+            try:
+                request = ChatRequest.model_validate(json.loads(await websocket.receive_text()))
+            except (json.JSONDecodeError, ValidationError) as e:
+                # A malformed frame is answered, the connection stays open
+                metrics.inc("service.ws.bad_requests")
+                await websocket.send_text(json.dumps({"type": "error", "message": f"Invalid request: {e}"},
+                                                     ensure_ascii=False))
+                continue
+            session_id = request.session_id or store.new_session_id()
+            events = run_chat_turn(session_id, request.message, request.transport_mode, request.bypass_cache)
+            # The agent is synchronous, so drive it from the thread pool
+            async for event in iterate_in_threadpool(events):
+                await websocket.send_text(json.dumps(event, ensure_ascii=False, default=str))
+    except WebSocketDisconnect:
+        pass
+
+
+@app.post("/itinerary")
+def itinerary(request: ItineraryRequest):
+    """Create an itinerary from the same preferences as the Streamlit form."""
+    start_time = time.perf_counter()
+    try:
+        report = {}
+        result = create_itinerary(request.model_dump(), report)
+    except Exception as e:
+        metrics.inc("service.itinerary.errors")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    metrics.inc("service.itinerary.requests")
+    metrics.observe("service.itinerary.seconds", time.perf_counter() - start_time)
+    return {"itinerary": result, "stages": report["stages"], "map": report.get("map")}
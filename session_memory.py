@@ -0,0 +1,346 @@
+# session_memory.py
+# Memory accounting and eviction of the Streamlit session state
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# Every browser tab has its own session state in the Streamlit process,
+# and the heavy parts of it (tool results of every turn, reasoning texts,
+# route maps, itineraries, profiles) used to be kept for the lifetime of
+# the tab. These now live in SpillStores: each entry is sized when it is
+# added, and when a session grows over its cap, or all sessions together
+# over the global cap, the oldest entries are moved to disk (or dropped,
+# for diagnostics) - the least recently active sessions first. Spilled
+# entries are read back from disk when they are displayed, without being
+# kept in memory again. The few newest entries of a store always stay.
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import pickle
+import weakref
+import threading
+import tracemalloc
+from collections import OrderedDict
+
+from metrics import metrics
+
+MB = 1024 * 1024
+
+SESSION_MEMORY_MB = float(os.getenv("SESSION_MEMORY_MB", "20"))
+SESSION_MEMORY_TOTAL_MB = float(os.getenv("SESSION_MEMORY_TOTAL_MB", "200"))
+SESSION_SPILL_DIR = os.getenv("SESSION_SPILL_DIR", "session_spill")
+
+# Start tracing allocations with the process (also possible later from Developer Mode)
+if os.getenv("SESSION_TRACEMALLOC", "0") == "1":
+    tracemalloc.start(10)
+
+
+def deep_sizeof(obj, seen: set = None) -> int:
+    """Approximate size of an object and everything it references (bytes)."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+
+class _Spilled:
+    """Placeholder of an entry that was moved to disk."""
+    __slots__ = ("path", "size")
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+
+class SpillStore:
+    """Ordered key -> value store of one session whose oldest entries can leave memory.
+
+    policy "spill" writes evicted entries to disk, "drop" forgets them.
+    """
+
+    def __init__(self, session: "SessionMemory", name: str, policy: str = "spill", keep_recent: int = 2):
+        self.session = session
+        self.name = name
+        self.policy = policy
+        self.keep_recent = keep_recent
+        # key -> [sequence number, size, value or _Spilled]
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __setitem__(self, key, value):
+        size = deep_sizeof(value)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = [self.session.next_sequence(), size, value]
+        self.session.touch()
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._entries[key]
+        return self._load(entry)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._entries:
+                raise KeyError(key)
+            self._discard(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __bool__(self) -> bool:
+        return bool(self._entries)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+    def values(self) -> list:
+        with self._lock:
+            entries = list(self._entries.values())
+        return [self._load(entry) for entry in entries]
+
+    def items(self) -> list:
+        with self._lock:
+            entries = list(self._entries.items())
+        return [(key, self._load(entry)) for key, entry in entries]
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and isinstance(entry[2], _Spilled):
+            try:
+                os.remove(entry[2].path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _load(entry):
+        value = entry[2]
+        if not isinstance(value, _Spilled):
+            return value
+        # Read back for this use only: it stays on disk
+        metrics.inc("session_memory.spill_reads")
+        with open(value.path, "rb") as f:
+            return pickle.load(f)
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(size for _, size, value in self._entries.values() if not isinstance(value, _Spilled))
+
+    def spilled_bytes(self) -> int:
+        with self._lock:
+            return sum(size for _, size, value in self._entries.values() if isinstance(value, _Spilled))
+
+    def evictable(self) -> list:
+        """(sequence, size, key) of the entries that may leave memory, oldest first."""
+        with self._lock:
+            in_memory = [(entry[0], entry[1], key) for key, entry in self._entries.items()
+                         if not isinstance(entry[2], _Spilled)]
+        return sorted(in_memory)[:max(0, len(in_memory) - self.keep_recent)]
+
+    def evict(self, key) -> int:
+        """Move one entry out of memory; returns the bytes freed."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or isinstance(entry[2], _Spilled):
+                return 0
+            size = entry[1]
+            if self.policy == "drop":
+                del self._entries[key]
+                metrics.inc("session_memory.dropped")
+            else:
+                path = os.path.join(self.session.spill_dir, f"{self.name}_{entry[0]}.pkl")
+                os.makedirs(self.session.spill_dir, exist_ok=True)
+                with open(path, "wb") as f:
+                    pickle.dump(entry[2], f, protocol=pickle.HIGHEST_PROTOCOL)
+                entry[2] = _Spilled(path, size)
+                metrics.inc("session_memory.spilled")
+                metrics.inc("session_memory.spilled_bytes", size)
+        return size
+
+
+class SpillList(SpillStore):
+    """Append-only list version of a SpillStore (indexing, slicing, iteration)."""
+
+    def __init__(self, session: "SessionMemory", name: str, policy: str = "spill", keep_recent: int = 2):
+        super().__init__(session, name, policy, keep_recent)
+        self._next_key = 0
+
+    def append(self, value):
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+        self[key] = value
+
+    def __getitem__(self, index):
+        keys = self.keys()
+        if isinstance(index, slice):
+            return [SpillStore.__getitem__(self, key) for key in keys[index]]
+        return SpillStore.__getitem__(self, keys[index])
+
+    def __iter__(self):
+        return iter(self.values())
+
+
+class SessionMemory:
+    """The heavy session state of one Streamlit session, with its memory accounting."""
+
+    def __init__(self, label: str = ""):
+        self.session_id = uuid.uuid4().hex
+        self.label = label or self.session_id[:8]
+        self.spill_dir = os.path.join(SESSION_SPILL_DIR, self.session_id)
+        self.last_active = time.time()
+        self.stores = {}
+        self.other_bytes = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+        _register(self)
+        # Spill files go away with the session (Streamlit drops the state of closed tabs)
+        weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+
+    def spill_list(self, name: str, policy: str = "spill", keep_recent: int = 2) -> SpillList:
+        store = self.stores[name] = SpillList(self, name, policy, keep_recent)
+        return store
+
+    def spill_dict(self, name: str, policy: str = "spill", keep_recent: int = 2) -> SpillStore:
+        store = self.stores[name] = SpillStore(self, name, policy, keep_recent)
+        return store
+
+    def account_state(self, values: dict):
+        """Record the size of the session state kept outside the stores (not evictable)."""
+        self.other_bytes = deep_sizeof(values)
+
+    def next_sequence(self) -> int:
+        with self._lock:
+            self._sequence += 1
+            return self._sequence
+
+    def touch(self):
+        self.last_active = time.time()
+
+    def memory_bytes(self) -> int:
+        return self.other_bytes + sum(store.memory_bytes() for store in self.stores.values())
+
+    def evict(self, target_bytes: int) -> int:
+        """Evict the oldest entries of this session until it uses at most target_bytes."""
+        over = self.memory_bytes() - target_bytes
+        if over <= 0:
+            return 0
+        candidates = sorted((sequence, size, store, key)
+                            for store in self.stores.values()
+                            for sequence, size, key in store.evictable())
+        freed = 0
+        for _, _, store, key in candidates:
+            if freed >= over:
+                break
+            freed += store.evict(key)
+        return freed
+
+    def report(self) -> dict:
+        return {
+            "session": self.label,
+            "last_active": self.last_active,
+            "memory_bytes": self.memory_bytes(),
+            "other_bytes": self.other_bytes,
+            "stores": {
+                name: {"entries": len(store), "memory_bytes": store.memory_bytes(),
+                       "spilled_bytes": store.spilled_bytes(), "policy": store.policy}
+                for name, store in self.stores.items()
+            }
+        }
+
+
+# Live sessions of this process; entries vanish when Streamlit drops a session
+_sessions = weakref.WeakValueDictionary()
+_sessions_lock = threading.Lock()
+
+
+def _register(session: SessionMemory):
+    with _sessions_lock:
+        _sessions[session.session_id] = session
+
+
+def live_sessions() -> list:
+    with _sessions_lock:
+        return list(_sessions.values())
+
+
+def enforce_limits(current: SessionMemory = None, session_mb: float = None, total_mb: float = None) -> int:
+    """Apply the per-session and the global cap; returns the bytes freed.
+
+    Called after every script run of a session. Over the global cap the
+    least recently active sessions give up their old entries first.
+    """
+    session_cap = int((SESSION_MEMORY_MB if session_mb is None else session_mb) * MB)
+    total_cap = int((SESSION_MEMORY_TOTAL_MB if total_mb is None else total_mb) * MB)
+    freed = 0
+    if current is not None:
+        freed += current.evict(session_cap)
+
+    sessions = live_sessions()
+    usage = {session.session_id: session.memory_bytes() for session in sessions}
+    total = sum(usage.values())
+    for session in sorted(sessions, key=lambda s: s.last_active):
+        if total <= total_cap:
+            break
+        released = session.evict(max(0, usage[session.session_id] - (total - total_cap)))
+        total -= released
+        freed += released
+    if freed:
+        metrics.inc("session_memory.evicted_bytes", freed)
+    return freed
+
+
+def memory_report(top: int = 15) -> dict:
+    """Accounted memory per session, and the top allocation sites if tracemalloc is on."""
+    sessions = sorted((session.report() for session in live_sessions()),
+                      key=lambda r: r["memory_bytes"], reverse=True)
+    report = {
+        "session_cap_bytes": int(SESSION_MEMORY_MB * MB),
+        "total_cap_bytes": int(SESSION_MEMORY_TOTAL_MB * MB),
+        "total_bytes": sum(r["memory_bytes"] for r in sessions),
+        "sessions": sessions,
+        "tracemalloc": None
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+        ))
+        report["tracemalloc"] = {
+            "current_bytes": current,
+            "peak_bytes": peak,
+            "top": [
+                {"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                 "bytes": stat.size, "blocks": stat.count}
+                for stat in snapshot.statistics("lineno")[:top]
+            ]
+        }
+    return report
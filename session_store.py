@@ -0,0 +1,107 @@
+# session_store.py
+# Pluggable conversation session storage for Budapest Explorer
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import uuid
+
+
+class SessionStore:
+    """Base class for session stores. Sessions are JSON-serializable dicts."""
+
+    def new_session_id(self) -> str:
+        """Generate a fresh, unique session ID."""
+        return uuid.uuid4().hex
+
+    def load(self, session_id: str) -> dict:
+        """Return the stored session data, or None if the session is unknown."""
+        raise NotImplementedError
+
+    def save(self, session_id: str, data: dict):
+        """Create or overwrite the session data."""
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        """Remove a session (no error if it does not exist)."""
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    """Process-local store, only useful for a single worker or for development."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, session_id: str) -> dict:
+        with self._lock:
+            data = self._sessions.get(session_id)
+        return json.loads(data) if data is not None else None
+
+    def save(self, session_id: str, data: dict):
+        with self._lock:
+            self._sessions[session_id] = json.dumps(data, ensure_ascii=False)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite-backed store that can be shared by several worker processes."""
+
+    def __init__(self, path: str = "sessions.db"):
+        self.path = path
+        with self._connect() as conn:
+            # WAL lets readers and a writer from different processes work at the same time
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        # A new connection per call keeps the store safe to use from any thread
+        return sqlite3.connect(self.path, timeout=30)
+
+    def load(self, session_id: str) -> dict:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT data FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, session_id: str, data: dict):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (session_id, json.dumps(data, ensure_ascii=False), time.time())
+            )
+
+    def delete(self, session_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+
+def create_session_store(url: str = None) -> SessionStore:
+    """Create a session store from a URL like 'sqlite:///sessions.db' or 'memory://'.
+
+    Defaults to the SESSION_STORE_URL environment variable, then to SQLite.
+    """
+    url = url or os.getenv("SESSION_STORE_URL", "sqlite:///sessions.db")
+
+    if url.startswith("memory://"):
+        return InMemorySessionStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteSessionStore(url[len("sqlite:///"):])
+
+    raise ValueError(f"Unsupported session store URL: {url}")
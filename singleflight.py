@@ -0,0 +1,74 @@
+# singleflight.py
+# Coalescing of identical in-flight calls (one upstream request, many waiters)
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+
+import threading
+
+from metrics import metrics
+
+
+class _Call:
+    """One in-flight call that several callers may be waiting on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time.
+
+    Callers that arrive while a call with the same key is still running do
+    not start their own; they wait and receive the result (or exception)
+    of the running call. Results are shared between all waiters, so they
+    must be treated as read-only.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return fn(), sharing the result with concurrent callers of the same key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            metrics.inc(f"singleflight.{self.name}.coalesced")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.inc(f"singleflight.{self.name}.calls")
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # Forget the call before waking the waiters, so later callers start fresh
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> dict:
+        """Upstream calls made and requests served by joining an in-flight call."""
+        return {
+            "calls": metrics.counter(f"singleflight.{self.name}.calls"),
+            "coalesced": metrics.counter(f"singleflight.{self.name}.coalesced")
+        }
+
+
+# Shared groups for the external lookups
+directions_flight = SingleFlight("directions")
+places_flight = SingleFlight("places")
+search_flight = SingleFlight("search")
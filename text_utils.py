@@ -0,0 +1,21 @@
+# text_utils.py
+# Small text helpers shared by the agent runtime and the evaluation tools
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+
+import re
+
+HUNGARIAN_WORDS = {"a", "az", "és", "hogy", "nem", "van", "egy", "meg", "is", "ki", "el", "perc", "óra", "utca",
+                   "tér", "hogyan", "mi", "szeretnék", "juthatok", "majd", "vagy", "ahol", "ezt", "itt"}
+ENGLISH_WORDS = {"the", "and", "is", "to", "of", "you", "in", "from", "how", "what", "can", "take", "then",
+                 "minutes", "street", "square", "with", "for", "near", "this", "get", "i"}
+
+
+def detect_language(text: str) -> str:
+    """'hu', 'en' or 'unknown' from common words and Hungarian letters."""
+    words = re.findall(r"\w+", text.lower())
+    hungarian = sum(word in HUNGARIAN_WORDS for word in words) + 2 * len(re.findall(r"[őűŐŰ]", text))
+    english = sum(word in ENGLISH_WORDS for word in words)
+    if hungarian == english:
+        return "hu" if re.search(r"[áéíóöúü]", text.lower()) else "unknown"
+    return "hu" if hungarian > english else "en"
@@ -0,0 +1,92 @@
+# tool_memo.py
+# Conversation-scoped memo of tool results for the agent loop
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# The model often repeats a tool call it already made in the same
+# conversation (e.g. the same directions after a follow-up question).
+# take_action looks the call up here first; the key is the tool name plus
+# the canonical arguments, and every tool has its own time-to-live.
+
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from metrics import metrics
+from prefetch import canonical_args
+
+# How long a result may be reused, per tool (seconds); 0 disables memoization
+TOOL_MEMO_TTLS = {
+    "parse_input_tool": 3600,
+    "extract_attractions_tool": 3600,
+    "directions_tool": 600,         # Transit departures move on
+    "attractions_tool": 1800,       # Opening state changes during the day
+    "attraction_info_tool": 86400
+}
+DEFAULT_TTL = 300
+
+
+def is_error_result(result) -> bool:
+    """Whether a tool reported a failure: an "error" field or source "error" in its result.
+
+    Content-and-artifact tools come back as JSON text, which is parsed, not pattern matched.
+    """
+    if isinstance(result, str):
+        try:
+            result = json.loads(result)
+        except ValueError:
+            return False
+    return isinstance(result, dict) and ("error" in result or result.get("source") == "error")
+
+
+class ToolMemo:
+    """Tool results per conversation thread (LRU over threads and entries)."""
+
+    def __init__(self, ttls: dict = None, max_threads: int = 1000, max_entries: int = 64):
+        self.ttls = dict(TOOL_MEMO_TTLS if ttls is None else ttls)
+        self.max_threads = max_threads
+        self.max_entries = max_entries
+        self._threads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, name: str) -> float:
+        return self.ttls.get(name, DEFAULT_TTL)
+
+    def get(self, thread_id, tool, name: str, args: dict):
+        """(result, artifact) of an earlier identical call, or None."""
+        if thread_id is None or not self.ttl(name):
+            return None
+        key = (name, canonical_args(tool, args))
+        with self._lock:
+            entries = self._threads.get(thread_id)
+            entry = entries.get(key) if entries is not None else None
+            if entry is not None and entry[0] < time.monotonic():
+                del entries[key]
+                entry = None
+            if entry is None:
+                metrics.inc(f"tool_memo.{name}.misses")
+                return None
+            self._threads.move_to_end(thread_id)
+            entries.move_to_end(key)
+        metrics.inc(f"tool_memo.{name}.hits")
+        return entry[1], entry[2]
+
+    def put(self, thread_id, tool, name: str, args: dict, result, artifact=None):
+        if thread_id is None or not self.ttl(name) or is_error_result(result):
+            return
+        key = (name, canonical_args(tool, args))
+        with self._lock:
+            entries = self._threads.setdefault(thread_id, OrderedDict())
+            self._threads.move_to_end(thread_id)
+            entries[key] = (time.monotonic() + self.ttl(name), result, artifact)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            while len(self._threads) > self.max_threads:
+                self._threads.popitem(last=False)
+
+    def clear(self, thread_id):
+        """Forget a conversation (e.g. when its session is deleted)."""
+        with self._lock:
+            self._threads.pop(thread_id, None)
@@ -0,0 +1,212 @@
+# travel_matrix.py
+# Precomputed landmark-to-landmark travel times stored as memory-mapped arrays
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+#
+# Build (offline, uses the directions backend):
+#   python travel_matrix.py build --landmarks data/landmarks.json --modes transit walking
+# Files written to the output directory:
+#   travel_matrix_<mode>.npy   float32 array of shape (2, n, n):
+#                              [0] = duration in seconds, [1] = distance in meters, NaN = unknown
+#   travel_matrix_index.json   landmark names, aliases and coordinates (row/column order)
+
+import os
+import re
+import json
+import argparse
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+import numpy as np
+
+INDEX_FILE = "travel_matrix_index.json"
+
+
+def normalize_place_name(name: str) -> str:
+    """Canonical form of a place name for lookups (case, accents, city suffix)."""
+    text = unicodedata.normalize("NFKD", name.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r",?\s*(budapest|hungary|magyarorszag)\b", "", text)
+    text = re.sub(r"[^a-z0-9]+", " ", text)
+    return text.strip()
+
+
+def format_duration(seconds: float) -> str:
+    minutes = int(round(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} perc"
+    return f"{minutes // 60} óra {minutes % 60} perc"
+
+
+def format_distance(meters: float) -> str:
+    if meters < 1000:
+        return f"{int(round(meters))} m"
+    return f"{meters / 1000:.1f} km"
+
+
+class TravelMatrix:
+    """Read-only access to the precomputed matrices (loaded lazily, memory-mapped)."""
+
+    def __init__(self, directory: str = "data"):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.landmarks = []
+        self.modes = []
+        self._names = {}
+        self._matrices = {}
+
+    def _load(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            index_path = os.path.join(self.directory, INDEX_FILE)
+            if os.path.exists(index_path):
+                with open(index_path, encoding="utf-8") as f:
+                    index = json.load(f)
+                self.landmarks = index["landmarks"]
+                self.modes = index["modes"]
+                for i, landmark in enumerate(self.landmarks):
+                    for name in [landmark["name"]] + landmark.get("aliases", []):
+                        self._names.setdefault(normalize_place_name(name), i)
+                for mode in self.modes:
+                    path = os.path.join(self.directory, f"travel_matrix_{mode}.npy")
+                    if os.path.exists(path):
+                        self._matrices[mode] = np.load(path, mmap_mode="r")
+            self._loaded = True
+
+    @property
+    def available(self) -> bool:
+        self._load()
+        return bool(self._matrices)
+
+    def index_of(self, name: str):
+        """Row/column of a landmark by name or alias, or None if unknown."""
+        self._load()
+        return self._names.get(normalize_place_name(name))
+
+    def location_of(self, name: str):
+        """(lat, lng) of a landmark if known from the build, else None."""
+        i = self.index_of(name)
+        if i is None or self.landmarks[i].get("lat") is None:
+            return None
+        return self.landmarks[i]["lat"], self.landmarks[i]["lng"]
+
+    def lookup(self, from_place: str, to_place: str, mode: str = "transit"):
+        """Precomputed duration and distance between two landmarks, or None."""
+        self._load()
+        matrix = self._matrices.get(mode)
+        i, j = self.index_of(from_place), self.index_of(to_place)
+        if matrix is None or i is None or j is None:
+            return None
+
+        duration, distance = float(matrix[0, i, j]), float(matrix[1, i, j])
+        if np.isnan(duration):
+            return None
+        return {
+            "from": self.landmarks[i]["name"],
+            "to": self.landmarks[j]["name"],
+            "mode": mode,
+            "duration_s": duration,
+            "distance_m": distance,
+            "duration_text": format_duration(duration),
+            "distance_text": format_distance(distance)
+        }
+
+    def durations(self, names: list, mode: str = "transit"):
+        """Duration matrix (seconds) between the given places; NaN where unknown."""
+        self._load()
+        result = np.full((len(names), len(names)), np.nan)
+        np.fill_diagonal(result, 0.0)
+        matrix = self._matrices.get(mode)
+        if matrix is None:
+            return result
+
+        rows = [self.index_of(name) for name in names]
+        known = [k for k, row in enumerate(rows) if row is not None]
+        if known:
+            known_rows = [rows[k] for k in known]
+            result[np.ix_(known, known)] = matrix[0][np.ix_(known_rows, known_rows)]
+        return result
+
+
+def build(landmarks_path: str, modes: list, out_dir: str = "data", workers: int = 8, backend=None):
+    """Compute the matrices with the directions backend and write them to out_dir."""
+    from scheduler import request_priority
+
+    if backend is None:
+        from agent import get_directions as backend
+
+    with open(landmarks_path, encoding="utf-8") as f:
+        landmarks = json.load(f)
+    n = len(landmarks)
+    os.makedirs(out_dir, exist_ok=True)
+    pairs = [(i, j) for i in range(n) for j in range(n) if i != j]
+
+    for mode in modes:
+        path = os.path.join(out_dir, f"travel_matrix_{mode}.npy")
+        matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(2, n, n))
+        matrix[:] = np.nan
+        matrix[:, np.arange(n), np.arange(n)] = 0.0
+
+        def compute(pair):
+            i, j = pair
+            route = backend(landmarks[i]["name"], landmarks[j]["name"], mode)
+            if not route.get("routes"):
+                return pair, None
+            leg = route["routes"][0]["legs"][0]
+            return pair, leg
+
+        # Offline work at the lowest priority. Pool threads do not inherit context
+        # variables, so every task runs in a copy of this context. The scheduler is
+        # per process: in the CLI this only paces the build's own requests against
+        # the local rate limits, it does not yield to a running app or service.
+        with request_priority("evaluator"), ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(copy_context().run, compute, pair) for pair in pairs]
+            for done, future in enumerate(futures, start=1):
+                (i, j), leg = future.result()
+                if leg is not None:
+                    matrix[0, i, j] = leg["duration"]["value"]
+                    matrix[1, i, j] = leg["distance"]["value"]
+                    landmarks[i].setdefault("lat", leg["start_location"]["lat"])
+                    landmarks[i].setdefault("lng", leg["start_location"]["lng"])
+                if done % 100 == 0:
+                    print(f"  {mode}: {done}/{len(pairs)}")
+
+        matrix.flush()
+        del matrix
+        print(f"Wrote {path}")
+
+    with open(os.path.join(out_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump({"landmarks": landmarks, "modes": modes}, f, ensure_ascii=False, indent=1)
+
+
+# Shared instance used by the agent and the itinerary planner
+travel_matrix = TravelMatrix(os.getenv("TRAVEL_MATRIX_DIR", "data"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Landmark travel-time matrix tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Compute the matrices (calls the directions backend)")
+    build_parser.add_argument("--landmarks", default="data/landmarks.json")
+    build_parser.add_argument("--modes", nargs="+", default=["transit", "walking"])
+    build_parser.add_argument("--out", default="data")
+    build_parser.add_argument("--workers", type=int, default=8)
+
+    lookup_parser = subparsers.add_parser("lookup", help="Look up one pair")
+    lookup_parser.add_argument("from_place")
+    lookup_parser.add_argument("to_place")
+    lookup_parser.add_argument("--mode", default="transit")
+    lookup_parser.add_argument("--dir", default="data")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build(args.landmarks, args.modes, args.out, args.workers)
+    else:
+        print(TravelMatrix(args.dir).lookup(args.from_place, args.to_place, args.mode))
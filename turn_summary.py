@@ -0,0 +1,103 @@
+# turn_summary.py
+# Helpers that turn agent result messages into display data
+# Author: Szalay Miklós Márton
+# Thesis project for Pannon University
+
+import re
+from langchain_core.messages import AIMessage, ToolMessage, SystemMessage
+
+
+def extract_reasoning(messages):
+    """Return the reasoning plan from the reasoning SystemMessage, if any."""
+    for msg in messages:
+        if isinstance(msg, SystemMessage) and "### Reasoning Plan:" in msg.content:
+            # Extract the reasoning part
+            match = re.search(r"### Reasoning Plan:(.*?)###", msg.content, re.DOTALL)
+            if match:
+                return match.group(1).strip()
+    return None
+
+
+def _visible_text(text):
+    """Text without a leading <plan>...</plan> block (written by the plan_act topology)."""
+    stripped = text.lstrip()
+    if "<plan>".startswith(stripped[:6]) and len(stripped) < 6:
+        return ""  # Could still turn out to be a plan
+    if not stripped.startswith("<plan>"):
+        return text
+    if "</plan>" not in stripped:
+        return ""
+    return stripped.split("</plan>", 1)[1].lstrip()
+
+
+def visible_stream_text(seen: dict, chunk) -> str:
+    """New user-visible text of a streamed message chunk; the plan is held back.
+
+    seen keeps the text received so far per message ID.
+    """
+    before = seen.get(chunk.id, "")
+    seen[chunk.id] = before + chunk.content
+    return _visible_text(seen[chunk.id])[len(_visible_text(before)):]
+
+
+def extract_final_response(messages):
+    """Return the last AIMessage from the messages, if any."""
+    for msg in reversed(messages):
+        if isinstance(msg, AIMessage):
+            return msg
+    return None
+
+
+def extract_steps(messages):
+    """List the tool calls and tool results in the order they happened."""
+    steps = []
+    for message in messages:
+        if hasattr(message, 'tool_calls') and message.tool_calls:
+            for tool_call in message.tool_calls:
+                steps.append({
+                    "tool": tool_call["name"],
+                    "args": tool_call["args"],
+                    "step": "tool_call"
+                })
+        elif isinstance(message, ToolMessage):
+            step = {
+                "tool": message.name,
+                "result": message.content,
+                "step": "tool_result"
+            }
+            # Data for the UI only (e.g. route geometry), not seen by the model
+            if message.artifact:
+                step["artifact"] = message.artifact
+            # "memo" / "prefetch" when the tool did not have to run now
+            if message.response_metadata.get("source"):
+                step["source"] = message.response_metadata["source"]
+            steps.append(step)
+    return steps
+
+
+def extract_map_data(steps) -> dict:
+    """Merge the route paths and POIs of the tool artifacts of a turn."""
+    map_data = {"paths": [], "points": []}
+    for step in steps:
+        artifact = step.get("artifact") or {}
+        map_data["paths"] += artifact.get("paths", [])
+        map_data["points"] += artifact.get("points", [])
+    return map_data
+
+
+def summarize_turn(messages, plan: str = None) -> dict:
+    """Collect the reasoning, final answer and tool steps of one agent turn.
+
+    The reasoning plan lives in the agent state, not in the messages; pass it
+    as plan (older checkpoints still have it as a SystemMessage).
+    """
+    final_response = extract_final_response(messages)
+    return {
+        "reasoning": plan or extract_reasoning(messages),
+        "response": final_response.content if final_response else None,
+        "steps": extract_steps(messages),
+        # "deadline" / "step_limit" when the agent had to answer early
+        "forced_final": final_response.response_metadata.get("forced_final") if final_response else None,
+        # Earlier question whose answer was reused by the answer cache
+        "cached_query": final_response.response_metadata.get("cached_query") if final_response else None
+    }